@@ -36,12 +36,16 @@ def main(args):
         cookie_data = environ['HTTP_COOKIE']
     except KeyError:
         cookie_data = None
+    try:
+        accept_encoding = environ['HTTP_ACCEPT_ENCODING']
+    except KeyError:
+        accept_encoding = None
 
     params = FieldStorage()
 
     # Call main server
     cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-            cookie_data)
+            cookie_data, accept_encoding)
 
     # Package and send response
     if cookie_hdrs is not None:
@@ -56,8 +60,12 @@ def main(args):
     # Hack to support binary data and general Unicode for SVGs and JSON
     if isinstance(response_data[1], unicode):
         stdout.write(response_data[1].encode('utf-8'))
-    else:
+    elif isinstance(response_data[1], str):
         stdout.write(response_data[1])
+    else:
+        # Streamed in pieces
+        for data in response_data[1]:
+            stdout.write(data)
     return 0
 
 def profile_main(argv):
@@ -75,6 +75,83 @@ USER_PASSWORD = {
 MAX_SEARCH_RESULT_NUMBER = 1000
 
 
+### MAPPED_TEXT_MIN_SIZE
+# Document texts of at least this many bytes are memory-mapped instead of
+# read and decoded in full when opened for annotation, which speeds up
+# requests on very long texts. (never mapped if None, defaults to 1MB)
+
+#MAPPED_TEXT_MIN_SIZE = 1024 * 1024
+
+
+### PARSE_CACHE_SIZE
+# Parsed annotation files are cached in the work directory to speed up
+# opening documents again. At most this many are kept, the oldest ones
+# being removed first. (defaults to 4096)
+
+#PARSE_CACHE_SIZE = 4096
+
+
+### OFFSET_CACHE_SIZE
+# The token and sentence offsets of document texts are cached in the work
+# directory. At most this many texts are kept, the oldest ones being
+# removed first. (defaults to 4096)
+
+#OFFSET_CACHE_SIZE = 4096
+
+
+### DOCUMENT_CACHE_SIZE
+# The responses to getDocument for this many of the most recently viewed
+# documents are kept in the work directory to serve repeated views.
+# (no caching if None or 0, defaults to 256)
+
+#DOCUMENT_CACHE_SIZE = 256
+
+
+### STATS_WORKERS
+# Number of processes generating document statistics (and validation
+# issue counts) for collection listings in parallel; tools/warm_stats.py
+# can generate them ahead of time. The processes are forked from the
+# server, which they can only be from servers running each request in a
+# process of its own (CGI, standalone.py): under the threaded FastCGI
+# server (ajax.fcgi) the statistics are generated by the request thread.
+# (as many as there are CPUs if None)
+
+#STATS_WORKERS = None
+
+
+### STATS_TIME_BUDGET
+# Seconds a collection listing may spend generating statistics, those of
+# the documents left over being shown as missing until a later listing.
+# (no limit if None)
+
+#STATS_TIME_BUDGET = 10
+
+
+### SEARCH_WORKERS
+# Number of processes used to search collections of many documents.
+# As for STATS_WORKERS, they are only forked from servers running each
+# request in a process of its own, not from the threaded FastCGI server.
+# (as many as there are CPUs if None)
+
+#SEARCH_WORKERS = 4
+
+
+### SEARCH_TIME_BUDGET
+# Seconds a search in a collection may take, the results being those
+# found in the documents searched by then.
+# (no limit if None)
+
+#SEARCH_TIME_BUDGET = 30
+
+
+### RESPONSE_COMPRESSION_MIN_SIZE
+# JSON responses of at least this many bytes are compressed (gzip or
+# deflate) for clients that accept it, which pays off on slow links.
+# (never compressed if None, defaults to 1024)
+
+#RESPONSE_COMPRESSION_MIN_SIZE = 1024
+
+
 ### DEBUG
 # Set to True to enable additional debug output
 
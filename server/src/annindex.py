@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Persistent per-collection index of the annotations of the documents, used
+to find the documents with annotations matching a search without reading
+every annotation file of a collection.
+
+The index is a small SQLite database under WORK_DIR with a row for each
+annotation (its id, kind, type, text, offsets and target) and for each of
+the arguments of the relations, events and equivs. It is brought up to
+date incrementally before every lookup: only the documents marked as
+written by invalidate_document() since, and when documents were added to
+or removed from the collection those whose text or annotation files were
+added or changed (by modification time and size), are read again.
+
+The lookups return the names of the documents that may hold matches: the
+searches themselves are still made on the annotations of these documents
+only, so that their results are those of a search through all of them.
+'''
+
+import sqlite3 as sqlite
+
+from logging import info as log_info
+from os import listdir, stat
+from os.path import join as path_join
+from os.path import basename, dirname
+
+from annotation import (AnnotationFileNotFoundError, AnnotationNotFoundError,
+        BinaryRelationAnnotation, EquivAnnotation, EventAnnotation,
+        AttributeAnnotation, NormalizationAnnotation,
+        OnelineCommentAnnotation, TextBoundAnnotation, TextAnnotations,
+        JOINED_ANN_FILE_SUFF, PARTIAL_ANN_FILE_SUFF, TEXT_FILE_SUFFIX)
+from workdir import mark_changed, open_database, refresh_documents
+
+### Constants
+# Sub-directory of the work directory holding the indices
+ANN_INDEX_DIR_NAME = 'ann_index'
+# Bump this whenever the schema or the contents of the indices change
+ANN_INDEX_VERSION = 1
+# Seconds to wait for other processes updating the same index
+ANN_INDEX_TIMEOUT = 30
+# The suffixes of the files whose changes call for re-indexing a document
+INDEXED_FILE_SUFFIXES = ([TEXT_FILE_SUFFIX, JOINED_ANN_FILE_SUFF]
+        + PARTIAL_ANN_FILE_SUFF)
+###
+
+_SCHEMA = (
+        'CREATE TABLE documents ('
+            'id INTEGER PRIMARY KEY, name TEXT UNIQUE, identity TEXT)',
+        # kind is one of "entity", "trigger", "event", "relation", "equiv",
+        # "attribute", "normalization" and "note", the text that of an
+        # entity or trigger, the trigger text of an event, the value of an
+        # attribute, the reference of a normalization and the text of a
+        # note, the target that of an attribute, normalization or note and
+        # the trigger of an event
+        'CREATE TABLE annotations ('
+            'id INTEGER PRIMARY KEY, document INTEGER, ann_id TEXT, '
+            'kind TEXT, type TEXT, text TEXT, start INTEGER, end INTEGER, '
+            'target TEXT)',
+        'CREATE INDEX annotations_kind '
+            'ON annotations (kind, type)',
+        'CREATE INDEX annotations_document '
+            'ON annotations (document, ann_id)',
+        'CREATE TABLE arguments ('
+            'annotation INTEGER, position INTEGER, role TEXT, target TEXT)',
+        'CREATE INDEX arguments_annotation '
+            'ON arguments (annotation)',
+        )
+
+
+def _connect(directory):
+    # Returns a connection to the index for the given directory, None if it
+    # can not be opened
+    return open_database(ANN_INDEX_DIR_NAME, directory, _SCHEMA,
+            ANN_INDEX_VERSION, ANN_INDEX_TIMEOUT)
+
+
+def _annotation_rows(ann_obj):
+    # Generate the (annotation row, argument rows) of the annotations
+    triggers = set(e.trigger for e in ann_obj.get_events())
+    for ann in ann_obj:
+        ann_id = getattr(ann, 'id', None)
+        args = ()
+        if isinstance(ann, TextBoundAnnotation):
+            kind = 'trigger' if ann_id in triggers else 'entity'
+            row = (ann_id, kind, ann.type, getattr(ann, 'text', None),
+                    ann.first_start(), ann.last_end(), None)
+        elif isinstance(ann, EventAnnotation):
+            try:
+                trigger = ann_obj.get_ann_by_id(ann.trigger)
+                start, end = trigger.first_start(), trigger.last_end()
+                text = getattr(trigger, 'text', None)
+            except AnnotationNotFoundError:
+                start, end, text = None, None, None
+            row = (ann_id, 'event', ann.type, text, start, end, ann.trigger)
+            args = ann.args
+        elif isinstance(ann, BinaryRelationAnnotation):
+            row = (ann_id, 'relation', ann.type, None, None, None, None)
+            args = ((ann.arg1l, ann.arg1), (ann.arg2l, ann.arg2))
+        elif isinstance(ann, EquivAnnotation):
+            row = (None, 'equiv', ann.type, None, None, None, None)
+            args = [(None, e) for e in ann.entities]
+        elif isinstance(ann, AttributeAnnotation):
+            row = (ann_id, 'attribute', ann.type, unicode(ann.value),
+                    None, None, ann.target)
+        elif isinstance(ann, NormalizationAnnotation):
+            row = (ann_id, 'normalization', ann.type,
+                    u'%s:%s' % (ann.refdb, ann.refid), None, None, ann.target)
+        elif isinstance(ann, OnelineCommentAnnotation):
+            row = (ann_id, 'note', ann.type, ann.get_text(), None, None,
+                    ann.target)
+        else:
+            continue
+        yield row, args
+
+
+def _store_annotations(conn, doc_id, ann_obj):
+    # Index the annotations of a document, none if ann_obj is None
+    if ann_obj is None:
+        return
+    for row, args in _annotation_rows(ann_obj):
+        ann_row_id = conn.execute('INSERT INTO annotations (document, '
+                'ann_id, kind, type, text, start, end, target) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (doc_id, ) + row).lastrowid
+        conn.executemany('INSERT INTO arguments (annotation, position, role, '
+                'target) VALUES (?, ?, ?, ?)', ((ann_row_id, i, role, target)
+                    for i, (role, target) in enumerate(args)))
+
+
+def _delete_annotations(conn, doc_id):
+    conn.execute('DELETE FROM arguments WHERE annotation IN '
+            '(SELECT id FROM annotations WHERE document = ?)', (doc_id, ))
+    conn.execute('DELETE FROM annotations WHERE document = ?', (doc_id, ))
+
+
+def _document_identities(directory, names):
+    # The identities (modification times and sizes of the text and
+    # annotation files) of the documents in the directory, by name, of the
+    # given ones only if names is not None
+    files_by_name = {}
+    if names is None:
+        for file_name in listdir(directory):
+            name, _, suffix = file_name.rpartition('.')
+            if suffix in INDEXED_FILE_SUFFIXES:
+                files_by_name.setdefault(name, []).append(file_name)
+    else:
+        for name in names:
+            files_by_name[name] = [name + '.' + suffix
+                    for suffix in INDEXED_FILE_SUFFIXES]
+    identities = {}
+    for name, file_names in files_by_name.iteritems():
+        identity = _files_identity(directory, file_names)
+        if identity is not None:
+            identities[name] = identity
+    return identities
+
+
+def _files_identity(directory, file_names):
+    # The identity of the document with the given files, None for files
+    # that do not make up a document (lacking a text)
+    identity = []
+    for file_name in sorted(file_names):
+        try:
+            st = stat(path_join(directory, file_name))
+        except OSError:
+            if file_name.endswith('.' + TEXT_FILE_SUFFIX):
+                return None
+            # Gone already, or never there
+            continue
+        identity.append((file_name, st.st_mtime, st.st_size))
+    return repr(identity)
+
+
+def _read_annotations(directory, name):
+    path = path_join(directory, name)
+    try:
+        return TextAnnotations(path, read_only=True)
+    except (AnnotationFileNotFoundError, AnnotationNotFoundError,
+            IOError, UnicodeDecodeError), e:
+        # Can not be searched, do not try again until it changes
+        log_info('Could not index %s: %s' % (path, e))
+        return None
+
+
+def _open_index(directory):
+    # Returns a connection to the up to date index for the given directory,
+    # None if not available
+    conn = _connect(directory)
+    if conn is None:
+        return None
+    try:
+        refresh_documents(conn, ANN_INDEX_DIR_NAME, directory,
+                _document_identities, _read_annotations, _store_annotations,
+                _delete_annotations)
+    except (OSError, sqlite.Error), e:
+        log_info('Could not update annotation index for %s: %s' % (
+            directory, e))
+        conn.close()
+        return None
+    return conn
+
+
+class _Query(object):
+    '''
+    Conditions on the annotations of a document, built up along with the
+    arguments they take. Text conditions are given as compiled regular
+    expressions that the texts have to match (search()) to meet them,
+    kept in a list that may be shared with other queries making up the
+    same statement.
+    '''
+
+    def __init__(self, regexes=None):
+        self.conditions = []
+        self.args = []
+        self.regexes = regexes if regexes is not None else []
+
+    def add(self, condition, *args):
+        self.conditions.append(condition)
+        self.args.extend(args)
+
+    def add_types(self, column, restrict_types, ignore_types):
+        if restrict_types:
+            self.add('%s IN (%s)' % (column,
+                ', '.join('?' for _ in restrict_types)), *restrict_types)
+        if ignore_types:
+            self.add('%s NOT IN (%s)' % (column,
+                ', '.join('?' for _ in ignore_types)), *ignore_types)
+
+    def add_text(self, column, regex):
+        if regex is not None:
+            self.add('text_matches(?, %s)' % column, len(self.regexes))
+            self.regexes.append(regex)
+
+    def where(self):
+        return ' AND '.join(self.conditions) or '1'
+
+    def _text_matches(self, i, text):
+        # Texts we do not have (e.g. of events as arguments) are left for
+        # the search to decide on
+        return text is None or self.regexes[i].search(text) is not None
+
+    def documents(self, directory, select):
+        '''
+        Return the names of the documents in the given directory selected
+        by the given statement (with "%s" for the conditions), or None if
+        the index is not available.
+        '''
+        conn = _open_index(directory)
+        if conn is None:
+            return None
+        try:
+            conn.create_function('text_matches', 2, self._text_matches)
+            return set(name for name, in conn.execute('SELECT name FROM '
+                'documents WHERE id IN (' + (select % self.where()) + ')',
+                self.args))
+        except sqlite.Error, e:
+            log_info('Could not look up annotations in %s: %s' % (
+                directory, e))
+            return None
+        finally:
+            conn.close()
+
+
+def _argument_condition(query, ann_column, position=None, role=None,
+        type=None, regex=None):
+    # Require an argument of the annotation with the given position, role,
+    # type and text
+    arg_query = _Query(query.regexes)
+    arg_query.add('g.annotation = %s' % ann_column)
+    if position is not None:
+        arg_query.add('g.position = ?', position)
+    if role is not None:
+        arg_query.add('g.role = ?', role)
+    if type is not None:
+        arg_query.add('a.type = ?', type)
+    arg_query.add_text('a.text', regex)
+    query.add('EXISTS (SELECT 1 FROM arguments g JOIN annotations a '
+            'ON a.document = %s.document AND a.ann_id = g.target WHERE %s)' % (
+                ann_column.split('.')[0], arg_query.where()), *arg_query.args)
+
+
+def find_textbounds(directory, regex=None, restrict_types=None,
+        ignore_types=None, entities_only=False):
+    '''
+    Return the names of the documents in the given directory with entities
+    (or, if entities_only is True, any textbounds, triggers included; the
+    naming follows search_anns_for_textbound) of the given types whose
+    text matches the given regular expression, or None if the index is not
+    available.
+    '''
+    query = _Query()
+    if entities_only:
+        query.add("kind IN ('entity', 'trigger')")
+    else:
+        query.add("kind = 'entity'")
+    query.add_types('type', restrict_types, ignore_types)
+    query.add_text('text', regex)
+    return query.documents(directory,
+            'SELECT document FROM annotations WHERE %s')
+
+
+def find_notes(directory, regex=None, restrict_types=None,
+        ignore_types=None):
+    '''
+    Return the names of the documents in the given directory with notes
+    whose text matches the given regular expression on annotations of the
+    given types, or None if the index is not available.
+    '''
+    query = _Query()
+    query.add("n.kind = 'note'")
+    query.add("n.type != 'STATUS'")
+    query.add_text('n.text', regex)
+    target_query = _Query()
+    target_query.add_types('a.type', restrict_types, ignore_types)
+    # Notes on annotations that are not there are left for the search
+    query.add('(a.id IS NULL OR %s)' % target_query.where(),
+            *target_query.args)
+    return query.documents(directory,
+            'SELECT n.document FROM annotations n LEFT JOIN annotations a '
+            'ON a.document = n.document AND a.ann_id = n.target WHERE %s')
+
+
+def find_relations(directory, arg1_regex=None, arg1type=None,
+        arg2_regex=None, arg2type=None, restrict_types=None,
+        ignore_types=None):
+    '''
+    Return the names of the documents in the given directory with
+    relations (or equivs) of the given types whose arguments are of the
+    given types and have texts matching the given regular expressions, or
+    None if the index is not available.
+    '''
+    query = _Query()
+    relation_query, equiv_query = _Query(query.regexes), _Query(query.regexes)
+    for kind_query, kind in ((relation_query, 'relation'),
+            (equiv_query, 'equiv')):
+        kind_query.add('r.kind = ?', kind)
+        kind_query.add_types('r.type', restrict_types, ignore_types)
+    for position, type, regex in ((0, arg1type, arg1_regex),
+            (1, arg2type, arg2_regex)):
+        if type is None and regex is None:
+            continue
+        _argument_condition(relation_query, 'r.id', position=position,
+                type=type, regex=regex)
+        # Equivs are symmetric, any of their entities will do
+        _argument_condition(equiv_query, 'r.id', type=type, regex=regex)
+
+    query.add('(%s) OR (%s)' % (relation_query.where(), equiv_query.where()),
+            *(relation_query.args + equiv_query.args))
+    return query.documents(directory,
+            'SELECT r.document FROM annotations r WHERE %s')
+
+
+def find_events(directory, trigger_regex=None, args=(), restrict_types=None,
+        ignore_types=None):
+    '''
+    Return the names of the documents in the given directory with events
+    of the given types whose trigger text matches the given regular
+    expression and that have arguments meeting each of the given (role,
+    type, regular expression for the text) constraints, None meaning no
+    constraint, or None if the index is not available.
+    '''
+    query = _Query()
+    query.add("e.kind = 'event'")
+    query.add_types('e.type', restrict_types, ignore_types)
+    query.add_text('e.text', trigger_regex)
+    for role, type, regex in args:
+        _argument_condition(query, 'e.id', role=role, type=type, regex=regex)
+    return query.documents(directory,
+            'SELECT e.document FROM annotations e WHERE %s')
+
+
+def invalidate_document(document):
+    '''
+    Mark the given document (path without suffix) as changed, for its
+    annotations to be indexed again before the next lookup in its
+    collection. To be called once its annotations are written, never
+    waits for the index.
+    '''
+    mark_changed(ANN_INDEX_DIR_NAME, dirname(document), basename(document))
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import remove, utime
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    import workdir
+    from annotation import TextBoundAnnotationWithText
+    # The searches going through every document are what the lookups are
+    # compared with
+    import search
+    from search import _index_match_regex as match_regex
+
+    DOCUMENTS = {
+            'a': ('BRCA1 expression in breast cancer cells.\n',
+                'T1\tProtein 0 5\tBRCA1\n'
+                'T2\tGene_expression 6 16\texpression\n'
+                'E1\tGene_expression:T2 Theme:T1\n'
+                'T3\tDisease 20 33\tbreast cancer\n'
+                'R1\tAssoc Arg1:T1 Arg2:T3\n'
+                '#1\tAnnotatorNotes T3\tknown disease\n'),
+            'b': ('p53 binds BRCA1 and MDM2.\n',
+                'T1\tProtein 0 3\tp53\n'
+                'T2\tBinding 4 9\tbinds\n'
+                'T3\tProtein 10 15\tBRCA1\n'
+                'T4\tProtein 20 24\tMDM2\n'
+                'E1\tBinding:T2 Theme:T1 Theme2:T3\n'
+                '*\tEquiv T3 T4\n'
+                '#1\tAnnotatorNotes E1\tbinding note\n'),
+            'c': ('Nothing here.\n', None),
+            }
+    TYPES = ([], ['Protein'], ['Disease'], ['Binding'], ['Assoc'],
+            ['Equiv'])
+
+    class TestAnnotationIndex(TestCase):
+        def setUp(self):
+            self._work_dir = workdir.WORK_DIR
+            self._tmp_work_dir = workdir.WORK_DIR = mkdtemp()
+            self._dir = mkdtemp()
+            for name, (text, anns) in DOCUMENTS.iteritems():
+                self._write(name + '.' + TEXT_FILE_SUFFIX, text)
+                if anns is not None:
+                    self._write(name + '.' + JOINED_ANN_FILE_SUFF, anns)
+
+        def tearDown(self):
+            workdir.WORK_DIR = self._work_dir
+            rmtree(self._tmp_work_dir)
+            rmtree(self._dir)
+
+        def _write(self, file_name, data, mtime=None):
+            path = path_join(self._dir, file_name)
+            with open(path, 'w') as f:
+                f.write(data)
+            if mtime is not None:
+                utime(path, (mtime, mtime))
+
+        def _scan(self, search_function, *args, **kwargs):
+            found = set()
+            for name in DOCUMENTS:
+                ann_obj = TextAnnotations(path_join(self._dir, name),
+                        read_only=True)
+                if len(search_function([ann_obj], *args, max_results=-1,
+                        **kwargs)):
+                    found.add(name)
+            return found
+
+        def test_textbounds(self):
+            for text in ('BRCA1', 'brca', 'cancer', 'binds', 'nothing'):
+                for text_match in ('word', 'prefix', 'substring'):
+                    for types in TYPES:
+                        for entities_only in (False, True):
+                            self.assertEqual(find_textbounds(self._dir,
+                                match_regex(text, text_match),
+                                restrict_types=types,
+                                entities_only=entities_only),
+                                self._scan(search.search_anns_for_textbound,
+                                    text, restrict_types=types,
+                                    text_match=text_match,
+                                    entities_only=entities_only))
+
+        def test_notes(self):
+            for text in ('known', 'binding', 'note'):
+                for types in TYPES:
+                    self.assertEqual(find_notes(self._dir, match_regex(text),
+                        restrict_types=types),
+                        self._scan(search.search_anns_for_note, text, None,
+                            restrict_types=types))
+
+        def test_relations(self):
+            for arg1, arg1type, arg2, arg2type in ((None, None, None, None),
+                    ('BRCA1', None, None, None),
+                    (None, 'Protein', 'cancer', None),
+                    ('MDM2', None, None, None),
+                    ('BRCA1', 'Protein', 'MDM2', 'Protein'),
+                    (None, None, 'p53', None)):
+                for types in TYPES:
+                    self.assertEqual(find_relations(self._dir,
+                        match_regex(arg1), arg1type, match_regex(arg2),
+                        arg2type, restrict_types=types),
+                        self._scan(search.search_anns_for_relation, arg1,
+                            arg1type, arg2, arg2type, restrict_types=types))
+
+        def test_events(self):
+            for trigger, args in (('', []), ('binds', []),
+                    ('', [('Theme', 'Protein', 'BRCA1')]),
+                    ('', [('Theme2', None, None)]),
+                    ('expression', [('Theme', None, 'p53')])):
+                for types in TYPES:
+                    self.assertEqual(find_events(self._dir,
+                        match_regex(trigger), [(role, type,
+                            match_regex(text)) for role, type, text in args],
+                        restrict_types=types),
+                        self._scan(search.search_anns_for_event, trigger,
+                            [{'role': role, 'type': type, 'text': text}
+                                for role, type, text in args],
+                            restrict_types=types))
+
+        def test_refresh(self):
+            # Reading c creates its missing annotation file, changing the
+            # directory while it is first indexed
+            for _ in range(2):
+                self.assertEqual(find_textbounds(self._dir,
+                    match_regex('p53')), set(['b']))
+            self._write('a.' + JOINED_ANN_FILE_SUFF,
+                    'T1\tDisease 0 5\tBRCA1\n', 1000)
+            self._write('b.' + JOINED_ANN_FILE_SUFF, '')
+            # Changed in place, not seen until invalidated
+            self.assertEqual(find_textbounds(self._dir, match_regex('p53')),
+                    set(['b']))
+            invalidate_document(path_join(self._dir, 'a'))
+            invalidate_document(path_join(self._dir, 'b'))
+            self.assertEqual(find_textbounds(self._dir, match_regex('p53')),
+                    set())
+            self.assertEqual(find_textbounds(self._dir, match_regex('BRCA1'),
+                restrict_types=['Disease']), set(['a']))
+
+        def test_written(self):
+            self.assertEqual(find_textbounds(self._dir,
+                match_regex('cancer'), restrict_types=['Protein']), set())
+            with TextAnnotations(path_join(self._dir, 'a')) as ann_obj:
+                ann_obj.add_annotation(TextBoundAnnotationWithText(
+                    [(27, 33)], 'T4', 'Protein', 'cancer'))
+            self.assertEqual(find_textbounds(self._dir,
+                match_regex('cancer'), restrict_types=['Protein']),
+                set(['a']))
+
+        def test_added_and_removed(self):
+            self.assertEqual(find_textbounds(self._dir, match_regex('p53')),
+                    set(['b']))
+            self._write('d.' + TEXT_FILE_SUFFIX, 'p53.\n')
+            self._write('d.' + JOINED_ANN_FILE_SUFF, 'T1\tProtein 0 3\tp53\n')
+            remove(path_join(self._dir, 'b.' + TEXT_FILE_SUFFIX))
+            self.assertEqual(find_textbounds(self._dir, match_regex('p53')),
+                    set(['d']))
+
+        def test_unavailable(self):
+            workdir.WORK_DIR = None
+            self.assertEqual(find_textbounds(self._dir, match_regex('p53')),
+                    None)
+
+    unittest.main()
@@ -13,20 +13,39 @@ Version:    2011-01-25
 
 # TODO: Major re-work, cleaning up and conforming with new server paradigm
 
+from array import array
+from bisect import bisect_left, bisect_right
+from cPickle import HIGHEST_PROTOCOL
+from cPickle import dumps as pickle_dumps
+from cPickle import load as pickle_load
 from logging import info as log_info
 from codecs import open as codecs_open
 from functools import partial
+from hashlib import sha1
 from itertools import chain, takewhile
-from os import close as os_close, utime
+from os import close as os_close, utime, stat, rename
 from time import time
 from os.path import join as path_join
-from os.path import basename, splitext
+from os.path import abspath, basename, dirname, getsize, splitext
 from re import match as re_match
 from re import compile as re_compile
 
 from common import ProtocolError
 from filelock import file_lock
+from mappedtext import MappedText
 from message import Messager
+from workdir import WORK_DIR, write_cache_file
+
+try:
+    from config import MAPPED_TEXT_MIN_SIZE
+except ImportError:
+    # Only long texts gain anything from not being read in full
+    MAPPED_TEXT_MIN_SIZE = 1024 * 1024
+
+try:
+    from config import PARSE_CACHE_SIZE
+except ImportError:
+    PARSE_CACHE_SIZE = 4096
 
 
 ### Constants
@@ -39,8 +58,30 @@ KNOWN_FILE_SUFF = [JOINED_ANN_FILE_SUFF]+PARTIAL_ANN_FILE_SUFF
 TEXT_FILE_SUFFIX = 'txt'
 # String used to catenate texts of discontinuous annotations in reference text
 DISCONT_SEP = ' '
+# Sub-directory of the work directory holding the cached parses
+PARSE_CACHE_DIR_NAME = 'parse_cache'
+# Text-bound spans longer than this are kept apart from the others in the
+# span index of TextAnnotations, so that a few long spans (e.g. covering a
+# whole section) do not slow down every lookup
+SPAN_INDEX_LONG_SPAN = 1024
+# Bump this whenever the annotation classes change in a way that makes
+# previously pickled parses invalid
+PARSE_CACHE_VERSION = 2
+# Kinds of changes recorded by Annotations
+ANN_ADDED, ANN_CHANGED, ANN_DELETED = 'added', 'changed', 'deleted'
 ###
 
+# If True, files written on exit are parsed in full before replacing the
+# original annotation file, in addition to the verification of the lines
+# that were added or changed that always takes place. Slow for large
+# documents, for debugging only.
+REPARSE_WRITTEN_ANNOTATIONS = False
+
+# If True, annotation files that parse cleanly are cached in pickled
+# form under WORK_DIR, keyed by the identity (path, mtime, size, inode)
+# of every file the parse depends on, and later loads skip parsing.
+USE_PARSE_CACHE = True
+
 # If True, use BioNLP Shared Task 2013 compatibilty mode, allowing
 # normalization annotations to be parsed using the BioNLP Shared Task
 # 2013 format in addition to the brat format and allowing relations to
@@ -235,6 +276,15 @@ def annotation_id_prefix(id):
 def annotation_id_number(id):
     return __split_annotation_id(id)[1]
 
+def annotation_id_suffix(id):
+    return __split_annotation_id(id)[2]
+
+# Type and role names are shared by the annotations of all documents, so
+# keep only one copy of each around
+_interned_strs = {}
+def _intern_str(s):
+    return _interned_strs.setdefault(s, s)
+
 def is_valid_id(id):
     # special case: '*' is acceptable as an "ID"
     if id == '*':
@@ -249,6 +299,63 @@ def is_valid_id(id):
         return False
 
 
+def _select_input_files(document):
+    """
+    Given a document name (path), returns a list of the names of
+    specific annotation files relevant do the document, or the
+    empty list if none found, along with whether the files should be
+    treated as read-only. For example, given "1000", may return
+    (["1000.a1", "1000.a2"], True).
+    """
+
+    from os.path import isfile
+    from os import access, W_OK
+
+    read_only = False
+
+    try:
+        # Do we have a valid suffix? If so, it is probably best to the file
+        suff = document[document.rindex('.') + 1:]
+        if suff == JOINED_ANN_FILE_SUFF:
+            # It is a joined file, let's load it
+            input_files = [document]
+            # Do we lack write permissions?
+            if not access(document, W_OK):
+                #TODO: Should raise an exception or warning
+                read_only = True
+        elif suff in PARTIAL_ANN_FILE_SUFF:
+            # It is only a partial annotation, we will most likely fail
+            # but we will try opening it
+            input_files = [document]
+            read_only = True
+        else:
+            input_files = []
+    except ValueError:
+        # The document lacked a suffix
+        input_files = []
+
+    if not input_files:
+        # Our first attempts at finding the input by checking suffixes
+        # failed, so we try to attach know suffixes to the path.
+        sugg_path = document + '.' + JOINED_ANN_FILE_SUFF
+        if isfile(sugg_path):
+            # We found a joined file by adding the joined suffix
+            input_files = [sugg_path]
+            # Do we lack write permissions?
+            if not access(sugg_path, W_OK):
+                #TODO: Should raise an exception or warning
+                read_only = True
+        else:
+            # Our last shot, we go for as many partial files as possible
+            input_files = [sugg_path for sugg_path in 
+                    (document + '.' + suff
+                        for suff in PARTIAL_ANN_FILE_SUFF)
+                    if isfile(sugg_path)]
+            read_only = True
+
+    return input_files, read_only
+
+
 class Annotations(object):
     """
     Basic annotation storage. Not concerned with conformity of
@@ -263,74 +370,20 @@ class Annotations(object):
         """
         Given a document name (path), returns a list of the names of
         specific annotation files relevant do the document, or the
-        empty list if none found. For example, given "1000", may
-        return ["1000.a1", "1000.a2"]. May set self._read_only flag to
-        True.
+        empty list if none found. May set self._read_only flag to True.
         """
-
-        from os.path import isfile
-        from os import access, W_OK
-
-        try:
-            # Do we have a valid suffix? If so, it is probably best to the file
-            suff = document[document.rindex('.') + 1:]
-            if suff == JOINED_ANN_FILE_SUFF:
-                # It is a joined file, let's load it
-                input_files = [document]
-                # Do we lack write permissions?
-                if not access(document, W_OK):
-                    #TODO: Should raise an exception or warning
-                    self._read_only = True
-            elif suff in PARTIAL_ANN_FILE_SUFF:
-                # It is only a partial annotation, we will most likely fail
-                # but we will try opening it
-                input_files = [document]
-                self._read_only = True
-            else:
-                input_files = []
-        except ValueError:
-            # The document lacked a suffix
-            input_files = []
-
-        if not input_files:
-            # Our first attempts at finding the input by checking suffixes
-            # failed, so we try to attach know suffixes to the path.
-            sugg_path = document + '.' + JOINED_ANN_FILE_SUFF
-            if isfile(sugg_path):
-                # We found a joined file by adding the joined suffix
-                input_files = [sugg_path]
-                # Do we lack write permissions?
-                if not access(sugg_path, W_OK):
-                    #TODO: Should raise an exception or warning
-                    self._read_only = True
-            else:
-                # Our last shot, we go for as many partial files as possible
-                input_files = [sugg_path for sugg_path in 
-                        (document + '.' + suff
-                            for suff in PARTIAL_ANN_FILE_SUFF)
-                        if isfile(sugg_path)]
-                self._read_only = True
-
+        input_files, read_only = _select_input_files(document)
+        if read_only:
+            self._read_only = True
         return input_files
             
     #TODO: DOC!
-    def __init__(self, document, read_only=False):
-        # this decides which parsing function is invoked by annotation
-        # ID prefix (first letter)
-        self._parse_function_by_id_prefix = {
-            'T': self._parse_textbound_annotation,
-            'M': self._parse_modifier_annotation,
-            'A': self._parse_attribute_annotation,
-            'N': self._parse_normalization_annotation,
-            'R': self._parse_relation_annotation,
-            '*': self._parse_equiv_annotation,
-            'E': self._parse_event_annotation,
-            '#': self._parse_comment_annotation,
-            }
+    def __init__(self, document, read_only=False, use_cache=True,
+            verify_changes=False):
+        self._init_parse_functions()
 
         #TODO: DOC!
         #TODO: Incorparate file locking! Is the destructor called upon inter crash?
-        from collections import defaultdict
         from os.path import basename, getmtime, getctime
         #from fileinput import FileInput, hook_encoded
 
@@ -339,6 +392,8 @@ class Annotations(object):
 
         self.failed_lines = []
         self.externally_referenced_triggers = set()
+        # Number of problems reported (but not raised) by _sanity()
+        self._sanity_errors = 0
 
         ### Here be dragons, these objects need constant updating and syncing
         # Annotation for each line of the file
@@ -346,11 +401,32 @@ class Annotations(object):
         # Mapping between annotation objects and which line they occur on
         # Range: [0, inf.) unlike [1, inf.) which is common for files
         self._line_by_ann = {}
-        # Maximum id number used for each id prefix, to speed up id generation
-        #XXX: This is effectively broken by the introduction of id suffixes
-        self._max_id_num_by_prefix = defaultdict(lambda : 1)
+        # Lowest id number that may be free for each (prefix, suffix) pair,
+        # every lower number is known to be in use
+        self._next_id_num_by_prefix_suffix = {}
+        # Ids handed out by reserve_new_ids() but not yet added
+        self._reserved_ids = set()
         # Annotation by id, not includid non-ided annotations 
         self._ann_by_id = {}
+        # Annotations referencing an id (soft or hard), by referenced id
+        self._dependants_by_id = {}
+        # The ids each annotation was registered as referencing above
+        self._deps_by_ann = {}
+        # The annotation file contents as last read or written, and the
+        # identity of the file at that time, to find out what to write
+        self._source_str = None
+        self._source_stat = None
+        # Whether the annotations differ from the files, and the changes
+        # made since they were read: annotation -> (change, string before)
+        # in the order the annotations were first changed
+        self._modified = False
+        self._change_by_ann = {}
+        self._changed_anns = []
+        # Changes are only recorded once reading is done
+        self._track_changes = False
+        # If verifying changes, a hash of each annotation as read, to find
+        # those changed in place without change_annotation()
+        self._hash_by_ann = None
         ###
 
         ## We use some heuristics to find the appropriate annotation files
@@ -369,12 +445,30 @@ class Annotations(object):
         #self._file_input = FileInput(openhook=hook_encoded('utf-8'))
         self._input_files = input_files
 
-        # Finally, parse the given annotation file
+        if not self._read_only:
+            self._source_stat = self._file_identity(self._input_files[0])
+
+        # Finally, parse the given annotation file, unless we have a
+        # cached parse for the very same files
+        use_cache = use_cache and USE_PARSE_CACHE and WORK_DIR is not None
         try:
-            self._parse_ann_file()
-        
-            # Sanity checking that can only be done post-parse
-            self._sanity()
+            if use_cache:
+                # NOTE: Stat before parsing, a file that changes while we
+                #       parse then simply ends up with a stale cache entry
+                cache_key = self._parse_cache_key()
+            if not (use_cache and self._load_parse_cache(cache_key)):
+                self._parse_ann_file()
+            
+                # Sanity checking that can only be done post-parse
+                self._sanity()
+
+                if use_cache or not self._read_only:
+                    # Parsing may "fix" things in the files (missing text,
+                    # equivs to merge), these have to be written out
+                    self._modified = unicode(self) != self._source_str
+
+                if use_cache:
+                    self._store_parse_cache(cache_key)
         except UnicodeDecodeError:
             Messager.error('Encoding error reading annotation file: '
                     'nonstandard encoding or binary?', -1)
@@ -391,17 +485,35 @@ class Annotations(object):
             self.ann_mtime = -1
             self.ann_ctime = -1
 
+        self._track_changes = True
+        if verify_changes and not self._read_only:
+            self._hash_by_ann = dict((ann, hash(unicode(ann)))
+                    for ann in self._lines)
+
+    def _init_parse_functions(self):
+        # this decides which parsing function is invoked by annotation
+        # ID prefix (first letter)
+        self._parse_function_by_id_prefix = {
+            'T': self._parse_textbound_annotation,
+            'M': self._parse_modifier_annotation,
+            'A': self._parse_attribute_annotation,
+            'N': self._parse_normalization_annotation,
+            'R': self._parse_relation_annotation,
+            '*': self._parse_equiv_annotation,
+            'E': self._parse_event_annotation,
+            '#': self._parse_comment_annotation,
+            }
+
     def _sanity(self):
         # Beware, we ONLY do format checking, leave your semantics hat at home
 
         # Check that referenced IDs are defined
-        for ann in self:
-            for rid in chain(*ann.get_deps()):
-                try:
-                    self.get_ann_by_id(rid)
-                except AnnotationNotFoundError:
+        for rid in self._dependants_by_id.keys():
+            if rid not in self._ann_by_id:
+                for ann in self.get_dependants(rid):
                     # TODO: do more than just send a message for this error?
                     Messager.error('ID '+rid+' not defined, referenced from annotation '+str(ann))
+                    self._sanity_errors += 1
 
         # Check that each event has a trigger
         for e_ann in self.get_events():
@@ -415,23 +527,14 @@ class Annotations(object):
             except AnnotationNotFoundError:
                 raise EventWithoutTriggerError(e_ann)
 
-        # Check that every trigger is only referenced by events
-
-        # Create a map for non-event references
-        referenced_to_referencer = {}
-        for non_e_ann in (a for a in self
-                if not isinstance(a, EventAnnotation)
-                and isinstance(a, IdedAnnotation)):
-            for ref in chain(*non_e_ann.get_deps()):
-                try:
-                    referenced_to_referencer[ref].add(non_e_ann.id)
-                except KeyError:
-                    referenced_to_referencer[ref] = set((non_e_ann.id, ))
-
-        # Ensure that no non-event references a trigger
+        # Check that every trigger is only referenced by events, that is,
+        # that no non-event references a trigger
         for tr_ann in self.get_triggers():
-            if tr_ann.id in referenced_to_referencer:
-                conflict_ann_ids = referenced_to_referencer[tr_ann.id]
+            conflict_ann_ids = set((a.id
+                for a in self._dependants_by_id.get(tr_ann.id, ())
+                if not isinstance(a, EventAnnotation)
+                and isinstance(a, IdedAnnotation)))
+            if conflict_ann_ids:
                 if BIONLP_ST_2013_COMPATIBILITY:
                     # Special-case processing for BioNLP ST 2013: allow
                     # Relations to reference event triggers (#926).
@@ -447,7 +550,61 @@ class Annotations(object):
                 if conflict_ann_ids:
                     referencer = self.get_ann_by_id(list(conflict_ann_ids)[0])
                     raise TriggerReferenceError(tr_ann, referencer)
-        
+
+    def _parse_cache_sources(self):
+        '''
+        Return the paths of all files that the parse result depends on.
+        '''
+        return list(self._input_files)
+
+    def _parse_cache_path(self):
+        doc_hash = sha1(repr((self.__class__.__name__,
+            [abspath(p) for p in self._input_files]))).hexdigest()
+        return path_join(WORK_DIR, PARSE_CACHE_DIR_NAME, doc_hash)
+
+    def _parse_cache_key(self):
+        key = [PARSE_CACHE_VERSION, self.__class__.__name__]
+        for path in self._parse_cache_sources():
+            st = stat(path)
+            key.append((abspath(path), st.st_mtime, st.st_size, st.st_ino))
+        return tuple(key)
+
+    def _load_parse_cache(self, cache_key):
+        '''
+        Populate the annotations from the parse cache. Returns True on
+        success and False if there is no valid cache for the given key,
+        leaving the annotations untouched.
+        '''
+        try:
+            with open(self._parse_cache_path(), 'rb') as cache_file:
+                cached_key, lines, ext_triggers = pickle_load(cache_file)
+        except Exception:
+            # Missing, corrupt or from an incompatible version, re-parse
+            return False
+
+        if cached_key != cache_key:
+            return False
+
+        for ann in lines:
+            self._index_annotation(ann)
+        self.externally_referenced_triggers = ext_triggers
+        return True
+
+    def _store_parse_cache(self, cache_key):
+        # Only cache parses without any problems, anything reported to
+        # the user while parsing has to be reported again on every load
+        if self.failed_lines or self._sanity_errors:
+            return
+
+        # The same goes for parses that "fixed" something in the files,
+        # only cache them if they would serialise back unchanged
+        if self._modified:
+            return
+
+        write_cache_file(self._parse_cache_path(), pickle_dumps((cache_key,
+            self._lines, self.externally_referenced_triggers),
+            HIGHEST_PROTOCOL), PARSE_CACHE_SIZE)
+
     def get_events(self):
         return (a for a in self if isinstance(a, EventAnnotation))
     
@@ -515,6 +672,7 @@ class Annotations(object):
                         for m_ent in merge_cand.entities:
                             if m_ent not in eq_ann.entities: 
                                 eq_ann.entities.append(m_ent)
+                        self.update_deps(eq_ann)
                         # Don't try to delete ann since it never was added
                         if merge_cand != ann:
                             try:
@@ -538,11 +696,24 @@ class Annotations(object):
             # It was not an Equiv, skip along
             pass
 
+        self._index_annotation(ann)
+        self._note_change(ann, ANN_ADDED)
+        # Update the modification time
+        from time import time
+        self.ann_mtime = time()
+
+    def _index_annotation(self, ann):
         # Register the object id
         try:
             self._ann_by_id[ann.id] = ann
-            pre, num = annotation_id_prefix(ann.id), annotation_id_number(ann.id)
-            self._max_id_num_by_prefix[pre] = max(num, self._max_id_num_by_prefix[pre])
+            self._reserved_ids.discard(ann.id)
+            pre, num, suf = (annotation_id_prefix(ann.id),
+                    int(annotation_id_number(ann.id)),
+                    annotation_id_suffix(ann.id))
+            if self._next_id_num_by_prefix_suffix.get((pre, suf), 1) == num:
+                # We just took the lowest free number, find the next one
+                self._next_id_num_by_prefix_suffix[(pre, suf)
+                        ] = self._free_id_num(pre, num, suf)
         except AttributeError:
             # The annotation simply lacked an id which is fine
             pass
@@ -550,9 +721,142 @@ class Annotations(object):
         # Add the annotation as the last line
         self._lines.append(ann)
         self._line_by_ann[ann] = len(self) - 1
-        # Update the modification time
-        from time import time
-        self.ann_mtime = time()
+
+        self._index_deps(ann)
+
+    def _index_deps(self, ann):
+        deps = set(chain(*ann.get_deps()))
+        self._deps_by_ann[ann] = deps
+        for rid in deps:
+            try:
+                self._dependants_by_id[rid].add(ann)
+            except KeyError:
+                self._dependants_by_id[rid] = set((ann, ))
+
+    def _unindex_deps(self, ann):
+        for rid in self._deps_by_ann.pop(ann, ()):
+            dependants = self._dependants_by_id[rid]
+            dependants.discard(ann)
+            if not dependants:
+                del self._dependants_by_id[rid]
+
+    def change_annotation(self, ann):
+        '''
+        Record that an annotation already added to this object is about to
+        be changed in place (its type, value, text, etc.). Must be called
+        before making the change, otherwise it is not written out, unless
+        the object was opened with verify_changes, in which case changes
+        made without it are found (but what the annotation was before is
+        not known). Changes to the references or spans of the annotation
+        also call for update_deps() or update_spans() once made.
+        '''
+        self._note_change(ann, ANN_CHANGED)
+
+    def update_deps(self, ann):
+        '''
+        Re-register the ids referenced by an annotation already added to
+        this object. Must be called after changing the references of an
+        annotation in place (event arguments and triggers, relation
+        arguments, equiv members, attribute targets, etc.), otherwise
+        deletions and sanity checks will not see the change.
+        '''
+        self._unindex_deps(ann)
+        self._index_deps(ann)
+        self._note_change(ann, ANN_CHANGED, after_the_fact=True)
+
+    def _note_change(self, ann, change, after_the_fact=False):
+        '''
+        Record a change (ANN_ADDED, ANN_CHANGED or ANN_DELETED) to an
+        annotation of this object. Called before the annotation is changed
+        unless after_the_fact is True, in which case what it was before is
+        not known. Changes made while reading are not recorded.
+        '''
+        if not self._track_changes:
+            return
+        self._modified = True
+
+        try:
+            prev_change, before = self._change_by_ann[ann]
+        except KeyError:
+            if change == ANN_CHANGED and not after_the_fact:
+                before = unicode(ann)
+            else:
+                before = None
+            self._change_by_ann[ann] = (change, before)
+            self._changed_anns.append(ann)
+            return
+
+        if change == ANN_DELETED and prev_change == ANN_ADDED:
+            # Never made it to the file, as if it never happened
+            del self._change_by_ann[ann]
+            self._changed_anns.remove(ann)
+        elif change == ANN_DELETED:
+            self._change_by_ann[ann] = (ANN_DELETED, before)
+        elif change == ANN_ADDED and prev_change == ANN_DELETED:
+            # Deleted and then put back
+            self._change_by_ann[ann] = (ANN_CHANGED, before)
+
+    def _note_untracked_changes(self):
+        # Record the changes made in place to the annotations as read
+        # without change_annotation(), if verifying changes
+        if self._hash_by_ann is None:
+            return
+        for ann in self._lines:
+            if ann in self._change_by_ann:
+                continue
+            try:
+                ann_hash = self._hash_by_ann[ann]
+            except KeyError:
+                continue
+            if hash(unicode(ann)) != ann_hash:
+                self.update_deps(ann)
+
+    def is_modified(self):
+        '''
+        Return True if the annotations may differ from the annotation
+        files, i.e. if they will be written out when leaving the context.
+        '''
+        if not self._modified:
+            self._note_untracked_changes()
+        return self._modified
+
+    def discard_changes(self):
+        '''
+        Leave the annotation files as they are when leaving the context,
+        regardless of any changes made to the annotations since.
+        '''
+        self._modified = False
+        if self._hash_by_ann is not None:
+            # Not to be found again
+            self._hash_by_ann = dict((ann, hash(unicode(ann)))
+                    for ann in self._lines)
+
+    def get_changes(self):
+        '''
+        Return the annotations added, changed and deleted since the files
+        were read as three lists in the order they were first changed, the
+        changes as (before, after) pairs where before is the serialised
+        annotation prior to the change (None if not known).
+        '''
+        self._note_untracked_changes()
+        added, changed, deleted = [], [], []
+        for ann in self._changed_anns:
+            change, before = self._change_by_ann[ann]
+            if change == ANN_ADDED:
+                added.append(ann)
+            elif change == ANN_CHANGED:
+                changed.append((before, ann))
+            else:
+                deleted.append(ann)
+        return added, changed, deleted
+
+    def get_dependants(self, id):
+        '''
+        Return the annotations referencing the given id, soft or hard
+        dependencies alike, in the order they occur in the file.
+        '''
+        return sorted(self._dependants_by_id.get(id, ()),
+                key=self._line_by_ann.__getitem__)
 
     def del_annotation(self, ann, tracker=None):
         #TODO: Check read only
@@ -577,12 +881,7 @@ class Annotations(object):
             return
 
         # collect annotations dependending on ann
-        ann_deps = []
-
-        for other_ann in self:
-            soft_deps, hard_deps = other_ann.get_deps()
-            if unicode(ann.id) in soft_deps | hard_deps:
-                ann_deps.append(other_ann)
+        ann_deps = self.get_dependants(unicode(ann.id))
               
         # If all depending are AttributeAnnotations or EquivAnnotations,
         # delete all modifiers recursively (without confirmation) and remove
@@ -612,6 +911,7 @@ class Annotations(object):
                         if tracker is not None:
                             before = unicode(d)
                         d.entities.remove(unicode(ann.id))
+                        self.update_deps(d)
                         if tracker is not None:
                             tracker.change(before, d)
                 elif isinstance(d, OnelineCommentAnnotation):
@@ -643,10 +943,18 @@ class Annotations(object):
         # Erase the ann by id shorthand
         try:
             del self._ann_by_id[ann.id]
+            # The id number is free again
+            pre, num, suf = (annotation_id_prefix(ann.id),
+                    int(annotation_id_number(ann.id)),
+                    annotation_id_suffix(ann.id))
+            if self._next_id_num_by_prefix_suffix.get((pre, suf), 1) > num:
+                self._next_id_num_by_prefix_suffix[(pre, suf)] = num
         except AttributeError:
             # So, we did not have id to erase in the first place
             pass
 
+        self._unindex_deps(ann)
+
         ann_line = self._line_by_ann[ann]
         # Erase the main annotation
         del self._lines[ann_line]
@@ -656,6 +964,8 @@ class Annotations(object):
         # to reflect the new self._lines
         for l_num in xrange(ann_line, len(self)):
             self._line_by_ann[self[l_num]] = l_num
+
+        self._note_change(ann, ANN_DELETED)
         # Update the modification time
         from time import time
         self.ann_mtime = time()
@@ -667,14 +977,21 @@ class Annotations(object):
         except KeyError:
             raise AnnotationNotFoundError(id)
 
+    def _free_id_num(self, prefix, num, suffix):
+        # Lowest number from num and up not in use for the prefix and suffix
+        while (prefix + unicode(num) + suffix in self._ann_by_id
+                or prefix + unicode(num) + suffix in self._reserved_ids):
+            num += 1
+        return num
+
     def get_new_id(self, prefix, suffix=None):
         '''
         Return a new valid unique id for this annotation file for the given
-        prefix. No ids are re-used for traceability over time for annotations,
-        but this only holds for the lifetime of the annotation object. If the
-        annotation file is parsed once again into an annotation object the
-        next assigned id will be the maximum seen for a given prefix plus one
-        which could have been deleted during a previous annotation session.
+        prefix (and suffix, if any). The id is the one with the lowest
+        number not currently used by an annotation or reserved using
+        reserve_new_ids(); the numbers in use are tracked per prefix and
+        suffix as annotations are parsed, added and deleted, so this
+        is constant time in the common case.
 
         Warning: get_new_id('T') == get_new_id('T')
         Just calling this method does not reserve the id, you need to
@@ -683,21 +1000,35 @@ class Annotations(object):
 
         Argument(s):
         id_pre - an annotation prefix on the format [A-Za-z]+
+        suffix - an optional id suffix
 
         Returns:
         An id that is guaranteed to be unique for the lifetime of the
         annotation.
         '''
-        #XXX: We have changed this one radically!
-        #XXX: Stupid and linear
         if suffix is None:
             suffix = ''
-        #XXX: Arbitary constant!
-        for suggestion in (prefix + unicode(i) + suffix for i in xrange(1, 2**15)):
-            # This is getting more complicated by the minute, two checks since
-            # the developers no longer know when it is an id or string.
-            if suggestion not in self._ann_by_id:
-                return suggestion
+        num = self._free_id_num(prefix,
+                self._next_id_num_by_prefix_suffix.get((prefix, suffix), 1),
+                suffix)
+        self._next_id_num_by_prefix_suffix[(prefix, suffix)] = num
+        return prefix + unicode(num) + suffix
+
+    def reserve_new_ids(self, prefix, count, suffix=None):
+        '''
+        Return a list of count new unique ids for the given prefix (and
+        suffix, if any), reserving them so that neither get_new_id() nor
+        later calls to this method will return them. Intended for adding
+        many annotations at once, e.g. when tagging or importing.
+        '''
+        if suffix is None:
+            suffix = ''
+        ids = []
+        for _ in xrange(count):
+            new_id = self.get_new_id(prefix, suffix)
+            self._reserved_ids.add(new_id)
+            ids.append(new_id)
+        return ids
 
     # XXX: This syntax is subject to change
     def _parse_attribute_annotation(self, id, data, data_tail, input_file_path):
@@ -845,57 +1176,67 @@ class Annotations(object):
             raise IdedAnnotationLineSyntaxError(_id, self.ann_line, self.ann_line_num+1, input_file_path)
         return OnelineCommentAnnotation(target, _id, _type, data_tail, source_id=input_file_path)
     
+    def _parse_annotation_line(self, input_file_path, check_duplicates=True):
+        '''
+        Parse the current line (self.ann_line) into an annotation object,
+        raising an AnnotationLineSyntaxError if it can not be parsed.
+        '''
+        # ID processing
+        try:
+            id, id_tail = self.ann_line.split('\t', 1)
+        except ValueError:
+            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
+
+        pre = annotation_id_prefix(id)
+
+        if check_duplicates and id in self._ann_by_id and pre != '*':
+            raise DuplicateAnnotationIdError(id,
+                    self.ann_line, self.ann_line_num+1,
+                    input_file_path)
+
+        # if the ID is not valid, need to fail with
+        # AnnotationLineSyntaxError (not
+        # IdedAnnotationLineSyntaxError).
+        if not is_valid_id(id):
+            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
+
+        # Cases for lines
+        try:
+            data_delim = id_tail.index('\t')
+            data, data_tail = (id_tail[:data_delim],
+                    id_tail[data_delim:])
+        except ValueError:
+            data = id_tail
+            # No tail at all, although it should have a \t
+            data_tail = ''
+
+        new_ann = None
+
+        #log_info('Will evaluate prefix: ' + pre)
+
+        assert len(pre) >= 1, "INTERNAL ERROR"
+        pre_first = pre[0]
+
+        try:
+            parse_func = self._parse_function_by_id_prefix[pre_first]
+            new_ann = parse_func(id, data, data_tail, input_file_path)
+        except KeyError:
+            raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
+
+        assert new_ann is not None, "INTERNAL ERROR"
+        return new_ann
+
     def _parse_ann_file(self):
         self.ann_line_num = -1
+        source_lines = []
         for input_file_path in self._input_files:
             with open_textfile(input_file_path) as input_file:
                 #for self.ann_line_num, self.ann_line in enumerate(self._file_input):
                 for self.ann_line in input_file:
                     self.ann_line_num += 1
+                    source_lines.append(self.ann_line)
                     try:
-                        # ID processing
-                        try:
-                            id, id_tail = self.ann_line.split('\t', 1)
-                        except ValueError:
-                            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        pre = annotation_id_prefix(id)
-
-                        if id in self._ann_by_id and pre != '*':
-                            raise DuplicateAnnotationIdError(id,
-                                    self.ann_line, self.ann_line_num+1,
-                                    input_file_path)
-
-                        # if the ID is not valid, need to fail with
-                        # AnnotationLineSyntaxError (not
-                        # IdedAnnotationLineSyntaxError).
-                        if not is_valid_id(id):
-                            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        # Cases for lines
-                        try:
-                            data_delim = id_tail.index('\t')
-                            data, data_tail = (id_tail[:data_delim],
-                                    id_tail[data_delim:])
-                        except ValueError:
-                            data = id_tail
-                            # No tail at all, although it should have a \t
-                            data_tail = ''
-
-                        new_ann = None
-
-                        #log_info('Will evaluate prefix: ' + pre)
-
-                        assert len(pre) >= 1, "INTERNAL ERROR"
-                        pre_first = pre[0]
-
-                        try:
-                            parse_func = self._parse_function_by_id_prefix[pre_first]
-                            new_ann = parse_func(id, data, data_tail, input_file_path)
-                        except KeyError:
-                            raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        assert new_ann is not None, "INTERNAL ERROR"
+                        new_ann = self._parse_annotation_line(input_file_path)
                         self.add_annotation(new_ann, read=True)
                     except IdedAnnotationLineSyntaxError, e:
                         # Could parse an ID but not the whole line; add UnparsedIdedAnnotation
@@ -909,6 +1250,66 @@ class Annotations(object):
                             source_id=e.filepath), read=True)
                         # NOTE: For access we start at line 0, not 1 as in here
                         self.failed_lines.append(e.line_num - 1)
+        self._source_str = u''.join(source_lines)
+
+    def _verify_lines(self, lines, input_file_path):
+        '''
+        Check that the given serialised annotation lines can be read back
+        in, raising an AnnotationLineSyntaxError if not. Used to verify
+        only the lines that were added or changed before writing them.
+        '''
+        for self.ann_line_num, line in enumerate(lines):
+            self.ann_line = line + u'\n'
+            # The ids are already in use, by the very annotations we check
+            self._parse_annotation_line(input_file_path,
+                    check_duplicates=False)
+
+    def _file_identity(self, path):
+        st = stat(path)
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _write_atomically(self, out_str, target):
+        '''
+        Write the given string to a temporary file next to the target and
+        rename it onto the target, so that readers never see a partially
+        written annotation file.
+        '''
+        from tempfile import mkstemp
+        from os import chmod, remove
+        # NOTE: Hidden, so that it is not listed if left behind by a crash
+        try:
+            tmp_fh, tmp_fname = mkstemp(dir=dirname(abspath(target)),
+                    prefix='.', suffix='.' + JOINED_ANN_FILE_SUFF)
+            replace = rename
+        except (IOError, OSError):
+            # We may lack write permissions for the directory, fall back on
+            # overwriting the file in place
+            from shutil import copyfile
+            tmp_fh, tmp_fname = mkstemp(suffix='.' + JOINED_ANN_FILE_SUFF)
+            replace = copyfile
+        os_close(tmp_fh)
+
+        try:
+            with open_textfile(tmp_fname, 'w') as tmp_file:
+                tmp_file.write(out_str)
+            chmod(tmp_fname, stat(target).st_mode)
+
+            if REPARSE_WRITTEN_ANNOTATIONS:
+                try:
+                    with Annotations(tmp_fname, read_only=True,
+                            use_cache=False):
+                        pass
+                except Exception, e:
+                    Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e, -1)
+                    raise
+
+            replace(tmp_fname, target)
+        finally:
+            try:
+                remove(tmp_fname)
+            except OSError:
+                # Already renamed onto the target
+                pass
 
     def __str__(self):
         s = u'\n'.join(unicode(ann).rstrip(u'\r\n') for ann in self)
@@ -938,71 +1339,76 @@ class Annotations(object):
     
     def __exit__(self, type, value, traceback):
         #self._file_input.close()
-        if not self._read_only:
+        # Nothing to do unless something was changed, which is most of the
+        # times we are used
+        if not self._read_only and self.is_modified():
             assert len(self._input_files) == 1, 'more than one valid outfile'
+            target = self._input_files[0]
 
-            # We are hitting the disk a lot more than we should here, what we
-            # should have is a modification flag in the object but we can't
-            # due to how we change the annotations.
-            
+            # Annotations loaded from the parse cache did not read the file,
+            # but only what is still on disk is of any use to us
+            if (self._source_str is None
+                    and self._file_identity(target) == self._source_stat):
+                with open_textfile(target, 'r') as ann_file:
+                    self._source_str = ann_file.read()
+
+            # Changes may cancel each other out, so compare against the file
+            # contents as read
             out_str = unicode(self)
-            with open_textfile(self._input_files[0], 'r') as old_ann_file:
-                old_str = old_ann_file.read()
 
             # Was it changed?
-            if out_str == old_str:
+            if out_str == self._source_str:
                 # Then just return
                 return
 
+            # If annotations were only added, they are the only new lines
+            # and can simply be appended to the file
+            if (self._source_str is not None
+                    and self._source_str[-1:] in (u'', u'\n')
+                    and out_str.startswith(self._source_str)):
+                appended_str = out_str[len(self._source_str):]
+                touched_lines = [l for l in appended_str.split(u'\n') if l]
+            else:
+                appended_str = None
+                source_lines = set((self._source_str or u'').split(u'\n'))
+                touched_lines = [l for l in out_str.split(u'\n')
+                        if l and l not in source_lines]
+
+            # The remaining lines were read from the file, so we only need to
+            # make sure that the new and changed lines can be read back in
+            try:
+                self._verify_lines(touched_lines, target)
+            except AnnotationLineSyntaxError, e:
+                Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e.line, -1)
+                raise
+
             from config import WORK_DIR
             
             # Protect the write so we don't corrupt the file
             with file_lock(path_join(WORK_DIR,
-                    str(hash(self._input_files[0].replace('/', '_')))
+                    str(hash(target.replace('/', '_')))
                         + '.lock')
                     ) as lock_file:
-                #from tempfile import NamedTemporaryFile
-                from tempfile import mkstemp
-                # TODO: XXX: Is copyfile really atomic?
-                from shutil import copyfile
-                # XXX: NamedTemporaryFile only supports encoding for Python 3
-                #       so we hack around it.
-                #with NamedTemporaryFile('w', suffix='.ann') as tmp_file:
-                # Grab the filename, but discard the handle
-                tmp_ann_fh, tmp_ann_fname = mkstemp(suffix='.ann')
-
-                files = [(tmp_ann_fh, tmp_ann_fname, out_str, self._input_files[0])]
-
-                for (tmp_fh, tmp_fname, out_str, target) in files:
-                    os_close(tmp_fh)
-                    try:
-                        with open_textfile(tmp_fname, 'w') as tmp_file:
-                            #XXX: Temporary hack to make sure we don't write corrupted
-                            #       files, but the client will already have the version
-                            #       at this stage leading to potential problems upon
-                            #       the next change to the file.
-                            tmp_file.write(out_str)
-                            tmp_file.flush()
-
-                            try:
-                                with Annotations(tmp_file.name) as ann:
-                                    # Move the temporary file onto the old file
-                                    copyfile(tmp_file.name, target)
-                                    # As a matter of convention we adjust the modified
-                                    # time of the data dir when we write to it. This
-                                    # helps us to make back-ups
-                                    now = time()
-                                    #XXX: Disabled for now!
-                                    #utime(DATA_DIR, (now, now))
-                            except Exception, e:
-                                Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e, -1)
-                                raise
-                    finally:
-                        try:
-                            from os import remove
-                            remove(tmp_fname)
-                        except Exception, e:
-                            Messager.error("Error removing temporary file '%s'" % tmp_fname)
+                # Only append if nobody else wrote the file since we read it
+                if (appended_str is not None and
+                        self._file_identity(target) == self._source_stat):
+                    with open_textfile(target, 'a') as ann_file:
+                        ann_file.write(appended_str)
+                else:
+                    self._write_atomically(out_str, target)
+
+                self._source_str = out_str
+                self._source_stat = self._file_identity(target)
+            self._modified = False
+
+            # Writing a file in place does not change the mtime of its
+            # directory, let the collection manifest and annotation index
+            # know about it
+            import annindex
+            import manifest
+            document = splitext(target)[0]
+            manifest.invalidate_document(document)
+            annindex.invalidate_document(document)
             return
 
     def __in__(self, other):
@@ -1016,7 +1422,8 @@ class TextAnnotations(Annotations):
     access to text text to which the annotations apply and verifying
     the correctness of text-bound annotations against the text.
     """
-    def __init__(self, document, read_only=False):
+    def __init__(self, document, read_only=False, use_cache=True,
+            verify_changes=False):
         # First read the text or the Annotations can't verify the annotations
         if document.endswith('.txt'):
             textfile_path = document
@@ -1028,9 +1435,23 @@ class TextAnnotations(Annotations):
             else:
                 textfile_path = document[:len(document) - len(file_ext)]
 
+        self._text_file_path = textfile_path + '.' + TEXT_FILE_SUFFIX
         self._document_text = self._read_document_text(textfile_path)
+
+        # Index over the (start, end) spans of all text-bound annotations,
+        # as (start, end, id) triples sorted by start when not dirty, with
+        # spans longer than SPAN_INDEX_LONG_SPAN kept in a list of their own
+        self._spans = []
+        self._spans_dirty = False
+        self._long_spans = []
+        self._spans_by_ann = {}
         
-        Annotations.__init__(self, document, read_only)
+        Annotations.__init__(self, document, read_only, use_cache,
+                verify_changes)
+
+    def _parse_cache_sources(self):
+        # Text-bound annotations are verified against the text
+        return Annotations._parse_cache_sources(self) + [self._text_file_path]
 
     def _parse_textbound_annotation(self, id, data, data_tail, input_file_path):
         type, spans = self._split_textbound_data(id, data, input_file_path)
@@ -1102,7 +1523,99 @@ class TextAnnotations(Annotations):
         return TextBoundAnnotationWithText(spans, id, type, text, data_tail, source_id=input_file_path)
 
     def get_document_text(self):
-        return self._document_text
+        # NOTE: Decodes all of a mapped text, use get_document_text_slice()
+        #       and get_document_text_length() when that is not needed
+        return unicode(self._document_text)
+
+    def get_document_text_slice(self, start, end):
+        return self._document_text[start:end]
+
+    def get_document_text_length(self):
+        return len(self._document_text)
+
+    def _index_annotation(self, ann):
+        Annotations._index_annotation(self, ann)
+        if isinstance(ann, TextBoundAnnotation):
+            self._index_spans(ann)
+
+    def _atomic_del_annotation(self, ann):
+        self._unindex_spans(ann)
+        Annotations._atomic_del_annotation(self, ann)
+
+    def _index_spans(self, ann):
+        entries = [(start, end, ann.id) for start, end in ann.spans]
+        self._spans_by_ann[ann] = entries
+        for entry in entries:
+            if entry[1] - entry[0] > SPAN_INDEX_LONG_SPAN:
+                self._long_spans.append(entry)
+            else:
+                # Sorted on the next lookup, adding is the common case
+                self._spans.append(entry)
+                self._spans_dirty = True
+
+    def _unindex_spans(self, ann):
+        for entry in self._spans_by_ann.pop(ann, ()):
+            if entry[1] - entry[0] > SPAN_INDEX_LONG_SPAN:
+                self._long_spans.remove(entry)
+            elif self._spans_dirty:
+                self._spans.remove(entry)
+            else:
+                del self._spans[bisect_left(self._spans, entry)]
+
+    def update_spans(self, ann):
+        '''
+        Re-index the spans of a text-bound annotation already added to
+        this object. Must be called after changing the spans in place.
+        '''
+        self._unindex_spans(ann)
+        self._index_spans(ann)
+        self._note_change(ann, ANN_CHANGED, after_the_fact=True)
+
+    def _spans_near(self, start, end):
+        # All indexed spans (s, e, id) with s <= end and e >= start
+        if self._spans_dirty:
+            self._spans.sort()
+            self._spans_dirty = False
+        # Short spans starting before start - SPAN_INDEX_LONG_SPAN also end
+        # before start, no need to look at them
+        lo = bisect_left(self._spans, (start - SPAN_INDEX_LONG_SPAN, ))
+        hi = bisect_right(self._spans, (end, float('inf')))
+        for entry in self._spans[lo:hi]:
+            if entry[1] >= start:
+                yield entry
+        for entry in self._long_spans:
+            if entry[0] <= end and entry[1] >= start:
+                yield entry
+
+    def _anns_for_spans(self, entries):
+        anns = set(self._ann_by_id[_id] for _, _, _id in entries)
+        return sorted(anns, key=self._line_by_ann.__getitem__)
+
+    def overlapping(self, start, end):
+        '''
+        Return the text-bound annotations with a span overlapping the
+        given (start, end) span, in the order they occur in the file.
+        '''
+        return self._anns_for_spans(e for e in self._spans_near(start, end)
+                if e[0] < end and e[1] > start)
+
+    def containing(self, start, end):
+        '''
+        Return the text-bound annotations with a span containing (or
+        equivalent with) the given (start, end) span, in file order.
+        '''
+        return self._anns_for_spans(e for e in self._spans_near(start, end)
+                if e[0] <= start and e[1] >= end)
+
+    def contained_in(self, start, end):
+        '''
+        Return the text-bound annotations with all spans inside (or
+        equivalent with) the given (start, end) span, in file order.
+        '''
+        return [a for a in self._anns_for_spans(
+                    e for e in self._spans_near(start, end)
+                    if e[0] >= start and e[1] <= end)
+                if all(s >= start and e <= end for s, e in a.spans)]
 
     def _read_document_text(self, document):
         # TODO: this is too naive; document may be e.g. "PMID.a1",
@@ -1110,16 +1623,62 @@ class TextAnnotations(Annotations):
         # "PMID.txt", not "PMID.a1.txt"
         textfn = document + '.' + TEXT_FILE_SUFFIX
         try:
+            # Long texts are mapped rather than read, they are mostly
+            # needed for the text of a few spans (can not map empty files)
+            if (MAPPED_TEXT_MIN_SIZE is not None
+                    and getsize(textfn) >= max(MAPPED_TEXT_MIN_SIZE, 1)):
+                return MappedText(textfn)
             with open_textfile(textfn, 'r') as f:
                 return f.read()
-        except IOError:
+        except EnvironmentError:
             Messager.error('Error reading document text from %s' % textfn)
         raise AnnotationTextFileNotFoundError(document)
 
+def iter_annotations(document, kinds=None):
+    """
+    Generate the annotations of the given document (path, with or without
+    an annotation file suffix) one line at a time, in file order, without
+    building an Annotations object. If kinds is given, only lines whose ID
+    prefix starts with one of the given characters (e.g. 'T', 'E', '*')
+    are parsed at all.
+
+    Unlike Annotations, no references are resolved, no sanity checks are
+    made, equivs are not merged and text-bound annotations are not
+    checked against the document text. Lines that fail to parse are
+    generated as UnparsedIdedAnnotation or UnknownAnnotation objects. A
+    document without annotation files simply has no annotations.
+    """
+    if kinds is not None:
+        kinds = tuple(kinds)
+
+    # Borrow the line parsers, but none of the storage
+    parser = Annotations.__new__(Annotations)
+    parser._init_parse_functions()
+    parser.ann_line_num = -1
+
+    for input_file_path in _select_input_files(document)[0]:
+        with open_textfile(input_file_path) as input_file:
+            for parser.ann_line in input_file:
+                parser.ann_line_num += 1
+                if kinds is not None and not parser.ann_line.startswith(kinds):
+                    continue
+                try:
+                    yield parser._parse_annotation_line(input_file_path,
+                            check_duplicates=False)
+                except IdedAnnotationLineSyntaxError, e:
+                    yield UnparsedIdedAnnotation(e.id, e.line,
+                            source_id=e.filepath)
+                except AnnotationLineSyntaxError, e:
+                    yield UnknownAnnotation(e.line, source_id=e.filepath)
+
 class Annotation(object):
     """
     Base class for all annotations.
     """
+    # Annotations are numerous and long-lived, so avoid a __dict__ per
+    # instance by declaring the attributes of all annotation classes
+    __slots__ = ('tail', 'source_id', )
+
     def __init__(self, tail, source_id=None):
         self.tail = tail
         self.source_id = source_id
@@ -1129,6 +1688,17 @@ class Annotation(object):
 
     def __repr__(self):
         return u'%s("%s")' % (unicode(self.__class__), unicode(self))
+
+    def __getstate__(self):
+        # For copy and pickle: the slots that are set, skipping those that
+        # a subclass replaced with a derived attribute (property)
+        slot_state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if (not isinstance(getattr(type(self), name), property)
+                        and hasattr(self, name)):
+                    slot_state[name] = getattr(self, name)
+        return (getattr(self, '__dict__', None), slot_state)
     
     def get_deps(self):
         return (set(), set())
@@ -1138,6 +1708,8 @@ class UnknownAnnotation(Annotation):
     Represents a line of annotation that could not be parsed.
     These are not discarded, but rather passed through unmodified.
     """
+    __slots__ = ()
+
     def __init__(self, line, source_id=None):
         Annotation.__init__(self, line, source_id=source_id)
 
@@ -1153,6 +1725,8 @@ class UnparsedIdedAnnotation(Annotation):
     """
     # duck-type instead of inheriting from IdedAnnotation as
     # that inherits from TypedAnnotation and we have no type
+    __slots__ = ('id', )
+
     def __init__(self, id, line, source_id=None):
         # (this actually is the whole line, not just the id tail,
         # although Annotation will assign it to self.tail)
@@ -1166,9 +1740,11 @@ class TypedAnnotation(Annotation):
     """
     Base class for all annotations with a type.
     """
+    __slots__ = ('type', )
+
     def __init__(self, type, tail, source_id=None):
         Annotation.__init__(self, tail, source_id=source_id)
-        self.type = type
+        self.type = _intern_str(type)
 
     def __str__(self):
         raise NotImplementedError
@@ -1177,6 +1753,8 @@ class IdedAnnotation(TypedAnnotation):
     """
     Base class for all annotations with an ID.
     """
+    __slots__ = ('id', )
+
     def __init__(self, id, type, tail, source_id=None):
         TypedAnnotation.__init__(self, type, tail, source_id=source_id)
         self.id = id
@@ -1217,10 +1795,13 @@ class EventAnnotation(IdedAnnotation):
 
     ID\tTYPE:TRIGGER [ROLE1:PART1 ROLE2:PART2 ...]
     """
+    __slots__ = ('trigger', 'args', )
+
     def __init__(self, trigger, args, id, type, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.trigger = trigger
-        self.args = args
+        # A list of our own, the roles interned
+        self.args = [(_intern_str(a[0]), ) + tuple(a[1:]) for a in args]
 
     def add_argument(self, role, argid):
         # split into "main" role label and possible numeric suffix
@@ -1289,6 +1870,8 @@ class EquivAnnotation(TypedAnnotation):
 
     Where "*" is the literal asterisk character.
     """
+    __slots__ = ('entities', )
+
     def __init__(self, type, entities, tail, source_id=None):
         TypedAnnotation.__init__(self, type, tail, source_id=source_id)
         self.entities = entities
@@ -1323,6 +1906,8 @@ class EquivAnnotation(TypedAnnotation):
         return '('+','.join([unicode(e) for e in self.entities])+')'
 
 class AttributeAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'value', )
+
     def __init__(self, target, id, type, tail, value, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.target = target
@@ -1349,10 +1934,12 @@ class AttributeAnnotation(IdedAnnotation):
         return [self.target]
 
 class NormalizationAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'refdb', 'refid', 'reftext', )
+
     def __init__(self, _id, _type, target, refdb, refid, tail, source_id=None):
         IdedAnnotation.__init__(self, _id, _type, tail, source_id=source_id)
         self.target = target
-        self.refdb = refdb
+        self.refdb = _intern_str(refdb)
         self.refid = refid
         # "human-readable" text of referenced ID (optional)
         self.reftext = tail.lstrip('\t').rstrip('\n')
@@ -1378,6 +1965,8 @@ class NormalizationAnnotation(IdedAnnotation):
         return [self.target]
 
 class OnelineCommentAnnotation(IdedAnnotation):
+    __slots__ = ('target', )
+
     def __init__(self, target, id, type, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.target = target
@@ -1420,12 +2009,21 @@ class TextBoundAnnotation(IdedAnnotation):
 
     with multiple START END pairs separated by semicolons.
     """
+    # The spans are stored as a flat array of offsets [START1, END1, ...]
+    __slots__ = ('_offsets', )
 
     def __init__(self, spans, id, type, tail, source_id=None):
         # Note: if present, the text goes into tail
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.spans = spans
 
+    def get_spans(self):
+        o = self._offsets
+        return [(o[i], o[i+1]) for i in xrange(0, len(o), 2)]
+    def set_spans(self, spans):
+        self._offsets = array('l', chain(*spans))
+    spans = property(get_spans, set_spans)
+
     # TODO: temp hack while building support for discontinuous
     # annotations; remove once done
     def get_start(self):
@@ -1442,13 +2040,13 @@ class TextBoundAnnotation(IdedAnnotation):
         """
         Return the first (min) start offset in the annotation spans.
         """
-        return min([start for start, end in self.spans])
+        return min(self._offsets[0::2])
 
     def last_end(self):
         """
         Return the last (max) end offset in the annotation spans.
         """
-        return max([end for start, end in self.spans])
+        return max(self._offsets[1::2])
 
     def get_text(self):
         # If you're seeing this exception, you probably need a
@@ -1509,12 +2107,22 @@ class TextBoundAnnotationWithText(TextBoundAnnotation):
 
     with multiple START END pairs separated by semicolons.
     """
+    __slots__ = ('text', 'text_tail', )
+
     def __init__(self, spans, id, type, text, text_tail="", source_id=None):
-        IdedAnnotation.__init__(self, id, type, '\t'+text+text_tail, source_id=source_id)
+        # NOTE: No call to IdedAnnotation.__init__(), the tail is not
+        #       stored but derived from the text, see get_tail()
+        self.source_id = source_id
+        self.type = _intern_str(type)
+        self.id = id
         self.spans = spans
         self.text = text
         self.text_tail = text_tail
 
+    def get_tail(self):
+        return u'\t' + self.text + self.text_tail
+    tail = property(get_tail)
+
     # TODO: temp hack while building support for discontinuous
     # annotations; remove once done
     def get_start(self):
@@ -1554,11 +2162,13 @@ class BinaryRelationAnnotation(IdedAnnotation):
 
     Where ARG1 and ARG2 are arbitrary (but not identical) labels.
     """
+    __slots__ = ('arg1l', 'arg1', 'arg2l', 'arg2', )
+
     def __init__(self, id, type, arg1l, arg1, arg2l, arg2, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
-        self.arg1l = arg1l
+        self.arg1l = _intern_str(arg1l)
         self.arg1  = arg1
-        self.arg2l = arg2l
+        self.arg2l = _intern_str(arg2l)
         self.arg2  = arg2
 
     def __str__(self):
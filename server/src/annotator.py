@@ -13,13 +13,17 @@ Version:    2011-04-22
 
 from __future__ import with_statement
 
+from contextlib import contextmanager
+from inspect import getargspec
+from itertools import izip
 from os.path import join as path_join
 from os.path import split as path_split
 from re import compile as re_compile
+from threading import local
 
 from annotation import (OnelineCommentAnnotation, TEXT_FILE_SUFFIX,
         TextAnnotations, DependingAnnotationDeleteError, TextBoundAnnotation,
-        EventAnnotation, EquivAnnotation, open_textfile,
+        EventAnnotation, EquivAnnotation,
         AnnotationsIsReadOnlyError, AttributeAnnotation, 
         NormalizationAnnotation, SpanOffsetOverlapError, DISCONT_SEP)
 from common import ProtocolError, ProtocolArgumentError
@@ -30,7 +34,7 @@ except ImportError:
 from document import real_directory
 from jsonwrap import loads as json_loads, dumps as json_dumps
 from message import Messager
-from norm import norm_update_link
+from norm import norm_create_link, norm_update_link
 from projectconfig import ProjectConfiguration, ENTITY_CATEGORY, EVENT_CATEGORY, RELATION_CATEGORY, UNKNOWN_CATEGORY
 
 ### Constants
@@ -58,6 +62,20 @@ class ModificationTracker(object):
     def change(self, before, after):
         self.__changed.append((before, after))
 
+    def record_changes(self, ann_obj):
+        """
+        Track all the changes made to the given Annotations object since
+        its annotations were read, as recorded by the object itself.
+        """
+        added, changed, deleted = ann_obj.get_changes()
+        for ann in added:
+            self.addition(ann)
+        for before, after in changed:
+            # Changes made in place are only known after the fact
+            self.change(before if before is not None else after, after)
+        for ann in deleted:
+            self.deletion(ann)
+
     def json_response(self, response=None):
         if response is None:
             response = {}
@@ -133,11 +151,32 @@ class ModificationTracker(object):
 #         add_messages_to_json(mods_json)
 #         print dumps(mods_json)
 
+# The annotations shared by the operations of the batch_edit in progress (if
+# any) in ann_obj, per thread as the FastCGI server serves requests in
+# threads of the same process
+_batch = local()
+
+@contextmanager
+def _shared_annotations(ann_obj):
+    # Leaves the writing to whoever opened ann_obj
+    yield ann_obj
+
+def _open_annotations(document):
+    # Open the annotations of document for editing, operations that are part
+    # of a batch all edit the annotations opened for the batch
+    batch_ann_obj = getattr(_batch, 'ann_obj', None)
+    if batch_ann_obj is not None and batch_ann_obj.get_document() == document:
+        return _shared_annotations(batch_ann_obj)
+    return TextAnnotations(document, verify_changes=True)
+
 def _json_from_ann(ann_obj):
     # Returns json with ann_obj contents and the relevant text.  Used
     # for saving a round-trip when modifying annotations by attaching
     # the latest annotation data into the response to the edit
     # request.
+    if ann_obj is getattr(_batch, 'ann_obj', None):
+        # Only sent once, after the last operation of the batch
+        return None
     j_dic = {}
     txt_file_path = ann_obj.get_document() + '.' + TEXT_FILE_SUFFIX
     from document import (_enrich_json_with_data, _enrich_json_with_base,
@@ -225,8 +264,10 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
             # TODO: Log modification too?
             before = unicode(tb_ann)
             #log_info('Will alter span of: "%s"' % str(to_edit_span).rstrip('\n'))
+            ann_obj.change_annotation(tb_ann)
             tb_ann.spans = offsets[:]
             tb_ann.text = _text_for_offsets(ann_obj._document_text, tb_ann.spans)
+            ann_obj.update_spans(tb_ann)
             #log_info('Span altered')
             mods.change(before, tb_ann)
 
@@ -242,6 +283,7 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
             pass
         else:
             before = unicode(ann)
+            ann_obj.change_annotation(ann)
             ann.type = type
 
             # Try to propagate the type change
@@ -267,12 +309,13 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                         # Update the old annotation to use this trigger
                         ann.trigger = unicode(new_ann_trig.id)
                         ann_obj.add_annotation(new_ann_trig)
+                        ann_obj.update_deps(ann)
                         mods.addition(new_ann_trig)
                     else:
                         # Okay, we own the current trigger, but does an
                         # identical to our sought one already exist?
                         found = None
-                        for tb_ann in ann_obj.get_textbounds():
+                        for tb_ann in ann_obj.containing(*ann_trig.spans[0]):
                             if (_offsets_equal(tb_ann.spans, ann_trig.spans) and
                                 tb_ann.type == ann.type):
                                 found = tb_ann
@@ -282,12 +325,14 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                             # Just change the trigger type since we are the
                             # only users
                             before = unicode(ann_trig)
+                            ann_obj.change_annotation(ann_trig)
                             ann_trig.type = ann.type
                             mods.change(before, ann_trig)
                         else:
                             # Attach the new trigger THEN delete
                             # or the dep will hit you
                             ann.trigger = unicode(found.id)
+                            ann_obj.update_deps(ann)
                             ann_obj.del_annotation(ann_trig)
                             mods.deletion(ann_trig)
             except AttributeError:
@@ -302,8 +347,8 @@ def __create_span(ann_obj, mods, type, offsets, txt_file_path,
         projectconf, attributes):
     # For event types, reuse trigger if a matching one exists.
     found = None
-    if projectconf.is_event_type(type):
-        for tb_ann in ann_obj.get_textbounds():
+    if projectconf.is_event_type(type) and offsets:
+        for tb_ann in ann_obj.containing(*offsets[0]):
             try:
                 if (_offsets_equal(tb_ann.spans, offsets)
                     and tb_ann.type == type):
@@ -317,9 +362,8 @@ def __create_span(ann_obj, mods, type, offsets, txt_file_path,
         # Get a new ID
         new_id = ann_obj.get_new_id('T') #XXX: Cons
         # Get the text span
-        with open_textfile(txt_file_path, 'r') as txt_file:
-            text = txt_file.read()
-            text_span = _text_for_offsets(text, offsets)
+        text = ann_obj._document_text
+        text_span = _text_for_offsets(text, offsets)
 
         # The below code resolves cases where there are newlines in the
         #   offsets by creating discontinuous annotations for each span
@@ -397,6 +441,7 @@ def _set_attributes(ann_obj, ann, attributes, mods, undo_resp={}):
             #log_info('ATTR: "%s" "%s"' % (new_value, existing_attr_ann.value))
             if existing_attr_ann.value != new_value:
                 before = unicode(existing_attr_ann)
+                ann_obj.change_annotation(existing_attr_ann)
                 existing_attr_ann.value = new_value
                 mods.change(before, existing_attr_ann)
 
@@ -480,6 +525,7 @@ def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp={}):
             new_reftext = new_norms[old_norm_id]
             if old_norm.reftext != new_reftext:
                 old = unicode(old_norm)
+                ann_obj.change_annotation(old_norm)
                 old_norm.reftext = new_reftext
                 mods.change(old, old_norm)
 
@@ -562,6 +608,7 @@ def _set_comments(ann_obj, ann, comment, mods, undo_resp={}):
             # Change the comment
             # XXX: Note the ugly tab, it is for parsing the tail
             before = unicode(found)
+            ann_obj.change_annotation(found)
             found.tail = u'\t' + comment
             mods.change(before, found)
         else:
@@ -619,7 +666,7 @@ def _create_span(collection, document, offsets, _type, attributes=None,
 
     working_directory = path_split(document)[0]
 
-    with TextAnnotations(document) as ann_obj:
+    with _open_annotations(document) as ann_obj:
         # bail as quick as possible if read-only 
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -753,8 +800,10 @@ def _create_relation(ann_obj, projectconf, mods, origin, target, type,
         else:
             # type and/or target changed, mark.
             before = unicode(found)
+            ann_obj.change_annotation(found)
             found.arg2 = target.id
             found.type = type
+            ann_obj.update_deps(found)
             mods.change(before, found)
 
         target_ann = found
@@ -790,7 +839,9 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
         if old_type is None and old_target is None:
             if arg_tup not in origin.args:
                 before = unicode(origin)
+                ann_obj.change_annotation(origin)
                 origin.add_argument(type, unicode(target.id))
+                ann_obj.update_deps(origin)
                 mods.change(before, origin)
             else:
                 # It already existed as an arg, we were called to do nothing...
@@ -802,8 +853,10 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
 
             if old_arg_tup in origin.args and arg_tup not in origin.args:
                 before = unicode(origin)
+                ann_obj.change_annotation(origin)
                 origin.args.remove(old_arg_tup)
                 origin.add_argument(type, unicode(target.id))
+                ann_obj.update_deps(origin)
                 mods.change(before, origin)
             else:
                 # Collision etc. don't do anything
@@ -832,7 +885,7 @@ def reverse_arc(collection, document, origin, target, type, attributes=None):
     #mods = ModificationTracker() # TODO
     projectconf = ProjectConfiguration(real_dir)
     document = path_join(real_dir, document)
-    with TextAnnotations(document) as ann_obj:
+    with _open_annotations(document) as ann_obj:
         # bail as quick as possible if read-only 
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -854,7 +907,9 @@ def reverse_arc(collection, document, origin, target, type, attributes=None):
                 Messager.error('reverse_arc: failed to identify target relation (from %s to %s, type %s) (deleted?)' % (str(origin), str(target), str(type)))
             else:
                 # found it; just adjust this
+                ann_obj.change_annotation(found)
                 found.arg1, found.arg2 = found.arg2, found.arg1
+                ann_obj.update_deps(found)
                 # TODO: modification tracker
 
         json_response = {}
@@ -875,7 +930,7 @@ def create_arc(collection, document, origin, target, type, attributes=None,
 
     document = path_join(real_dir, document)
 
-    with TextAnnotations(document) as ann_obj:
+    with _open_annotations(document) as ann_obj:
         # bail as quick as possible if read-only 
         # TODO: make consistent across the different editing
         # functions, integrate ann_obj initialization and checks
@@ -930,8 +985,10 @@ def _delete_arc_equiv(origin, target, type_, mods, ann_obj):
             unicode(target) in eq_ann.entities and
             type_ == eq_ann.type):
             before = unicode(eq_ann)
+            ann_obj.change_annotation(eq_ann)
             eq_ann.entities.remove(unicode(origin))
             eq_ann.entities.remove(unicode(target))
+            ann_obj.update_deps(eq_ann)
             mods.change(before, eq_ann)
 
         if len(eq_ann.entities) < 2:
@@ -962,7 +1019,9 @@ def _delete_arc_event_arg(origin, target, type_, mods, ann_obj):
     arg_tup = (type_, unicode(target))
     if arg_tup in event_ann.args:
         before = unicode(event_ann)
+        ann_obj.change_annotation(event_ann)
         event_ann.args.remove(arg_tup)
+        ann_obj.update_deps(event_ann)
         mods.change(before, event_ann)
     else:
         # What we were to remove did not even exist in the first place
@@ -995,7 +1054,7 @@ def delete_arc(collection, document, origin, target, type):
 
     document = path_join(real_dir, document)
 
-    with TextAnnotations(document) as ann_obj:
+    with _open_annotations(document) as ann_obj:
         # bail as quick as possible if read-only 
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -1016,7 +1075,7 @@ def delete_span(collection, document, id):
 
     document = path_join(real_dir, document)
     
-    with TextAnnotations(document) as ann_obj:
+    with _open_annotations(document) as ann_obj:
         # bail as quick as possible if read-only 
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -1069,7 +1128,7 @@ def split_span(collection, document, args, id):
     # TODO don't know how to pass an array directly, so doing extra catenate and split
     tosplit_args = json_loads(args)
     
-    with TextAnnotations(document) as ann_obj:
+    with _open_annotations(document) as ann_obj:
         # bail as quick as possible if read-only 
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -1121,7 +1180,9 @@ def split_span(collection, document, args, id):
         for i, arg_combo in enumerate(argument_combos):
             # tweak args
             if i == 0:
+                ann_obj.change_annotation(ann)
                 ann.args = nonsplit_args[:] + arg_combo
+                ann_obj.update_deps(ann)
             else:
                 newann = deepcopy(ann)
                 newann.id = ann_obj.get_new_id("E") # TODO: avoid hard-coding ID prefix
@@ -1132,58 +1193,173 @@ def split_span(collection, document, args, id):
 
         # then, go through all the annotations referencing the original
         # event, and create appropriate copies
-        for a in ann_obj:
-            soft_deps, hard_deps = a.get_deps()
-            refs = soft_deps | hard_deps
-            if ann.id in refs:
-                # Referenced; make duplicates appropriately
-
-                if isinstance(a, EventAnnotation):
-                    # go through args and make copies for referencing
-                    new_args = []
-                    for arg, aid in a.args:
-                        if aid == ann.id:
-                            for newe in new_events:
-                                new_args.append((arg, newe.id))
-                    a.args.extend(new_args)
-
-                elif isinstance(a, AttributeAnnotation):
-                    for newe in new_events:
-                        newmod = deepcopy(a)
-                        newmod.target = newe.id
-                        newmod.id = ann_obj.get_new_id("A") # TODO: avoid hard-coding ID prefix
-                        ann_obj.add_annotation(newmod)
-                        mods.addition(newmod)
-
-                elif isinstance(a, BinaryRelationAnnotation):
-                    # TODO
-                    raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
-
-                elif isinstance(a, OnelineCommentAnnotation):
-                    for newe in new_events:
-                        newcomm = deepcopy(a)
-                        newcomm.target = newe.id
-                        newcomm.id = ann_obj.get_new_id("#") # TODO: avoid hard-coding ID prefix
-                        ann_obj.add_annotation(newcomm)
-                        mods.addition(newcomm)
-                elif isinstance(a, NormalizationAnnotation):
-                    for newe in new_events:
-                        newnorm = deepcopy(a)
-                        newnorm.target = newe.id
-                        newnorm.id = ann_obj.get_new_id("N") # TODO: avoid hard-coding ID prefix
-                        ann_obj.add_annotation(newnorm)
-                        mods.addition(newnorm)
-                else:
-                    raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
+        for a in ann_obj.get_dependants(ann.id):
+            # Referenced; make duplicates appropriately
+
+            if isinstance(a, EventAnnotation):
+                # go through args and make copies for referencing
+                new_args = []
+                for arg, aid in a.args:
+                    if aid == ann.id:
+                        for newe in new_events:
+                            new_args.append((arg, newe.id))
+                a.args.extend(new_args)
+                ann_obj.update_deps(a)
+
+            elif isinstance(a, AttributeAnnotation):
+                for newe in new_events:
+                    newmod = deepcopy(a)
+                    newmod.target = newe.id
+                    newmod.id = ann_obj.get_new_id("A") # TODO: avoid hard-coding ID prefix
+                    ann_obj.add_annotation(newmod)
+                    mods.addition(newmod)
+
+            elif isinstance(a, BinaryRelationAnnotation):
+                # TODO
+                raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
+
+            elif isinstance(a, OnelineCommentAnnotation):
+                for newe in new_events:
+                    newcomm = deepcopy(a)
+                    newcomm.target = newe.id
+                    newcomm.id = ann_obj.get_new_id("#") # TODO: avoid hard-coding ID prefix
+                    ann_obj.add_annotation(newcomm)
+                    mods.addition(newcomm)
+            elif isinstance(a, NormalizationAnnotation):
+                for newe in new_events:
+                    newnorm = deepcopy(a)
+                    newnorm.target = newe.id
+                    newnorm.id = ann_obj.get_new_id("N") # TODO: avoid hard-coding ID prefix
+                    ann_obj.add_annotation(newnorm)
+                    mods.addition(newnorm)
+            else:
+                raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
 
         mods_json = mods.json_response()
         mods_json['annotations'] = _json_from_ann(ann_obj)
         return mods_json
 
+class InvalidBatchOperationError(ProtocolError):
+    def __init__(self, index, reason):
+        self.index = index
+        self.reason = reason
+
+    def __str__(self):
+        return 'Invalid batch operation %d: %s' % (self.index, self.reason)
+
+    def json(self, json_dic):
+        json_dic['exception'] = 'invalidBatchOperation'
+        Messager.error(str(self))
+        return json_dic
+
+# Actions that can be part of a batch_edit, by name as for the dispatcher
+BATCH_OPERATION = {
+        'createSpan': create_span,
+        'deleteSpan': delete_span,
+        'splitSpan': split_span,
+
+        'createArc': create_arc,
+        'reverseArc': reverse_arc,
+        'deleteArc': delete_arc,
+
+        'normLink': norm_create_link,
+        }
+
+def _batch_operation_args(index, operation, collection, document):
+    # Bind the arguments of an operation like the dispatcher binds those of
+    # a request, values that are not strings are passed on as JSON
+    if not isinstance(operation, dict):
+        raise InvalidBatchOperationError(index, 'not an object')
+    try:
+        op_function = BATCH_OPERATION[operation.get('action')]
+    except (KeyError, TypeError):
+        raise InvalidBatchOperationError(index, 'unknown action "%s"'
+                % (operation.get('action'), ))
+
+    args, _, _, defaults = getargspec(op_function)
+    default_val_by_arg = {}
+    if defaults:
+        for arg, default_val in izip(args[-len(defaults):], defaults):
+            default_val_by_arg[arg] = default_val
+
+    op_args = []
+    for arg_name in args:
+        # All operations are on the document of the batch
+        if arg_name == 'collection':
+            arg_val = collection
+        elif arg_name == 'document':
+            arg_val = document
+        else:
+            arg_val = operation.get(arg_name)
+            if arg_val is None:
+                try:
+                    arg_val = default_val_by_arg[arg_name]
+                except KeyError:
+                    raise InvalidBatchOperationError(index,
+                            'missing argument "%s"' % (arg_name, ))
+            elif not isinstance(arg_val, basestring):
+                arg_val = json_dumps(arg_val)
+        op_args.append(arg_val)
+    return op_function, op_args
+
+def batch_edit(collection, document, operations):
+    """
+    Apply a JSON list of operations to the annotations of a document in
+    order, parsing and writing the annotations only once. Each operation
+    is an object with the "action" of the operation and its arguments,
+    e.g. {"action": "createSpan", "offsets": [[0, 5]], "type": "Protein"}.
+
+    Either all operations are applied or, if any fails, none of them (save
+    for changes made to normalisation databases by "normLink").
+    """
+    try:
+        operations = json_loads(operations)
+    except ValueError:
+        raise ProtocolArgumentError
+    if not isinstance(operations, list):
+        raise ProtocolArgumentError
+    # Check them all before doing anything
+    bound_operations = [_batch_operation_args(i, op, collection, document)
+            for i, op in enumerate(operations)]
+
+    real_dir = real_directory(collection)
+    with TextAnnotations(path_join(real_dir, document),
+            verify_changes=True) as ann_obj:
+        # bail as quick as possible if read-only
+        if ann_obj._read_only:
+            raise AnnotationsIsReadOnlyError(ann_obj.get_document())
+
+        results = []
+        _batch.ann_obj = ann_obj
+        try:
+            for op_function, op_args in bound_operations:
+                op_json = op_function(*op_args)
+                if op_json.get('exception'):
+                    # Already reported to the user, just stop here
+                    ann_obj.discard_changes()
+                    return op_json
+                op_json.pop('annotations', None)
+                results.append(op_json)
+        except:
+            # Leave the annotations as they were
+            ann_obj.discard_changes()
+            raise
+        finally:
+            _batch.ann_obj = None
+
+        mods = ModificationTracker()
+        mods.record_changes(ann_obj)
+        mods_json = mods.json_response()
+        # The responses of the individual operations, e.g. for undo
+        mods_json['operations'] = results
+        mods_json['annotations'] = _json_from_ann(ann_obj)
+        return mods_json
+
 def set_status(directory, document, status=None):
     real_dir = real_directory(directory) 
 
-    with TextAnnotations(path_join(real_dir, document)) as ann:
+    with TextAnnotations(path_join(real_dir, document),
+            verify_changes=True) as ann:
         # Erase all old status annotations
         for status in ann.get_statuses():
             ann.del_annotation(status)
@@ -1216,3 +1392,81 @@ def get_status(directory, document):
             'status': status
             }
     return json_dic
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from annotation import AnnotationNotFoundError
+    from session import init_session
+
+    class TestBatchEdit(TestCase):
+        def setUp(self):
+            global real_directory
+            init_session('127.0.0.1')
+            self._dir = mkdtemp()
+            self._real_directory = real_directory
+            real_directory = lambda collection: self._dir
+            self._write('doc.txt', 'Abc def ghi.\n')
+            self._write('doc.ann', 'T1\tProtein 4 7\tdef\n')
+
+        def tearDown(self):
+            global real_directory
+            real_directory = self._real_directory
+            rmtree(self._dir)
+
+        def _write(self, name, data):
+            with open(path_join(self._dir, name), 'w') as f:
+                f.write(data)
+
+        def _ann(self):
+            with open(path_join(self._dir, 'doc.ann')) as f:
+                return f.read()
+
+        def _batch_edit(self, *operations):
+            return batch_edit('/test/', 'doc', json_dumps(operations))
+
+        def test_applied(self):
+            result = self._batch_edit(
+                    {'action': 'createSpan', 'offsets': [[0, 3]],
+                        'type': 'Protein'},
+                    {'action': 'createSpan', 'offsets': [[8, 11]],
+                        'type': 'Protein'})
+            self.assertEqual(len(result['operations']), 2)
+            self.assertEqual(self._ann(), 'T1\tProtein 4 7\tdef\n'
+                    'T2\tProtein 0 3\tAbc\nT3\tProtein 8 11\tghi\n')
+
+        def test_rollback(self):
+            # The span created is not written as the deletion fails
+            self.assertRaises(AnnotationNotFoundError, self._batch_edit,
+                    {'action': 'createSpan', 'offsets': [[0, 3]],
+                        'type': 'Protein'},
+                    {'action': 'deleteSpan', 'id': 'T99'})
+            self.assertEqual(self._ann(), 'T1\tProtein 4 7\tdef\n')
+            self.assertEqual(getattr(_batch, 'ann_obj', None), None)
+
+        def test_invalid_operation(self):
+            # Checked before anything is done
+            self.assertRaises(InvalidBatchOperationError, self._batch_edit,
+                    {'action': 'deleteSpan', 'id': 'T1'},
+                    {'action': 'noSuchAction'})
+            self.assertRaises(InvalidBatchOperationError, self._batch_edit,
+                    {'action': 'deleteSpan'})
+            self.assertEqual(self._ann(), 'T1\tProtein 4 7\tdef\n')
+
+        def test_untracked_change(self):
+            # Changed without change_annotation(), found when opened as
+            # the annotator opens them
+            for verify_changes in (False, True):
+                with TextAnnotations(path_join(self._dir, 'doc'),
+                        verify_changes=verify_changes) as ann_obj:
+                    ann_obj.get_ann_by_id('T1').type = 'Gene'
+                    self.assertEqual(ann_obj.is_modified(), verify_changes)
+            _, changed, _ = ann_obj.get_changes()
+            self.assertEqual(changed, [(None, ann_obj.get_ann_by_id('T1'))])
+            self.assertEqual(self._ann(), 'T1\tGene 4 7\tdef\n')
+
+    unittest.main()
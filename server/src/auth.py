@@ -101,10 +101,12 @@ def whoami():
         Messager.error('Not logged in!', duration=3)
     return json_dic
 
-def allowed_to_read(real_path):
+def allowed_to_read(real_path, is_dir=None):
     data_path = path_join('/', relpath(real_path, DATA_DIR))
     # add trailing slash to directories, required to comply to robots.txt
-    if isdir(real_path):
+    if is_dir is None:
+        is_dir = isdir(real_path)
+    if is_dir:
         data_path = '%s/' % ( data_path )
         
     real_dir = dirname(real_path)
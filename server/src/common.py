@@ -66,6 +66,17 @@ def deprecated_action(func):
         return func(*args, **kwds)
     return wrapper
 
+def can_fork_workers():
+    """
+    Return True if worker processes (e.g. of a multiprocessing.Pool) may
+    be forked from this process. They may not while other threads are
+    running, as under the threaded FastCGI server: the children would
+    inherit the locks and other state of those threads as they happen to
+    be at the time (a lock held for logging, say), but not the threads.
+    """
+    from threading import active_count
+    return active_count() <= 1
+
 # relpath is not included in python 2.5; alternative implementation from
 # BareNecessities package, License: MIT, Author: James Gardner
 # TODO: remove need for relpath instead
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+On-disk cache for the annotation type configuration sent to the client
+for a collection, kept serialized to be spliced into responses as is.
+
+The configuration is identified by the modification times and sizes of
+every configuration file on the lookup path of the collection, so that
+it is built again whenever any of them is added, changed or removed.
+'''
+
+from hashlib import sha1
+from os import stat
+from os.path import join as path_join
+from os.path import abspath
+
+from jsonwrap import JSONFragment, dumps, loads
+from projectconfig import get_config_file_paths
+from workdir import WORK_DIR, write_cache_file
+
+### Constants
+# Sub-directory of the work directory holding the cached configurations
+TYPE_CONF_CACHE_DIR_NAME = 'type_conf_cache'
+# Bump this whenever the type configuration sent changes in form
+TYPE_CONF_VERSION = 1
+###
+
+
+def type_conf_version(directory):
+    '''
+    Return a token identifying the current version of the type
+    configuration for the given collection directory.
+    '''
+    identity = [TYPE_CONF_VERSION, abspath(directory)]
+    for path in get_config_file_paths(directory):
+        try:
+            st = stat(path)
+        except OSError:
+            # Not there, the next one on the lookup path is used
+            continue
+        identity.append((abspath(path), st.st_mtime, st.st_size))
+    return sha1(repr(identity)).hexdigest()
+
+
+def _type_conf_cache_path(directory):
+    return path_join(WORK_DIR, TYPE_CONF_CACHE_DIR_NAME,
+            sha1(abspath(directory)).hexdigest())
+
+
+def load_cached_type_conf(directory, version):
+    '''
+    Return the cached type configuration of the given version for a
+    collection directory as a tuple of the serialized JSON fragment and
+    the messages for the user from building it, or None if not cached.
+    '''
+    if WORK_DIR is None:
+        return None
+
+    cache_path = _type_conf_cache_path(directory)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_version, messages, fragment = cache_file.read().split(
+                    '\n', 2)
+        if cached_version != version:
+            return None
+        messages = loads(messages)
+    except (IOError, OSError, ValueError):
+        # Missing, outdated or corrupt, rebuild
+        return None
+    return JSONFragment(fragment), messages
+
+
+def store_cached_type_conf(directory, version, fragment, messages):
+    '''
+    Cache the serialized type configuration (a JSON fragment without
+    line breaks) of the given version for a collection directory, along
+    with the messages for the user from building it.
+    '''
+    if WORK_DIR is None:
+        return
+
+    write_cache_file(_type_conf_cache_path(directory),
+            version + '\n' + dumps(messages) + '\n' + fragment)
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import remove
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    try:
+        from config import BASE_DIR
+    except ImportError:
+        BASE_DIR = None
+
+    class TestTypeConfCache(TestCase):
+        def setUp(self):
+            global WORK_DIR
+            self._work_dir = WORK_DIR
+            WORK_DIR = mkdtemp()
+            # Configuration files are only looked for under BASE_DIR
+            self._dir = mkdtemp(dir=BASE_DIR)
+
+        def tearDown(self):
+            global WORK_DIR
+            rmtree(WORK_DIR)
+            WORK_DIR = self._work_dir
+            rmtree(self._dir)
+
+        def test_round_trip(self):
+            version = type_conf_version(self._dir)
+            self.assertEqual(load_cached_type_conf(self._dir, version), None)
+            fragment = JSONFragment(dumps({'a': [1, u'\xe9']})[1:-1])
+            messages = [[u'Built \xe9', 'warning', 3]]
+            store_cached_type_conf(self._dir, version, fragment, messages)
+            cached_fragment, cached_messages = load_cached_type_conf(
+                    self._dir, version)
+            self.assertTrue(isinstance(cached_fragment, JSONFragment))
+            self.assertEqual(cached_fragment, fragment)
+            self.assertEqual(cached_messages, messages)
+            self.assertEqual(load_cached_type_conf(self._dir, 'other'), None)
+
+        def test_config_added_and_removed(self):
+            version = type_conf_version(self._dir)
+            self.assertEqual(type_conf_version(self._dir), version)
+            conf_path = path_join(self._dir, 'annotation.conf')
+            with open(conf_path, 'w') as conf_file:
+                conf_file.write('[entities]\nProtein\n')
+            added = type_conf_version(self._dir)
+            self.assertNotEqual(added, version)
+            store_cached_type_conf(self._dir, added, JSONFragment(), [])
+            remove(conf_path)
+            self.assertEqual(type_conf_version(self._dir), version)
+            # Not what was cached with the file
+            self.assertEqual(load_cached_type_conf(self._dir,
+                type_conf_version(self._dir)), None)
+
+    unittest.main()
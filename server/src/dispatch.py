@@ -14,13 +14,13 @@ from os.path import join as path_join
 
 from annotator import create_arc, delete_arc, reverse_arc
 from annotator import create_span, delete_span
-from annotator import split_span
+from annotator import split_span, batch_edit
 from auth import login, logout, whoami, NotAuthorisedError
 from common import ProtocolError
 from config import DATA_DIR
 from convert.convert import convert
 from docimport import save_import
-from document import (get_directory_information, get_document, get_document_timestamp, get_configuration)
+from document import (get_directory_information, get_document, get_document_range, get_document_timestamp, get_configuration)
 from download import download_file, download_collection
 from inspect import getargspec
 from itertools import izip
@@ -31,7 +31,7 @@ from message import Messager
 from rdfIO import create_rdf_file
 from svg import store_svg, retrieve_stored
 from session import get_session, load_conf, save_conf
-from search import search_text, search_entity, search_event, search_relation, search_note
+from search import search_text, search_entity, search_event, search_relation, search_note, search_resume
 from predict import suggest_span_types
 from undo import undo
 from tag import tag
@@ -49,6 +49,7 @@ def logging_no_op(collection, document, log):
 DISPATCHER = {
         'getCollectionInformation': get_directory_information,
         'getDocument': get_document,
+        'getDocumentRange': get_document_range,
         'getDocumentTimestamp': get_document_timestamp,
         'importDocument': save_import,
 
@@ -70,6 +71,8 @@ DISPATCHER = {
         'reverseArc': reverse_arc,
         'deleteArc': delete_arc,
 
+        'batchEdit': batch_edit,
+
         # NOTE: search actions are redundant to allow different
         # permissions for single-document and whole-collection search.
         'searchTextInDocument'     : search_text,
@@ -82,6 +85,7 @@ DISPATCHER = {
         'searchEventInCollection'    : search_event,
         'searchRelationInCollection' : search_relation,
         'searchNoteInCollection'     : search_note,
+        'searchResume'               : search_resume,
 
         'suggestSpanTypes': suggest_span_types,
 
@@ -120,6 +124,7 @@ ANNOTATION_ACTION = set((
         'createSpan',
         'deleteSpan',
         'splitSpan',
+        'batchEdit',
         'suggestSpanTypes',
         'undo',
         ))
@@ -127,6 +132,7 @@ ANNOTATION_ACTION = set((
 # Actions that will be logged as annotator actions (if so configured)
 LOGGED_ANNOTATOR_ACTION = ANNOTATION_ACTION | set((
         'getDocument',
+        'getDocumentRange',
         'logAnnotatorAction',
         ))
 
@@ -141,6 +147,7 @@ REQUIRES_AUTHENTICATION = ANNOTATION_ACTION | set((
         'searchEventInCollection',
         'searchRelationInCollection',
         'searchNoteInCollection',
+        'searchResume',
 
         'tag',
         ))
@@ -154,6 +161,8 @@ ANNOTATION_SAVE_RDF = set((
         'deleteSpan',
         'splitSpan',
 
+        'batchEdit',
+
         'normCreate',
         'normDelete',
         'normLink',
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Version tokens and a bounded on-disk cache for the JSON sent in response
+to getDocument.
+
+The version of a document identifies the state of everything its JSON is
+built from: the text, the annotation files and the configuration that
+applies to it. Only the JSON for the latest version of a document is kept,
+and only for the DOCUMENT_CACHE_SIZE most recently viewed documents.
+'''
+
+from hashlib import sha1
+from os import stat, utime
+from os.path import join as path_join
+from os.path import abspath, dirname
+
+from annotation import KNOWN_FILE_SUFF, TEXT_FILE_SUFFIX
+from jsonwrap import dumps, loads
+from projectconfig import get_config_file_paths
+from workdir import WORK_DIR, write_cache_file
+
+try:
+    from config import DOCUMENT_CACHE_SIZE
+except ImportError:
+    DOCUMENT_CACHE_SIZE = 256
+
+### Constants
+# Sub-directory of the work directory holding the cached documents
+DOCUMENT_CACHE_DIR_NAME = 'document_cache'
+# Bump this whenever the JSON for a document changes in form, to make
+# previous versions (and cached JSON) invalid
+DOCUMENT_VERSION = 1
+###
+
+
+def document_version(document):
+    '''
+    Return a token identifying the current version of the given document
+    (path without suffix), changing whenever its text, annotations or
+    configuration change.
+    '''
+    sources = [document + '.' + TEXT_FILE_SUFFIX]
+    sources.extend(document + '.' + suff for suff in KNOWN_FILE_SUFF)
+    sources.extend(get_config_file_paths(dirname(document)))
+
+    identity = [DOCUMENT_VERSION]
+    for path in sources:
+        try:
+            st = stat(path)
+        except OSError:
+            # Coming into existence makes for a new version all the same
+            continue
+        identity.append((path, st.st_mtime, st.st_size))
+    return sha1(repr(identity)).hexdigest()
+
+
+def _use_document_cache():
+    return WORK_DIR is not None and DOCUMENT_CACHE_SIZE
+
+
+def _document_cache_path(document):
+    return path_join(WORK_DIR, DOCUMENT_CACHE_DIR_NAME,
+            sha1(abspath(document)).hexdigest())
+
+
+def load_cached_document(document, version):
+    '''
+    Return the cached JSON dictionary for the given version of a document,
+    or None if not cached.
+    '''
+    if not _use_document_cache():
+        return None
+
+    cache_path = _document_cache_path(document)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_version, json_str = cache_file.read().split('\n', 1)
+        if cached_version != version:
+            return None
+        json_dic = loads(json_str)
+        # Keep track of when it was last used for evicting
+        utime(cache_path, None)
+    except (IOError, OSError, ValueError):
+        # Missing, outdated or corrupt, rebuild
+        return None
+    return json_dic
+
+
+def store_cached_document(document, version, json_dic):
+    '''
+    Cache the JSON dictionary for the given version of a document, evicting
+    the least recently used documents if the cache is full.
+    '''
+    if not _use_document_cache():
+        return
+
+    write_cache_file(_document_cache_path(document),
+            version + '\n' + dumps(json_dic), DOCUMENT_CACHE_SIZE)
@@ -13,6 +13,7 @@ from annotation import open_textfile
 from common import ProtocolError
 from config import DATA_DIR
 from document import real_directory
+from textindex import invalidate_document
 from annotation import JOINED_ANN_FILE_SUFF, TEXT_FILE_SUFFIX
 from os.path import join as join_path
 from os.path import isdir, isfile
@@ -103,6 +104,9 @@ def save_import(text, docid, collection=None):
     with open(ann_path, 'w') as _:
         pass
 
+    # Let the text index of the collection know about it
+    invalidate_document(base_path)
+
     return { 'document': docid }
 
 if __name__ == '__main__':
@@ -26,7 +26,7 @@ from annotation import (TextAnnotations, TEXT_FILE_SUFFIX,
         JOINED_ANN_FILE_SUFF,
         open_textfile,
         BIONLP_ST_2013_COMPATIBILITY)
-from common import ProtocolError, CollectionNotAccessibleError
+from common import ProtocolError, ProtocolArgumentError
 from config import BASE_DIR, DATA_DIR
 from projectconfig import (ProjectConfiguration, SEPARATOR_STR, 
         SPAN_DRAWING_ATTRIBUTES, ARC_DRAWING_ATTRIBUTES,
@@ -36,11 +36,21 @@ from projectconfig import (ProjectConfiguration, SEPARATOR_STR,
         options_get_validation, options_get_tokenization,
         options_get_ssplitter, get_annotation_config_section_labels,
         visual_options_get_arc_bundle)
-from stats import get_statistics
+from manifest import get_manifest
 from message import Messager
+from jsonwrap import JSONFragment, dumps
+from jsonwrap import loads as json_loads
+from confcache import (type_conf_version, load_cached_type_conf,
+        store_cached_type_conf)
+from doccache import (document_version, load_cached_document,
+        store_cached_document)
+from offsetcache import (load_file_offsets, load_offsets,
+        store_file_offsets, store_offsets)
+from ssplit import merge_crossed_sentences
 from auth import allowed_to_read, AccessDeniedError
 from annlog import annotation_logging_active
 
+from bisect import bisect_left, bisect_right
 from itertools import chain
 
 def _fill_type_configuration(nodes, project_conf, hotkey_by_type, all_connections=None):
@@ -470,6 +480,34 @@ def _inject_annotation_type_conf(dir_path, json_dic=None):
     if json_dic is None:
         json_dic = {}
 
+    # Building the configuration takes as long as the rest of a listing
+    # for deep type hierarchies, so it is cached as serialized JSON and
+    # spliced into the response as is
+    version = type_conf_version(dir_path)
+    cached = load_cached_type_conf(dir_path, version)
+    if cached is None:
+        # Keep the messages from building it to be given again whenever
+        # it is used, setting aside any others meanwhile
+        earlier = Messager.take_pending()
+        try:
+            type_conf = _annotation_type_conf(dir_path)
+        finally:
+            messages = Messager.take_pending()
+            Messager.put_pending(earlier + messages)
+        fragment = JSONFragment(dumps(type_conf)[1:-1])
+        store_cached_type_conf(dir_path, version, fragment, messages)
+    else:
+        fragment, messages = cached
+        Messager.put_pending(messages)
+
+    # Spliced as members of the response, the key it is stored under is
+    # not used (see jsonwrap.dumps())
+    json_dic['type_configuration'] = fragment
+    return json_dic
+
+def _annotation_type_conf(dir_path):
+    json_dic = {}
+
     (event_types, entity_types, rel_types,
             unconf_types) = get_base_types(dir_path)
     (entity_attr_types, rel_attr_types,
@@ -497,43 +535,109 @@ def _inject_annotation_type_conf(dir_path, json_dic=None):
 
     return json_dic
 
+# Comparisons allowed in a collection listing filter
+LISTING_FILTER_OPERATOR = {
+        '=': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'contains': lambda a, b: unicode(b).lower() in unicode(a).lower(),
+        }
+
+def _listing_column(header, name):
+    # Index of the column with the given (case-insensitive) name
+    for i, (col_name, _) in enumerate(header):
+        if col_name.lower() == unicode(name).lower():
+            return i
+    Messager.error('Unknown collection listing column "%s"' % name)
+    raise ProtocolArgumentError
+
+def _non_negative_int(name, value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        Messager.error('%s should be a non-negative integer' % name)
+        raise ProtocolArgumentError
+    return value
+
+def _select_documents(header, doclist, offset, limit, sort_by, filter):
+    # Filter, sort and slice the document rows of a collection listing as
+    # requested, the arguments being as received from the client
+    if filter is not None:
+        # JSON list of [column, operator, value] conditions, all of which
+        # a row has to meet
+        try:
+            conditions = json_loads(filter)
+            conditions = [(_listing_column(header, col),
+                    LISTING_FILTER_OPERATOR[op], val)
+                    for col, op, val in conditions]
+        except (ValueError, TypeError, KeyError):
+            Messager.error('Collection listing filter should be a list of '
+                    '[column, operator, value] conditions, operators being '
+                    'one of %s' % ', '.join(sorted(LISTING_FILTER_OPERATOR)))
+            raise ProtocolArgumentError
+        doclist = [d for d in doclist
+                if all(op(d[col], val) for col, op, val in conditions)]
+
+    if sort_by is not None:
+        # Column name, descending if prefixed by "-"
+        reverse = sort_by.startswith('-')
+        col = _listing_column(header, sort_by.lstrip('-'))
+        doclist = sorted(doclist, key=lambda d: d[col], reverse=reverse)
+
+    if offset is not None:
+        doclist = doclist[_non_negative_int('Collection listing offset',
+            offset):]
+    if limit is not None:
+        doclist = doclist[:_non_negative_int('Collection listing limit',
+            limit)]
+    return doclist
+
 # TODO: This is not the prettiest of functions
-def get_directory_information(collection):
+def get_directory_information(collection, offset=None, limit=None,
+        sort_by=None, filter=None):
+    '''
+    Return the documents and sub-collections of a collection along with
+    the collection configuration. The documents may be filtered (by a JSON
+    list of [column, operator, value] conditions on the columns given in
+    the "header"), sorted by a column (descending if prefixed by "-") and
+    paged through (by offset and limit), "doc_total" and "doc_count"
+    giving the number of documents before and after filtering. The
+    sub-collections are always returned in full.
+    '''
     directory = collection
 
     real_dir = real_directory(directory)
     
     assert_allowed_to_read(real_dir)
     
-    # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir)
-            if fn.endswith('txt')]
-
-    doclist = base_names[:]
-    doclist_header = [("Document", "string")]
-
-    # Then get the modification times
-    doclist_with_time = []
-    for file_name in doclist:
-        file_path = path_join(DATA_DIR, real_dir,
-            file_name + "." + JOINED_ANN_FILE_SUFF)
-        doclist_with_time.append([file_name, _getmtime(file_path)])
-    doclist = doclist_with_time
-    doclist_header.append(("Modified", "time"))
-
+    # Documents, their statistics and sub-collections, as of the last time
+    # the collection was listed (updated for any change since)
     try:
-        stats_types, doc_stats = get_statistics(real_dir, base_names)
-    except OSError:
-        # something like missing access permissions?
-        raise CollectionNotAccessibleError
-                
-    doclist = [doclist[i] + doc_stats[i] for i in range(len(doclist))]
+        stats_types, doclist, dirlist = get_manifest(real_dir)
+    except OSError, e:
+        Messager.error("Error listing %s: %s" % (real_dir, e))
+        raise AnnotationCollectionNotFoundError(real_dir)
+
+    doclist = [d for d in doclist if allowed_to_read(
+        path_join(real_dir, d[0] + '.' + TEXT_FILE_SUFFIX), is_dir=False)]
+    doclist_header = [("Document", "string"), ("Modified", "time")]
     doclist_header += stats_types
 
-    dirlist = [dir for dir in _listdir(real_dir)
-            if isdir(path_join(real_dir, dir))]
+    doc_total = len(doclist)
+    doclist = _select_documents(doclist_header, doclist, None, None,
+            sort_by, filter)
+    doc_count = len(doclist)
+    doclist = _select_documents(doclist_header, doclist, offset, limit,
+            None, None)
+
     # just in case, and for generality
-    dirlist = [[dir] for dir in dirlist]
+    dirlist = [[dir] for dir in dirlist
+            if allowed_to_read(path_join(real_dir, dir), is_dir=True)]
 
     # check whether at root, ignoring e.g. possible trailing slashes
     if normpath(real_dir) != normpath(DATA_DIR):
@@ -581,6 +685,8 @@ def get_directory_information(collection):
     return _inject_annotation_type_conf(real_dir, json_dic={
             'items': combolist,
             'header' : doclist_header,
+            'doc_total': doc_total,
+            'doc_count': doc_count,
             'parent': parent,
             'messages': [],
             'description': readme_text,
@@ -613,32 +719,22 @@ class IsDirectoryError(ProtocolError):
         json_dic['exception'] = 'isDirectoryError'
         return json_dic
 
-#TODO: All this enrichment isn't a good idea, at some point we need an object
-def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
-    if raw_text is not None:
-        # looks like somebody read this already; nice
-        text = raw_text
-    else:
-        # need to read raw text
-        try:
-            with open_textfile(txt_file_path, 'r') as txt_file:
-                text = txt_file.read()
-        except IOError:
-            raise UnableToReadTextFile(txt_file_path)
-        except UnicodeDecodeError:
-            Messager.error('Error reading text file: nonstandard encoding or binary?', -1)
-            raise UnableToReadTextFile(txt_file_path)
-
-    j_dic['text'] = text
-    
-    from logging import info as log_info
-
-    tokeniser = options_get_tokenization(dirname(txt_file_path))
+def _text_offset_gens(directory):
+    # Returns the token and sentence offset generators configured for the
+    # given directory, preceded by the names to cache their offsets under
+    # (None if the offsets should not be cached)
+    tokeniser = options_get_tokenization(directory)
 
     # First, generate tokenisation
     if tokeniser == 'mecab':
         from tokenise import jp_token_boundary_gen
         tok_offset_gen = jp_token_boundary_gen
+        try:
+            import mecab
+        except ImportError:
+            # Will fall back on whitespace tokenisation (and say so), do
+            # not keep those offsets around for when MeCab is in place
+            tokeniser = None
     elif tokeniser == 'whitespace':
         from tokenise import whitespace_token_boundary_gen
         tok_offset_gen = whitespace_token_boundary_gen
@@ -650,9 +746,9 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
                 ', reverting to whitespace tokenisation.')
         from tokenise import whitespace_token_boundary_gen
         tok_offset_gen = whitespace_token_boundary_gen
-    j_dic['token_offsets'] = [o for o in tok_offset_gen(text)]
+        tokeniser = 'whitespace'
 
-    ssplitter = options_get_ssplitter(dirname(txt_file_path))
+    ssplitter = options_get_ssplitter(directory)
     if ssplitter == 'newline':
         from ssplit import newline_sentence_boundary_gen
         ss_offset_gen = newline_sentence_boundary_gen
@@ -664,23 +760,89 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
                 ', reverting to newline sentence splitting.')
         from ssplit import newline_sentence_boundary_gen
         ss_offset_gen = newline_sentence_boundary_gen
-    j_dic['sentence_offsets'] = [o for o in ss_offset_gen(text)]
+        ssplitter = 'newline'
+
+    return tokeniser, tok_offset_gen, ssplitter, ss_offset_gen
+
+def get_text_offsets(directory, text):
+    '''
+    Return the (start, end) token and sentence offsets of a text in the
+    given directory as split by the tokeniser and sentence splitter
+    configured for it, from the offset cache if possible.
+    '''
+    tokeniser, tok_offset_gen, ssplitter, ss_offset_gen = _text_offset_gens(
+            directory)
+
+    offsets = load_offsets(text, tokeniser, ssplitter)
+    if offsets is None:
+        offsets = ([o for o in tok_offset_gen(text)],
+                [o for o in ss_offset_gen(text)])
+        store_offsets(text, tokeniser, ssplitter, *offsets)
+    return offsets
+
+def get_document_offsets(directory, ann_obj, text_path):
+    '''
+    Return the (start, end) token and sentence offsets of the text of the
+    given TextAnnotations object as get_text_offsets(), without getting
+    the text if they are cached for its text file (at the given path) as
+    it is.
+    '''
+    tokeniser, _, ssplitter, _ = _text_offset_gens(directory)
+    text_len = ann_obj.get_document_text_length()
+
+    offsets = load_file_offsets(text_path, text_len, tokeniser, ssplitter)
+    if offsets is None:
+        offsets = get_text_offsets(directory, ann_obj.get_document_text())
+        store_file_offsets(text_path, text_len, tokeniser, ssplitter,
+                *offsets)
+    return offsets
+
+#TODO: All this enrichment isn't a good idea, at some point we need an object
+def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
+    if raw_text is not None:
+        # looks like somebody read this already; nice
+        text = raw_text
+    else:
+        # need to read raw text
+        try:
+            with open_textfile(txt_file_path, 'r') as txt_file:
+                text = txt_file.read()
+        except IOError:
+            raise UnableToReadTextFile(txt_file_path)
+        except UnicodeDecodeError:
+            Messager.error('Error reading text file: nonstandard encoding or binary?', -1)
+            raise UnableToReadTextFile(txt_file_path)
+
+    j_dic['text'] = text
+    (j_dic['token_offsets'], j_dic['sentence_offsets']
+            ) = get_text_offsets(dirname(txt_file_path), text)
 
     return True
 
-def _enrich_json_with_data(j_dic, ann_obj):
+def _enrich_json_with_data(j_dic, ann_obj, keep_ids=None):
     # TODO: figure out if there's a reason for all the unicode()
     # invocations here; remove if not.
 
+    # Only the annotations with (or, for equivs, of) the given ids are
+    # included if keep_ids is given
+    if keep_ids is None:
+        keep = lambda ann_id: True
+    else:
+        keep = lambda ann_id: ann_id in keep_ids
+
     # We collect trigger ids to be able to link the textbound later on
     trigger_ids = set()
     for event_ann in ann_obj.get_events():
         trigger_ids.add(event_ann.trigger)
+        if not keep(event_ann.id):
+            continue
         j_dic['events'].append(
                 [unicode(event_ann.id), unicode(event_ann.trigger), event_ann.args]
                 )
 
     for rel_ann in ann_obj.get_relations():
+        if not keep(rel_ann.id):
+            continue
         j_dic['relations'].append(
             [unicode(rel_ann.id), unicode(rel_ann.type), 
              [(rel_ann.arg1l, rel_ann.arg1),
@@ -688,6 +850,8 @@ def _enrich_json_with_data(j_dic, ann_obj):
             )
 
     for tb_ann in ann_obj.get_textbounds():
+        if not keep(tb_ann.id):
+            continue
         #j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
         j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.spans]
 
@@ -715,17 +879,25 @@ def _enrich_json_with_data(j_dic, ann_obj):
 
 
     for eq_ann in ann_obj.get_equivs():
+        entities = [e for e in eq_ann.entities if keep(e)]
+        if keep_ids is not None and len(entities) < 2:
+            # Nothing left to be equivalent with in the window
+            continue
         j_dic['equivs'].append(
                 (['*', eq_ann.type]
-                    + [e for e in eq_ann.entities])
+                    + entities)
                 )
 
     for att_ann in ann_obj.get_attributes():
+        if not keep(att_ann.target):
+            continue
         j_dic['attributes'].append(
                 [unicode(att_ann.id), unicode(att_ann.type), unicode(att_ann.target), att_ann.value]
                 )
 
     for norm_ann in ann_obj.get_normalizations():
+        if not keep(norm_ann.target):
+            continue
         j_dic['normalizations'].append(
                 [unicode(norm_ann.id), unicode(norm_ann.type), 
                  unicode(norm_ann.target), unicode(norm_ann.refdb), 
@@ -733,6 +905,8 @@ def _enrich_json_with_data(j_dic, ann_obj):
                 )
 
     for com_ann in ann_obj.get_oneline_comments():
+        if not keep(com_ann.target):
+            continue
         comment = [unicode(com_ann.target), unicode(com_ann.type),
                 com_ann.tail.strip()]
         try:
@@ -771,6 +945,8 @@ def _enrich_json_with_data(j_dic, ann_obj):
         Messager.error('Error: verify_annotation() failed: %s' % e, -1)
 
     for i in issues:
+        if not keep(i.ann_id):
+            continue
         issue = (unicode(i.ann_id), i.type, i.description)
         try:
             j_dic['comments'].append(issue)
@@ -827,38 +1003,156 @@ def _document_json_dict(document):
         # Note: At this stage the sentence offsets can conflict with the
         #   annotations, we thus merge any sentence offsets that lie within
         #   annotations
-        # XXX: ~O(tb_ann * sentence_breaks), can be optimised
-        # XXX: The merge strategy can lead to unforeseen consequences if two
-        #   sentences are not adjacent (the format allows for this:
-        #   S_1: [0, 10], S_2: [15, 20])
-        s_breaks = j_dic['sentence_offsets']
-        for tb_ann in ann_obj.get_textbounds():
-            s_i = 0
-            while s_i < len(s_breaks):
-                s_start, s_end = s_breaks[s_i]
-                # Does any subspan of the annotation strech over the
-                # end of the sentence?
-                found_spanning = False
-                for tb_start, tb_end in tb_ann.spans:
-                    if tb_start < s_end and tb_end > s_end:
-                        found_spanning = True
-                        break
-                if found_spanning:
-                    # Merge this sentence and the next sentence
-                    s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
-                    del s_breaks[s_i + 1]
-                else:
-                    s_i += 1
+        j_dic['sentence_offsets'] = merge_crossed_sentences(
+                j_dic['sentence_offsets'],
+                (span for tb_ann in ann_obj.get_textbounds()
+                    for span in tb_ann.spans))
         
         _enrich_json_with_data(j_dic, ann_obj)
 
     return j_dic
 
-def get_document(collection, document):
+def get_document(collection, document, version=None):
     directory = collection
     real_dir = real_directory(directory)
     doc_path = path_join(real_dir, document)
-    return _document_json_dict(doc_path)
+
+    # The client already has this version, if it tells us its version
+    current_version = document_version(doc_path)
+    if version is not None and version == current_version:
+        return {
+                'version': current_version,
+                'not_modified': True,
+                }
+
+    j_dic = load_cached_document(doc_path, current_version)
+    if j_dic is None:
+        j_dic = _document_json_dict(doc_path)
+        j_dic['version'] = current_version
+        # Anything reported to the user on the way would be reported again
+        # were it rebuilt, so keep it with the rest of the response
+        Messager.output_json(j_dic)
+        store_cached_document(doc_path, current_version, j_dic)
+    return j_dic
+
+# Units of the window for getDocumentRange
+DOCUMENT_RANGE_UNITS = ('sentence', 'char')
+
+def _sentence_window(sentence_starts, text_length, start, end, unit):
+    # The (first, last + 1) indices of the sentences making up the given
+    # window, each sentence taken to run up to the start of the next one
+    # (the first from the start of the text) so that windows of
+    # consecutive sentences cover the text without gaps
+    if unit == 'sentence':
+        first = min(start, len(sentence_starts))
+        last = len(sentence_starts) if end is None else end
+    elif start >= text_length:
+        first = last = len(sentence_starts)
+    else:
+        # The sentence the start is in and those starting before the end
+        # (or at it, for an empty window)
+        first = max(bisect_right(sentence_starts, start) - 1, 0)
+        if end is None:
+            last = len(sentence_starts)
+        else:
+            last = bisect_left(sentence_starts, max(end, start + 1))
+    return first, max(first, min(last, len(sentence_starts)))
+
+def _window_annotation_ids(ann_obj, start, end):
+    # Returns the ids of the annotations touching the given window (the
+    # text-bound annotations overlapping it and the events, relations and
+    # their attachments that refer to those) and the ids of those of the
+    # events and relations that also refer to annotations outside it
+    in_window = set(a.id for a in ann_obj.overlapping(start, end))
+
+    # Events stand for their triggers when arguments of other events
+    trigger_by_event = dict((e.id, e.trigger) for e in ann_obj.get_events())
+
+    keep_ids = set(in_window)
+    crossing_ids = set()
+    arcs = [(e.id, [e.trigger] + [a for _, a in e.args])
+            for e in ann_obj.get_events()]
+    arcs.extend((r.id, [r.arg1, r.arg2]) for r in ann_obj.get_relations())
+    for arc_id, refs in arcs:
+        inside = [trigger_by_event.get(ref, ref) in in_window for ref in refs]
+        if any(inside):
+            keep_ids.add(arc_id)
+            if not all(inside):
+                crossing_ids.add(arc_id)
+    return keep_ids, crossing_ids
+
+def get_document_range(collection, document, start=None, end=None,
+        unit='sentence'):
+    '''
+    Return the part of a document in a window of sentences (the indices
+    of the first and one past the last sentence) or characters (extended
+    to whole sentences, each running up to the next) along with the
+    annotations touching it, as for getDocument. Offsets are those in the
+    whole document, the text being the slice starting at "window"[0].
+    Events and relations that refer to annotations both in and outside
+    the window are included, with their ids listed in "crossing_arcs".
+    '''
+    directory = collection
+    real_dir = real_directory(directory)
+    assert_allowed_to_read(real_dir)
+    doc_path = path_join(real_dir, document)
+
+    if isdir(doc_path):
+        raise IsDirectoryError(doc_path)
+    if unit not in DOCUMENT_RANGE_UNITS:
+        Messager.error('Document range unit should be one of %s' % (
+            ', '.join(DOCUMENT_RANGE_UNITS)))
+        raise ProtocolArgumentError
+    start = _non_negative_int('Document range start',
+            start) if start is not None else 0
+    if end is not None:
+        end = _non_negative_int('Document range end', end)
+        if end < start:
+            Messager.error('Document range end should not be before its start')
+            raise ProtocolArgumentError
+
+    j_dic = {}
+    _enrich_json_with_base(j_dic)
+
+    with TextAnnotations(doc_path) as ann_obj:
+        # Only the text of the window is needed, once the offsets are
+        # cached
+        text_len = ann_obj.get_document_text_length()
+        token_offsets, sentence_offsets = get_document_offsets(real_dir,
+                ann_obj, doc_path + '.' + TEXT_FILE_SUFFIX)
+        sentence_offsets = merge_crossed_sentences(sentence_offsets,
+                (span for tb_ann in ann_obj.get_textbounds()
+                    for span in tb_ann.spans))
+
+        sentence_starts = [s for s, _ in sentence_offsets]
+        first, last = _sentence_window(sentence_starts, text_len, start,
+                end, unit)
+        if first == last:
+            # Nothing, say past the last sentence
+            window_start = window_end = (sentence_starts[first]
+                    if first < len(sentence_starts) else text_len)
+        else:
+            window_start = sentence_starts[first] if first > 0 else 0
+            window_end = (sentence_starts[last]
+                    if last < len(sentence_starts) else text_len)
+        window = (window_start, window_end)
+
+        j_dic['text'] = ann_obj.get_document_text_slice(*window)
+        j_dic['window'] = window
+        j_dic['sentence_window'] = (first, last)
+        j_dic['text_length'] = text_len
+        j_dic['sentence_count'] = len(sentence_offsets)
+        j_dic['sentence_offsets'] = sentence_offsets[first:last]
+        j_dic['token_offsets'] = token_offsets[
+                bisect_left([e for _, e in token_offsets], window[0] + 1):
+                bisect_right([s for s, _ in token_offsets], window[1] - 1)]
+
+        keep_ids, crossing_ids = _window_annotation_ids(ann_obj, *window)
+        _enrich_json_with_data(j_dic, ann_obj, keep_ids)
+        j_dic['crossing_arcs'] = sorted(crossing_ids)
+
+    j_dic['version'] = document_version(doc_path)
+    return j_dic
 
 def get_document_timestamp(collection, document):
     directory = collection
@@ -871,3 +1165,99 @@ def get_document_timestamp(collection, document):
     return {
             'mtime': mtime,
             }
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    class TestSelectDocuments(TestCase):
+        HEADER = [('Document', 'string'), ('Modified', 'time'),
+                ('Entities', 'int'), ('Relations', 'int')]
+        DOCUMENTS = [['a', 1000, 3, 0], ['b', 3000, 1, 2],
+                ['c', 2000, 2, 0], ['d', -1, 0, 0]]
+
+        def _select(self, offset=None, limit=None, sort_by=None,
+                filter=None):
+            return [d[0] for d in _select_documents(self.HEADER,
+                self.DOCUMENTS, offset, limit, sort_by, filter)]
+
+        def test_all(self):
+            self.assertEqual(self._select(), ['a', 'b', 'c', 'd'])
+
+        def test_page(self):
+            self.assertEqual(self._select(offset='1', limit='2'), ['b', 'c'])
+            self.assertEqual(self._select(offset='3'), ['d'])
+            self.assertEqual(self._select(limit='1'), ['a'])
+            self.assertEqual(self._select(offset='4', limit='2'), [])
+
+        def test_sort(self):
+            self.assertEqual(self._select(sort_by='entities'),
+                    ['d', 'b', 'c', 'a'])
+            self.assertEqual(self._select(sort_by='-Modified', limit='2'),
+                    ['b', 'c'])
+
+        def test_filter(self):
+            self.assertEqual(self._select(
+                filter='[["Entities", ">=", 2], ["Relations", "=", 0]]'),
+                ['a', 'c'])
+            self.assertEqual(self._select(
+                filter='[["document", "contains", "B"]]'), ['b'])
+            # Filtered before being sorted and paged
+            self.assertEqual(self._select(offset='1', sort_by='-entities',
+                filter='[["Relations", "=", 0]]'), ['c', 'd'])
+
+        def test_invalid(self):
+            for kwargs in ({'offset': '-1'}, {'limit': 'x'},
+                    {'sort_by': 'nosuchcolumn'},
+                    {'filter': '[["Entities", "~", 1]]'},
+                    {'filter': '[["Entities", ">"]]'},
+                    {'filter': 'not json'}):
+                self.assertRaises(ProtocolArgumentError, self._select,
+                        **kwargs)
+
+    class TestTypeConf(TestCase):
+        def setUp(self):
+            global _annotation_type_conf
+            import confcache
+            from tempfile import mkdtemp
+
+            self._confcache = confcache
+            self._work_dir = confcache.WORK_DIR
+            confcache.WORK_DIR = mkdtemp()
+            self._dir = mkdtemp()
+            self._annotation_type_conf = _annotation_type_conf
+            self._built = 0
+            _annotation_type_conf = self._build
+            # Left by other tests
+            Messager.take_pending()
+
+        def tearDown(self):
+            global _annotation_type_conf
+            from shutil import rmtree
+
+            _annotation_type_conf = self._annotation_type_conf
+            rmtree(self._confcache.WORK_DIR)
+            self._confcache.WORK_DIR = self._work_dir
+            rmtree(self._dir)
+
+        def _build(self, dir_path):
+            self._built += 1
+            Messager.warning(u'Built <\xe9>')
+            return {'entity_types': [u'Protein']}
+
+        def _response(self):
+            Messager.info(u'Earlier')
+            json_dic = _inject_annotation_type_conf(self._dir, {'a': 1})
+            Messager.output_json(json_dic)
+            return json_loads(dumps(json_dic))
+
+        def test_messages_replayed(self):
+            for _ in range(2):
+                self.assertEqual(self._response(), {'a': 1,
+                    'entity_types': [u'Protein'],
+                    'messages': [[u'Earlier', 'comment', 3],
+                        [u'Built &lt;\xe9&gt;', 'warning', 3]]})
+            # Only built once, and its messages are not escaped again
+            self.assertEqual(self._built, 1)
+
+    unittest.main()
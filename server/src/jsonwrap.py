@@ -47,12 +47,54 @@ except ImportError, e:
 
 #ensure_ascii[, check_circular[, allow_nan[, cls[, indent[, separators[, encoding
 
+class JSONFragment(str):
+    '''
+    Members of a JSON object serialized already ('"key": value, ...'),
+    spliced as they are into the serialization of the dictionary holding
+    the fragment (under any key) by dumps() instead of serialized again.
+    '''
+    pass
+
 def dumps(dic):
     # ultrajson has neither sort_keys nor indent
 #     return lib_dumps(dic, sort_keys=True, indent=2)
+    if isinstance(dic, dict):
+        # The keys the fragments are stored under are dropped, only their
+        # members make it into the output
+        fragments = [v for v in dic.itervalues()
+                if isinstance(v, JSONFragment)]
+        if fragments:
+            dic = dict((k, v) for k, v in dic.iteritems()
+                    if not isinstance(v, JSONFragment))
+            members = ', '.join(f for f in fragments if f)
+            if not members:
+                return lib_dumps(dic)
+            if dic:
+                # Before the closing brace of the object
+                return lib_dumps(dic)[:-1] + ', ' + members + '}'
+            return '{' + members + '}'
     return lib_dumps(dic)
 
 def loads(s):
     return lib_loads(s)
 
 # TODO: Unittest that tries the import, encoding etc.
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    class TestJSONFragment(TestCase):
+        def test_spliced(self):
+            fragment = JSONFragment(dumps({'a': [1, 2], 'b': u'\xe9'})[1:-1])
+            self.assertEqual(loads(dumps({'c': 3, 'ignored': fragment})),
+                    {'a': [1, 2], 'b': u'\xe9', 'c': 3})
+            self.assertEqual(loads(dumps({'ignored': fragment})),
+                    {'a': [1, 2], 'b': u'\xe9'})
+
+        def test_empty(self):
+            self.assertEqual(loads(dumps({'c': 3, 'ignored': JSONFragment()})),
+                    {'c': 3})
+            self.assertEqual(loads(dumps({'ignored': JSONFragment()})), {})
+
+    unittest.main()
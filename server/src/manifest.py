@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Persistent per-collection manifest of the documents, their modification
+times, sizes and statistics, and the sub-collections of a collection.
+
+The manifest is a small SQLite database under WORK_DIR. It is brought up
+to date incrementally: the collection is only listed again once the
+mtime (or ctime) of its directory changes (documents added, removed or
+renamed), and only the statistics of documents invalidated since they
+were generated, or generated for another configuration, are generated
+again. Annotation files written in place do not change the mtime of
+their directory, so writers have to call invalidate_document() for them
+(Annotations does so for every file it writes). The statistics are
+generated outside of any transaction, the manifest is only locked to
+store them.
+'''
+
+import sqlite3 as sqlite
+
+from logging import info as log_info
+from os import listdir, stat
+from os.path import join as path_join
+from os.path import basename, dirname, isdir
+
+from annotation import JOINED_ANN_FILE_SUFF
+from jsonwrap import dumps, loads
+from stats import (generate_document_stats, get_stat_types,
+        get_stats_fingerprint, STATS_TIME_BUDGET, STATS_WORKERS)
+from workdir import (get_info, init_database, mark_changed, open_database,
+        set_info, take_changed, unicode_path, write_transaction)
+
+### Constants
+# Sub-directory of the work directory holding the manifests
+MANIFEST_DIR_NAME = 'manifest'
+# Bump this whenever the schema or the contents of the manifests change
+MANIFEST_VERSION = 3
+# Seconds to wait for other processes updating the same manifest
+MANIFEST_TIMEOUT = 30
+###
+
+_SCHEMA = (
+        # The mtime and size are those of the annotation file and the
+        # fingerprint that of the configuration the statistics (if any)
+        # were generated for, stale the number of times the document was
+        # invalidated since
+        'CREATE TABLE documents ('
+            'name TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+            'fingerprint TEXT, stats TEXT, '
+            'stale INTEGER NOT NULL DEFAULT 1)',
+        'CREATE TABLE collections ('
+            'name TEXT PRIMARY KEY)',
+        )
+
+
+def _is_hidden(file_name):
+    return file_name.startswith('hidden_') or file_name.startswith('.')
+
+
+def _connect(directory):
+    # Returns a connection to the manifest for the given directory, an
+    # in-memory one (that starts out empty) if it can not be stored
+    conn = open_database(MANIFEST_DIR_NAME, directory, _SCHEMA,
+            MANIFEST_VERSION, MANIFEST_TIMEOUT)
+    if conn is None:
+        conn = _connect_memory()
+    return conn
+
+
+def _connect_memory():
+    conn = sqlite.connect(':memory:')
+    init_database(conn, _SCHEMA, MANIFEST_VERSION)
+    return conn
+
+
+def _ann_identity(directory, name):
+    # The mtime and size of the annotation file of a document, -1 for both
+    # if there is none (or if we can not access it)
+    try:
+        st = stat(path_join(directory, name + '.' + JOINED_ANN_FILE_SUFF))
+    except OSError:
+        return -1, -1
+    return st.st_mtime, st.st_size
+
+
+def _sync_listing(conn, directory):
+    # List the directory again, adding and removing documents and
+    # sub-collections as needed and invalidating the documents whose
+    # annotation files changed since their statistics were generated, as
+    # whatever changed the directory may have changed them too
+    doc_names = set()
+    collection_names = []
+    for file_name in listdir(unicode_path(directory)):
+        if _is_hidden(file_name):
+            continue
+        if file_name.endswith('txt'):
+            doc_names.add(file_name[0:-4])
+        elif isdir(path_join(directory, file_name)):
+            collection_names.append(file_name)
+
+    known = {}
+    for name, mtime, size in conn.execute(
+            'SELECT name, mtime, size FROM documents'):
+        known[name] = (mtime, size)
+    conn.executemany('DELETE FROM documents WHERE name = ?',
+            ((name, ) for name in known if name not in doc_names))
+    conn.executemany('INSERT INTO documents (name) VALUES (?)',
+            ((name, ) for name in doc_names if name not in known))
+    conn.executemany('UPDATE documents SET stale = stale + 1 '
+            'WHERE name = ?', ((name, ) for name in doc_names
+                if name in known
+                and known[name] != _ann_identity(directory, name)))
+
+    conn.execute('DELETE FROM collections')
+    conn.executemany('INSERT INTO collections (name) VALUES (?)',
+            ((name, ) for name in collection_names))
+
+
+def _update_stats(conn, directory, stale, fingerprint, workers,
+        time_budget):
+    # Generate the statistics of the given documents (names to their stale
+    # counts), leaving those not done within the time budget for the next
+    # time. Must not be called inside a transaction: generating may take
+    # long and fork worker processes.
+    log_info('generating statistics for %d document(s) in "%s"' % (
+        len(stale), directory))
+    identities = dict((name, _ann_identity(directory, name))
+            for name in stale)
+    docstats = generate_document_stats(directory, stale.keys(), workers,
+            time_budget)
+    if len(docstats) < len(stale):
+        log_info('statistics for %d document(s) in "%s" left for later' % (
+            len(stale) - len(docstats), directory))
+
+    # Stored for the annotation files as they were before generating, a
+    # document invalidated meanwhile stays stale for the next refresh
+    with write_transaction(conn):
+        conn.executemany('UPDATE documents SET mtime = ?, size = ? '
+                'WHERE name = ?', (identities[name] + (name, )
+                    for name in stale if name not in docstats))
+        conn.executemany('UPDATE documents SET mtime = ?, size = ?, '
+                'fingerprint = ?, stats = ?, stale = stale - ? '
+                'WHERE name = ?',
+                (identities[name] + (fingerprint, dumps(doc_stats),
+                    stale[name], name)
+                    for name, doc_stats in docstats.iteritems()))
+
+
+def _refresh(conn, directory, workers, time_budget, changed):
+    # Bring the manifest up to date with the directory, the given documents
+    # having been invalidated since it last was
+    if changed:
+        with write_transaction(conn):
+            conn.executemany('UPDATE documents SET stale = stale + 1 '
+                    'WHERE name = ?', ((name, ) for name in changed))
+
+    # The ctime as well as the mtime, as restoring a directory (or a backup
+    # of it) may well have set its mtime back
+    st = stat(directory)
+    dir_identity = repr((st.st_mtime, st.st_ctime, st.st_ino))
+    if get_info(conn, 'dir_identity') != dir_identity:
+        with write_transaction(conn):
+            # Someone else may have updated it while we were waiting
+            if get_info(conn, 'dir_identity') != dir_identity:
+                _sync_listing(conn, directory)
+                set_info(conn, 'dir_identity', dir_identity)
+
+    fingerprint = get_stats_fingerprint(directory)
+    stale = dict(conn.execute('SELECT name, stale FROM documents '
+            'WHERE stale > 0 OR fingerprint IS NOT ?', (fingerprint, )))
+    if stale:
+        _update_stats(conn, directory, stale, fingerprint, workers,
+                time_budget)
+
+
+def get_manifest(directory, workers=STATS_WORKERS,
+        time_budget=STATS_TIME_BUDGET):
+    '''
+    Return the manifest for the given collection directory, brought up to
+    date, as a tuple of the statistics (name, type) column headers, the
+    documents as [name, mtime, statistic, ...] lists (the mtime of the
+    annotation file, -1 if missing) and the names of the sub-collections,
+    both sorted by name. Hidden files are left out, access control is up
+    to the caller.
+
+    Statistics are generated by the given number of worker processes (see
+    stats.generate_document_stats()) for at most time_budget seconds (if
+    not None). Documents left without statistics get -1 for all of them
+    (or their previous statistics, if any) until a later call.
+    '''
+    stat_types = get_stat_types(directory)
+    conn = _connect(directory)
+    changed = take_changed(MANIFEST_DIR_NAME, directory)
+    try:
+        try:
+            _refresh(conn, directory, workers, time_budget, changed)
+        except sqlite.Error, e:
+            # Locked for too long or some such, do without it this time
+            log_info('Could not update manifest for %s: %s' % (directory, e))
+            for name in changed:
+                # Still to be done for the stored one
+                mark_changed(MANIFEST_DIR_NAME, directory, name)
+            conn.close()
+            conn = _connect_memory()
+            _refresh(conn, directory, workers, time_budget, ())
+        documents = []
+        for name, mtime, stats in conn.execute(
+                'SELECT name, mtime, stats FROM documents ORDER BY name'):
+            stats = loads(stats) if stats is not None else None
+            if stats is None or len(stats) != len(stat_types):
+                stats = [-1] * len(stat_types)
+            if mtime is None:
+                # Listed by someone else since we refreshed
+                mtime = _ann_identity(directory, name)[0]
+            documents.append([name, mtime] + stats)
+        collections = [name for name, in conn.execute(
+                'SELECT name FROM collections ORDER BY name')]
+    finally:
+        conn.close()
+    return stat_types, documents, collections
+
+
+def invalidate_document(document):
+    '''
+    Mark the given document (path without suffix) as changed, for its
+    statistics to be generated again when its collection is next listed.
+    To be called once its annotations are written, never waits for the
+    manifest.
+    '''
+    mark_changed(MANIFEST_DIR_NAME, dirname(document), basename(document))
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import mkdir, remove, utime
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from annotation import TextAnnotations, TextBoundAnnotation
+    import workdir
+
+    class TestManifest(TestCase):
+        def setUp(self):
+            global generate_document_stats
+            self._work_dir = workdir.WORK_DIR
+            workdir.WORK_DIR = mkdtemp()
+            self._dir = mkdtemp()
+            self._write('a.txt', 'Abc def ghi.\n')
+            self._write('a.ann', 'T1\tProtein 4 7\tdef\n', 1000)
+            self._write('b.txt', 'Abc def ghi.\n')
+            self._write('hidden_c.txt', 'Abc def ghi.\n')
+            mkdir(path_join(self._dir, 'sub'))
+
+            # Keep track of the documents statistics are generated for
+            self.generated = []
+            self._generate_document_stats = generate_document_stats
+            def generate(directory, docnames, *args):
+                self.generated.extend(docnames)
+                return self._generate_document_stats(directory, docnames,
+                        *args)
+            generate_document_stats = generate
+
+        def tearDown(self):
+            global generate_document_stats
+            generate_document_stats = self._generate_document_stats
+            rmtree(workdir.WORK_DIR)
+            workdir.WORK_DIR = self._work_dir
+            rmtree(self._dir)
+
+        def _write(self, name, data, mtime=None):
+            path = path_join(self._dir, name)
+            with open(path, 'w') as f:
+                f.write(data)
+            if mtime is not None:
+                utime(path, (mtime, mtime))
+
+        def _manifest(self):
+            self.generated = []
+            return get_manifest(self._dir, workers=1)
+
+        def test_listing(self):
+            stat_types, documents, collections = self._manifest()
+            self.assertEqual(stat_types, [('Entities', 'int'),
+                ('Relations', 'int'), ('Events', 'int')])
+            self.assertEqual(documents, [['a', 1000, 1, 0, 0],
+                ['b', -1, 0, 0, 0]])
+            self.assertEqual(collections, ['sub'])
+            self.assertEqual(sorted(self.generated), ['a', 'b'])
+
+        def test_unchanged(self):
+            first = self._manifest()
+            self.assertEqual(self._manifest(), first)
+            self.assertEqual(self.generated, [])
+
+        def test_changed_in_place(self):
+            self._manifest()
+            # Not looked at unless invalidated
+            self._write('a.ann', 'T1\tProtein 8 11\tghi\n'
+                    'T2\tProtein 0 3\tAbc\n', 2000)
+            _, documents, _ = self._manifest()
+            self.assertEqual(documents[0], ['a', 1000, 1, 0, 0])
+            self.assertEqual(self.generated, [])
+            invalidate_document(path_join(self._dir, 'a'))
+            _, documents, _ = self._manifest()
+            self.assertEqual(documents[0], ['a', 2000, 2, 0, 0])
+            self.assertEqual(self.generated, ['a'])
+            self.assertEqual(self._manifest()[1], documents)
+            self.assertEqual(self.generated, [])
+
+        def test_written(self):
+            self._manifest()
+            # Annotations invalidate what they write
+            with TextAnnotations(path_join(self._dir, 'a')) as ann_obj:
+                ann_obj.add_annotation(TextBoundAnnotation([(0, 3)], 'T2',
+                    'Protein', '\tAbc'))
+            _, documents, _ = self._manifest()
+            self.assertEqual(documents[0][2:], [2, 0, 0])
+            self.assertEqual(self.generated, ['a'])
+
+        def test_changed_with_directory(self):
+            self._manifest()
+            # Whatever changes the directory may have changed the others
+            self._write('b.ann', 'T1\tProtein 0 3\tAbc\n', 2000)
+            _, documents, _ = self._manifest()
+            self.assertEqual(documents[1], ['b', 2000, 1, 0, 0])
+            self.assertEqual(self.generated, ['b'])
+
+        def test_added_and_removed(self):
+            self._manifest()
+            remove(path_join(self._dir, 'b.txt'))
+            self._write('d.txt', 'Abc def ghi.\n')
+            _, documents, _ = self._manifest()
+            self.assertEqual([d[0] for d in documents], ['a', 'd'])
+            self.assertEqual(self.generated, ['d'])
+
+        def test_configuration_changed(self):
+            global get_stats_fingerprint
+            self._manifest()
+            fingerprint = get_stats_fingerprint
+            get_stats_fingerprint = lambda directory: 'changed'
+            try:
+                self._manifest()
+            finally:
+                get_stats_fingerprint = fingerprint
+            self.assertEqual(sorted(self.generated), ['a', 'b'])
+
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+from __future__ import with_statement
+
+'''
+Read-only access to the text of a UTF-8 encoded document without reading
+and decoding all of it up front, for long (e.g. book-length) texts where
+a request only needs the text of a handful of spans.
+
+The file is memory-mapped and a sparse index maps character offsets to
+byte offsets every MAPPED_TEXT_BLOCK_SIZE bytes. Slicing decodes only the
+blocks covering the slice. Offsets are the same as for the decoded text
+as read by open_textfile: code points as represented by this Python
+build (i.e. counting surrogate pairs as two on narrow builds), with no
+newline translation.
+'''
+
+from array import array
+from bisect import bisect_right
+from mmap import mmap, ACCESS_READ
+from sys import maxunicode
+
+### Constants
+# Number of bytes between the entries of the character offset index, a
+# slice decodes at most this many bytes more than it needs to
+MAPPED_TEXT_BLOCK_SIZE = 4096
+###
+
+# Bytes other than UTF-8 continuation bytes (0x80-0xBF), every such byte
+# starts a character
+_NON_CONTINUATION_BYTES = ''.join(chr(b) for b in range(256)
+        if not 0x80 <= b <= 0xBF)
+# Bytes other than the lead bytes of four-byte sequences, the characters
+# that need a surrogate pair on narrow builds
+_NON_FOUR_BYTE_LEAD_BYTES = ''.join(chr(b) for b in range(256)
+        if not 0xF0 <= b <= 0xF7)
+
+
+def _char_count(data):
+    # The number of code points the given UTF-8 bytes decode into
+    count = len(data) - len(data.translate(None, _NON_CONTINUATION_BYTES))
+    if maxunicode == 0xFFFF:
+        count += len(data.translate(None, _NON_FOUR_BYTE_LEAD_BYTES))
+    return count
+
+
+class MappedText(object):
+    """
+    The text of a UTF-8 encoded file, supporting len(), slicing and
+    unicode() like the unicode string read from it would.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as text_file:
+            # NOTE: Can not map an empty file, the caller should check
+            self._map = mmap(text_file.fileno(), 0, access=ACCESS_READ)
+        self._text = None
+
+        # Character offset at the start of every block, and the byte offset
+        # of the block, moved forward to the next character boundary
+        self._block_byte_offsets = array('l')
+        self._block_char_offsets = array('l')
+        char_offset = 0
+        prev_byte_offset = 0
+        size = len(self._map)
+        for byte_offset in xrange(0, size, MAPPED_TEXT_BLOCK_SIZE):
+            while (byte_offset < size
+                    and 0x80 <= ord(self._map[byte_offset]) <= 0xBF):
+                byte_offset += 1
+            char_offset += _char_count(
+                    self._map[prev_byte_offset:byte_offset])
+            self._block_byte_offsets.append(byte_offset)
+            self._block_char_offsets.append(char_offset)
+            prev_byte_offset = byte_offset
+        self._len = char_offset + _char_count(self._map[prev_byte_offset:])
+
+    def __len__(self):
+        return self._len
+
+    def _decode(self, start, end):
+        # Decode just the blocks covering the [start, end) character range
+        first = bisect_right(self._block_char_offsets, start) - 1
+        last = bisect_right(self._block_char_offsets, end)
+        byte_start = self._block_byte_offsets[first]
+        if last < len(self._block_byte_offsets):
+            byte_end = self._block_byte_offsets[last]
+        else:
+            byte_end = len(self._map)
+        text = self._map[byte_start:byte_end].decode('utf-8')
+        char_start = self._block_char_offsets[first]
+        return text[start - char_start:end - char_start]
+
+    def __getitem__(self, key):
+        if self._text is not None:
+            return self._text[key]
+
+        if isinstance(key, slice):
+            start, end, step = key.indices(self._len)
+            if step != 1:
+                return unicode(self)[key]
+            if start >= end:
+                return u''
+            return self._decode(start, end)
+
+        if key < 0:
+            key += self._len
+        if not 0 <= key < self._len:
+            raise IndexError('text index out of range')
+        return self._decode(key, key + 1)
+
+    def __getslice__(self, start, end):
+        # Python 2 still uses this for simple slices
+        return self.__getitem__(slice(start, end))
+
+    def __unicode__(self):
+        # The whole text, only decoded once it is asked for
+        if self._text is None:
+            self._text = self._map[:].decode('utf-8')
+        return self._text
+
+    def close(self):
+        self._map.close()
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import close, remove
+    from tempfile import mkstemp
+
+    class TestMappedText(TestCase):
+        def setUp(self):
+            self._text = (u'Plain ASCII, \u00e5\u00e4\u00f6 two bytes, '
+                    u'\u65e5\u672c three bytes, \U0001F600 four bytes\n') * 400
+            handle, self._path = mkstemp()
+            close(handle)
+            with open(self._path, 'wb') as text_file:
+                text_file.write(self._text.encode('utf-8'))
+
+        def tearDown(self):
+            remove(self._path)
+
+        def test_len(self):
+            self.assertEqual(len(MappedText(self._path)), len(self._text))
+
+        def test_slices(self):
+            mapped = MappedText(self._path)
+            step = len(self._text) / 97
+            for start in xrange(0, len(self._text), step):
+                for length in (0, 1, 7, MAPPED_TEXT_BLOCK_SIZE + 3):
+                    self.assertEqual(mapped[start:start + length],
+                            self._text[start:start + length])
+            self.assertEqual(mapped[-5:], self._text[-5:])
+            self.assertEqual(mapped[:-5], self._text[:-5])
+            self.assertEqual(mapped[13], self._text[13])
+            self.assertEqual(mapped[-1], self._text[-1])
+
+        def test_unicode(self):
+            self.assertEqual(unicode(MappedText(self._path)), self._text)
+
+    unittest.main()
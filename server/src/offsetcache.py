@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Persistent cache of the token and sentence offsets of document texts.
+
+Tokenising and sentence splitting a text is costly (in particular with the
+PTB-like tokeniser) while texts rarely change once imported, so the offsets
+are stored under WORK_DIR keyed by a hash of the text (or by the identity
+of the text file, for the offsets to be found without reading the text)
+and the names of the tokeniser and sentence splitter used. The offsets are stored as a flat
+array of integers rather than pickled, as a long text has millions of them.
+'''
+
+from array import array
+from hashlib import sha1
+from os import stat
+from os.path import join as path_join
+from os.path import abspath
+from sys import byteorder
+
+from workdir import WORK_DIR, write_cache_file
+
+try:
+    from config import OFFSET_CACHE_SIZE
+except ImportError:
+    OFFSET_CACHE_SIZE = 4096
+
+### Constants
+# Sub-directory of the work directory holding the cached offsets
+OFFSET_CACHE_DIR_NAME = 'offset_cache'
+# Bump this whenever the tokenisers or sentence splitters change in a way
+# that makes previously cached offsets invalid
+OFFSET_CACHE_VERSION = 1
+# Type code of the arrays the offsets are stored in
+OFFSET_TYPECODE = 'i'
+###
+
+# If True, the token and sentence offsets of texts are cached under
+# WORK_DIR
+USE_OFFSET_CACHE = True
+
+
+def _text_key(text):
+    return sha1(text.encode('utf-8')).hexdigest()
+
+
+def _file_key(path):
+    st = stat(path)
+    return (abspath(path), st.st_mtime, st.st_size)
+
+
+def _offset_cache_path(key, tokeniser, ssplitter):
+    # The arrays are stored as they are in memory
+    key_hash = sha1(repr((OFFSET_CACHE_VERSION, key, tokeniser,
+        ssplitter, OFFSET_TYPECODE, array(OFFSET_TYPECODE).itemsize,
+        byteorder))).hexdigest()
+    return path_join(WORK_DIR, OFFSET_CACHE_DIR_NAME, key_hash)
+
+
+def _pairs(flat):
+    return [(flat[i], flat[i + 1]) for i in xrange(0, len(flat), 2)]
+
+
+def _cache_usable(tokeniser, ssplitter):
+    return (USE_OFFSET_CACHE and WORK_DIR is not None
+            and tokeniser is not None and ssplitter is not None)
+
+
+def _load(key, text_len, tokeniser, ssplitter):
+    try:
+        with open(_offset_cache_path(key, tokeniser, ssplitter),
+                'rb') as cache_file:
+            # Header: version, text length, number of tokens and sentences
+            header = array(OFFSET_TYPECODE)
+            header.fromfile(cache_file, 4)
+            version, cached_text_len, tok_count, sent_count = header
+            if (version != OFFSET_CACHE_VERSION
+                    or cached_text_len != text_len):
+                return None
+            offsets = array(OFFSET_TYPECODE)
+            offsets.fromfile(cache_file, 2 * (tok_count + sent_count))
+    except (IOError, OSError, EOFError):
+        # Missing or truncated, re-compute
+        return None
+
+    return (_pairs(offsets[:2 * tok_count]), _pairs(offsets[2 * tok_count:]))
+
+
+def _store(key, text_len, tokeniser, ssplitter, token_offsets,
+        sentence_offsets):
+    offsets = array(OFFSET_TYPECODE, (OFFSET_CACHE_VERSION, text_len,
+        len(token_offsets), len(sentence_offsets)))
+    for start, end in token_offsets:
+        offsets.append(start)
+        offsets.append(end)
+    for start, end in sentence_offsets:
+        offsets.append(start)
+        offsets.append(end)
+
+    write_cache_file(_offset_cache_path(key, tokeniser, ssplitter),
+            offsets.tostring(), OFFSET_CACHE_SIZE)
+
+
+def load_offsets(text, tokeniser, ssplitter):
+    '''
+    Return the cached (token_offsets, sentence_offsets) for the given text
+    as split by the given tokeniser and sentence splitter, or None if not
+    cached (or if caching is turned off, or not possible, for either).
+    '''
+    if not _cache_usable(tokeniser, ssplitter):
+        return None
+    return _load(_text_key(text), len(text), tokeniser, ssplitter)
+
+
+def store_offsets(text, tokeniser, ssplitter, token_offsets,
+        sentence_offsets):
+    '''
+    Store the (start, end) token and sentence offsets of the given text as
+    split by the given tokeniser and sentence splitter.
+    '''
+    if not _cache_usable(tokeniser, ssplitter):
+        return
+    _store(_text_key(text), len(text), tokeniser, ssplitter, token_offsets,
+            sentence_offsets)
+
+
+def load_file_offsets(path, text_len, tokeniser, ssplitter):
+    '''
+    As load_offsets(), for the text (of the given length) of the given
+    text file as it is now, without the text: the offsets are those
+    stored by store_file_offsets() for the file with the same
+    modification time and size.
+    '''
+    if not _cache_usable(tokeniser, ssplitter):
+        return None
+    try:
+        key = _file_key(path)
+    except OSError:
+        return None
+    return _load(key, text_len, tokeniser, ssplitter)
+
+
+def store_file_offsets(path, text_len, tokeniser, ssplitter, token_offsets,
+        sentence_offsets):
+    '''
+    As store_offsets(), for the text (of the given length) of the given
+    text file as it is now, see load_file_offsets().
+    '''
+    if not _cache_usable(tokeniser, ssplitter):
+        return
+    try:
+        key = _file_key(path)
+    except OSError:
+        # Gone, nothing to find them by
+        return
+    _store(key, text_len, tokeniser, ssplitter, token_offsets,
+            sentence_offsets)
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import utime
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    class TestOffsetCache(TestCase):
+        def setUp(self):
+            global WORK_DIR
+            self._work_dir = WORK_DIR
+            WORK_DIR = mkdtemp()
+            self._text = u'Hello world. Goodbye \u00e5 world.\n' * 3
+            self._tokens = [(0, 5), (6, 12), (13, 20), (21, 22), (23, 29)]
+            self._sentences = [(0, 12), (13, 29)]
+
+        def tearDown(self):
+            global WORK_DIR
+            rmtree(WORK_DIR)
+            WORK_DIR = self._work_dir
+
+        def test_round_trip(self):
+            self.assertEqual(load_offsets(self._text, 'a', 'b'), None)
+            store_offsets(self._text, 'a', 'b', self._tokens,
+                    self._sentences)
+            self.assertEqual(load_offsets(self._text, 'a', 'b'),
+                    (self._tokens, self._sentences))
+
+        def test_keyed_by_text_and_options(self):
+            store_offsets(self._text, 'a', 'b', self._tokens,
+                    self._sentences)
+            self.assertEqual(load_offsets(self._text[1:], 'a', 'b'), None)
+            self.assertEqual(load_offsets(self._text, 'c', 'b'), None)
+            self.assertEqual(load_offsets(self._text, 'a', 'c'), None)
+
+        def test_empty(self):
+            store_offsets(u'', 'a', 'b', [], [])
+            self.assertEqual(load_offsets(u'', 'a', 'b'), ([], []))
+
+        def test_file(self):
+            text_dir = mkdtemp()
+            try:
+                path = path_join(text_dir, 'a.txt')
+                with open(path, 'w') as text_file:
+                    text_file.write(self._text.encode('utf-8'))
+                utime(path, (1000, 1000))
+                self.assertEqual(load_file_offsets(path, len(self._text),
+                    'a', 'b'), None)
+                store_file_offsets(path, len(self._text), 'a', 'b',
+                        self._tokens, self._sentences)
+                self.assertEqual(load_file_offsets(path, len(self._text),
+                    'a', 'b'), (self._tokens, self._sentences))
+                # Not for the text, nor once the file changes
+                self.assertEqual(load_offsets(self._text, 'a', 'b'), None)
+                utime(path, (2000, 2000))
+                self.assertEqual(load_file_offsets(path, len(self._text),
+                    'a', 'b'), None)
+            finally:
+                rmtree(text_dir)
+
+        def test_truncated(self):
+            store_offsets(self._text, 'a', 'b', self._tokens,
+                    self._sentences)
+            cache_path = _offset_cache_path(_text_key(self._text), 'a',
+                    'b')
+            with open(cache_path, 'rb') as cache_file:
+                data = cache_file.read()
+            with open(cache_path, 'wb') as cache_file:
+                cache_file.write(data[:-4])
+            self.assertEqual(load_offsets(self._text, 'a', 'b'), None)
+
+    unittest.main()
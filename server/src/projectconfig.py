@@ -532,6 +532,33 @@ def __parse_access_control(acstr, source):
 def get_config_path(directory):
     return __read_first_in_directory_tree(directory, __annotation_config_filename)[1]
 
+def get_config_file_paths(directory):
+    '''
+    Return the paths of every configuration file that may apply to the
+    given directory, whether it exists or not: those in the directory and
+    its parents (as searched by __read_first_in_directory_tree()) followed
+    by the fallbacks read when none of those exist.
+    '''
+    try:
+        from config import BASE_DIR
+    except:
+        BASE_DIR = "/"
+    from os.path import split, join
+
+    filenames = (__access_control_filename, __annotation_config_filename,
+            __visual_config_filename, __tools_config_filename,
+            __kb_shortcut_filename)
+
+    paths = []
+    while directory is not None and BASE_DIR in directory:
+        paths.extend(join(directory, f) for f in filenames)
+        parent = split(directory)[0]
+        if parent == directory:
+            break
+        directory = parent
+    paths.extend(filenames)
+    return paths
+
 def __read_first_in_directory_tree(directory, filename):
     # config will not be available command-line invocations;
     # in these cases search whole tree
@@ -7,6 +7,9 @@ import tempfile
 
 from os.path import join as path_join
 
+from annotation import (iter_annotations, EventAnnotation,
+        NormalizationAnnotation, BinaryRelationAnnotation,
+        TextBoundAnnotation, AttributeAnnotation)
 from config import DATA_DIR
 from document import real_directory
 from message import Messager
@@ -44,6 +47,9 @@ def create_rdf_file(collection, document):
     (tmp_fh, tmp_name) = tempfile.mkstemp()
     os.close(tmp_fh)
 
+    if isinstance(rdf_string, unicode):
+        rdf_string = rdf_string.encode('utf-8')
+
     tmp_file = open(tmp_name, 'w')
     tmp_file.write(rdf_string)
     tmp_file.close()
@@ -85,155 +91,154 @@ def get_rdf_parts(fpath, document):
     for prefix, url in namespace_info['namespaces'].items():
         parts['prefixes'].append(prefix + ': <' + url + '>')
 
-    with open(fpath) as txt_file:
-        entity_data = {}
-        global_data = {}
-        global_links = {}
-        default_context_uri = ''
-        
-        
-#        for line in txt_file:
-#            chunks = re.split(r'\s+', line.strip())
-#            
-#            for global_class, global_property in namespace_info['global_classes'].items():
-#            
-#                if chunks[1] == global_class and not(global_class in context_data):
-#                    global_data[chunks[0]] = "<" + namespace + chunks[0] + ">"
-#                    
-#                if chunks[1] == global_property:
-#                    arg1 = chunks[2].split(":")[1]
-#                    arg2 = chunks[3].split(":")[1]
-#                    
-#                    rel = {global_property:arg2}
-#                    
-#                    global_links[arg1] = [rel]
-#                    
-#                if chunks[1] == "Default" and chunks[2] in global_data:
-#                    default_context_uri = "<" + namespace + chunks[2] + ">"
-#                    
-#        if default_context_uri == '' and len(global_data) == 1:
-#            default_context_uri = global_data.values()[0]
-                    
+    entity_data = {}
+    global_data = {}
+    global_links = {}
+    default_context_uri = ''
     
-        for line in txt_file:
-
-            chunks = re.split(r'\s+', line.strip())
+    
+#    for line in txt_file:
+#        chunks = re.split(r'\s+', line.strip())
+#        
+#        for global_class, global_property in namespace_info['global_classes'].items():
+#        
+#            if chunks[1] == global_class and not(global_class in context_data):
+#                global_data[chunks[0]] = "<" + namespace + chunks[0] + ">"
+#                
+#            if chunks[1] == global_property:
+#                arg1 = chunks[2].split(":")[1]
+#                arg2 = chunks[3].split(":")[1]
+#                
+#                rel = {global_property:arg2}
+#                
+#                global_links[arg1] = [rel]
+#                
+#            if chunks[1] == "Default" and chunks[2] in global_data:
+#                default_context_uri = "<" + namespace + chunks[2] + ">"
+#                
+#    if default_context_uri == '' and len(global_data) == 1:
+#        default_context_uri = global_data.values()[0]
+                
 
-            if line[0] == 'E':
+    for ann in iter_annotations(fpath, kinds='ENRTA'):
 
-                event = chunks[1]
+        if isinstance(ann, EventAnnotation):
 
-                event_id = event.split(':')[1]
-                event_type = event.split(':')[0]
+            event_id = ann.trigger
+            event_type = ann.type
 
-                parts['data'] += "<" + namespace + event_id + ">\n\ta "
+            parts['data'] += "<" + namespace + event_id + ">\n\ta "
 
-                if lookup(event_type, namespace_info) != False:
-                    parts['data'] += lookup(event_type, namespace_info) + ";\n"
+            if lookup(event_type, namespace_info) != False:
+                parts['data'] += lookup(event_type, namespace_info) + ";\n"
 
-                for chunk in chunks[2:]:
-                    if ':' in chunk and lookup(chunk.split(':')[0], namespace_info) != False:
-                        parts['data'] += "\t" + lookup(chunk.split(':')[0], namespace_info) + " <" + namespace + chunk.split(':')[1] + ">;\n"
-                    elif ':' in chunk:
-                        parts['data'] += "\t" + get_long_rdf(chunk.split(':')[0], namespace_info, namespace + chunk.split(':')[1]) + ";\n"
+            for arg in ann.args:
+                if len(arg) < 2:
+                    continue
+                role, arg_id = arg[0], arg[1]
+                if lookup(role, namespace_info) != False:
+                    parts['data'] += "\t" + lookup(role, namespace_info) + " <" + namespace + arg_id + ">;\n"
+                else:
+                    parts['data'] += "\t" + get_long_rdf(role, namespace_info, namespace + arg_id) + ";\n"
 
-                parts['data'] += '\trdfs:label "' + chunks[0] + '" .\n\n'
+            parts['data'] += '\trdfs:label "' + ann.id + '" .\n\n'
 
-            elif line[0] == 'N':
+        elif isinstance(ann, NormalizationAnnotation):
 
-                normalised = chunks[3].split(':', 1)[1]
-                dbname = chunks[3].split(':', 1)[0]
+            normalised = ann.refid
+            dbname = ann.refdb
 
-                if get_norm_type_by_id(dbname, normalised) == 'global':
-                    # If link is directly to global entity then need to create local entity for sameAs
-                    # and the link to global entity with shadow-of relationship
+            if get_norm_type_by_id(dbname, normalised) == 'global':
+                # If link is directly to global entity then need to create local entity for sameAs
+                # and the link to global entity with shadow-of relationship
 
-                    entity_name = normalised.split('/')[-1]
-                    
-                    parts['data'] += "<" + namespace + entity_name + "> ome:shadow-of <" + normalised + ">.\n\n"
+                entity_name = normalised.split('/')[-1]
+                
+                parts['data'] += "<" + namespace + entity_name + "> ome:shadow-of <" + normalised + ">.\n\n"
 
-                    parts['data'] += "<" + namespace + chunks[2] + "> owl:sameAs <" + namespace + entity_name + ">;\n"
+                parts['data'] += "<" + namespace + ann.target + "> owl:sameAs <" + namespace + entity_name + ">;\n"
 
-                    if normalised not in entity_data:
-                        entity_data[normalised] = data_by_id(dbname, normalised)
+                if normalised not in entity_data:
+                    entity_data[normalised] = data_by_id(dbname, normalised)
 
-                else:
+            else:
 
-                    parts['data'] += "<" + namespace + chunks[2] + "> owl:sameAs <" + normalised + ">" 
-                    # Check if local entity is linked to global entity - if so add in shadow-of relationship
+                parts['data'] += "<" + namespace + ann.target + "> owl:sameAs <" + normalised + ">" 
+                # Check if local entity is linked to global entity - if so add in shadow-of relationship
 
-                    global_id = get_linked_global_entity(dbname, normalised)
+                global_id = get_linked_global_entity(dbname, normalised)
+                
+                if len(global_id) < 1:
+                    parts['data'] += ";\n\n"
+                else:
+                    parts['data'] += ".\n\n"
+                    
+                    for uid in global_id:
+                        parts['data'] += "<" + normalised + "> ome:shadow-of <" + uid + ">;\n"
                     
-                    if len(global_id) < 1:
-                        parts['data'] += ";\n\n"
-                    else:
-                        parts['data'] += ".\n\n"
-                        
-                        for uid in global_id:
-                            parts['data'] += "<" + normalised + "> ome:shadow-of <" + uid + ">;\n"
-                        
-                        if uid not in entity_data:
-                            entity_data[uid] = data_by_id(dbname, uid)
+                    if uid not in entity_data:
+                        entity_data[uid] = data_by_id(dbname, uid)
 
-                parts['data'] += '\trdfs:label "' + chunks[0] + '" .\n\n'
+            parts['data'] += '\trdfs:label "' + ann.id + '" .\n\n'
 
 
-            elif line[0] == 'R':
+        elif isinstance(ann, BinaryRelationAnnotation):
 
-                parts['data'] += "<" + namespace + chunks[2].split(":")[1] + "> "
+            parts['data'] += "<" + namespace + ann.arg1 + "> "
 
-                if lookup(chunks[1], namespace_info) != False:
-                    parts['data'] += lookup(chunks[1], namespace_info) + " " + "<" + namespace + chunks[3].split(":")[1] + ">;\n"
-                else:
-                    parts['data'] += get_long_rdf(chunks[1], namespace_info,'', chunks[3].split(":")[1], namespace)
+            if lookup(ann.type, namespace_info) != False:
+                parts['data'] += lookup(ann.type, namespace_info) + " " + "<" + namespace + ann.arg2 + ">;\n"
+            else:
+                parts['data'] += get_long_rdf(ann.type, namespace_info,'', ann.arg2, namespace)
 
-                parts['data'] += '\trdfs:label "' + chunks[0] + '" .\n\n'
+            parts['data'] += '\trdfs:label "' + ann.id + '" .\n\n'
 
-            elif line[0] == 'T':
-                line_string = " ".join(chunks[4:])
+        elif isinstance(ann, TextBoundAnnotation):
+            line_string = " ".join(ann.tail.split())
 
-                parts['data'] += "<" + namespace + chunks[0] + ">\n\ta "
-                if lookup(chunks[1], namespace_info) != False:
-                    parts['data'] += lookup(chunks[1], namespace_info)
-                
-                
-                if line_string.strip() != '':
-                    line_string = line_string.replace('"', '\\"')
-                    parts['data'] += " ;\n"
-                    parts['data'] += '\tcnt:chars "' + line_string.strip() + '" .\n\n'
-                else:
-                    parts['data'] += " .\n\n"
-                
+            parts['data'] += "<" + namespace + ann.id + ">\n\ta "
+            if lookup(ann.type, namespace_info) != False:
+                parts['data'] += lookup(ann.type, namespace_info)
+            
+            
+            if line_string.strip() != '':
+                line_string = line_string.replace('"', '\\"')
+                parts['data'] += " ;\n"
+                parts['data'] += '\tcnt:chars "' + line_string.strip() + '" .\n\n'
+            else:
+                parts['data'] += " .\n\n"
+            
 
-            elif line[0] == 'A' and len(chunks) > 3:
+        elif isinstance(ann, AttributeAnnotation) and ann.value is not True:
+        
+            values = ann.value.split()
+            get_lookup = lookup(ann.type, namespace_info)
             
-                get_lookup = lookup(chunks[1], namespace_info)
-                
-                if (get_lookup == chunks[1]):
-                    get_lookup = 'a ' + lookup(chunks[3], namespace_info)
-                elif (get_lookup == False):
-                    get_lookup = get_long_rdf(chunks[1], namespace_info, chunks[3:]) 
-                else:
-                    get_lookup = 'a ' + get_lookup
-                
-                
-                parts['data'] += "<" + namespace + chunks[2] + ">\n\t " + get_lookup + ";\n"
-                parts['data'] += '\trdfs:label "' + chunks[0] + '" .\n\n'
+            if (get_lookup == ann.type):
+                get_lookup = 'a ' + lookup(values[0], namespace_info)
+            elif (get_lookup == False):
+                get_lookup = get_long_rdf(ann.type, namespace_info, values) 
+            else:
+                get_lookup = 'a ' + get_lookup
+            
+            
+            parts['data'] += "<" + namespace + ann.target + ">\n\t " + get_lookup + ";\n"
+            parts['data'] += '\trdfs:label "' + ann.id + '" .\n\n'
 
-        if len(entity_data) > 0:
+    if len(entity_data) > 0:
 
-            #for row in entity_data:
-            for key, value in entity_data.iteritems():
+        #for row in entity_data:
+        for key, value in entity_data.iteritems():
 
-                parts['data'] += "<" + key + ">\n"
+            parts['data'] += "<" + key + ">\n"
 
-                for data in value:
-                    for data_tuple in data:
-                        if data_tuple[0] == 'Name':
-                            parts['data'] += '\trdfs:label "' + data_tuple[1] + '";\n'
-                        elif data_tuple[0] == 'Category':
-                            parts['data'] += '\ta ' + lookup(data_tuple[1], namespace_info) + ' .\n\n'
-                                
+            for data in value:
+                for data_tuple in data:
+                    if data_tuple[0] == 'Name':
+                        parts['data'] += '\trdfs:label "' + data_tuple[1] + '";\n'
+                    elif data_tuple[0] == 'Category':
+                        parts['data'] += '\ta ' + lookup(data_tuple[1], namespace_info) + ' .\n\n'
+                            
     return parts
 
 
@@ -51,6 +51,20 @@ class Messager:
             print >> o, c, ":", m
     output = staticmethod(output)
 
+    def take_pending():
+        # Remove the messages pending and return them, as they are, for
+        # put_pending() (unlike output_json(), which also merges them)
+        pending = Messager.__pending_messages
+        Messager.__pending_messages = []
+        return pending
+    take_pending = staticmethod(take_pending)
+
+    def put_pending(messages):
+        # Add messages taken by take_pending() after those pending, also
+        # as read back from JSON
+        Messager.__pending_messages.extend([tuple(m) for m in messages])
+    put_pending = staticmethod(put_pending)
+
     def output_json(json_dict):
         try:
             return Messager.__output_json(json_dict)
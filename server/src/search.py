@@ -8,8 +8,12 @@
 from __future__ import with_statement
 
 import re
+import annindex
 import annotation
 
+from time import time
+
+from common import ProtocolArgumentError
 from message import Messager
 
 ### Constants
@@ -31,6 +35,26 @@ except ImportError:
     # unlimited
     MAX_SEARCH_RESULT_NUMBER = -1
 
+# Searches in collections of many documents are spread over worker
+# processes, and may be limited in time
+try:
+    from config import SEARCH_WORKERS
+except ImportError:
+    # As many as there are CPUs
+    SEARCH_WORKERS = None
+
+try:
+    from config import SEARCH_TIME_BUDGET
+except ImportError:
+    SEARCH_TIME_BUDGET = None
+
+### Constants
+# Below this many documents searching in a single process is faster
+PARALLEL_SEARCH_MIN_DOCUMENTS = 32
+# Documents searched by a worker process at a time
+SEARCH_SHARD_DOCUMENTS = 8
+###
+
 # TODO: nested_types restriction not consistently enforced in
 # searches.
 
@@ -46,12 +70,19 @@ class SearchMatchSet(object):
             matches = []
         self.criterion = criterion
         self.__matches = matches
+        # for a page of matches, the next page if there may be more
+        # (see __search_page())
+        self.next_page = None
+        # whether sorted by document name, to be kept so as matches are
+        # added (see __search_filenames())
+        self.by_document = False
 
     def add_match(self, ann_obj, ann):
         self.__matches.append((ann_obj, ann))
 
     def sort_matches(self):
         # sort by document name
+        self.by_document = True
         self.__matches.sort(lambda a,b: cmp(a[0].get_document(),b[0].get_document()))
 
     def limit_to(self, num):
@@ -144,30 +175,40 @@ class NoteMatch(object):
     def __str__(self):
         assert False, "INTERNAL ERROR: not implemented"
 
-def __filenames_to_annotations(filenames):
+def __filename_to_annotations(fn):
     """
-    Given file names, returns corresponding Annotations objects.
+    Given a file name, returns the corresponding Annotations object,
+    or None if it cannot be read.
     """
-    
+
     # TODO: error output should be done via messager to allow
     # both command-line and GUI invocations
 
+    try:
+        # remove suffixes for Annotations to prompt parsing of all
+        # annotation files.
+        nosuff_fn = fn.replace(".ann","").replace(".a1","").replace(".a2","").replace(".rel","")
+        return annotation.TextAnnotations(nosuff_fn, read_only=True)
+    except annotation.AnnotationFileNotFoundError:
+        print >> sys.stderr, "%s:\tFailed: file not found" % fn
+    except annotation.AnnotationNotFoundError, e:
+        print >> sys.stderr, "%s:\tFailed: %s" % (fn, e)
+    return None
+
+def __filenames_to_annotations(filenames):
+    """
+    Given file names, returns corresponding Annotations objects.
+    """
+    
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
 
     anns = []
     for fn in filenames:
-        try:
-            # remove suffixes for Annotations to prompt parsing of all
-            # annotation files.
-            nosuff_fn = fn.replace(".ann","").replace(".a1","").replace(".a2","").replace(".rel","")
-            ann_obj = annotation.TextAnnotations(nosuff_fn, read_only=True)
+        ann_obj = __filename_to_annotations(fn)
+        if ann_obj is not None:
             anns.append(ann_obj)
-        except annotation.AnnotationFileNotFoundError:
-            print >> sys.stderr, "%s:\tFailed: file not found" % fn
-        except annotation.AnnotationNotFoundError, e:
-            print >> sys.stderr, "%s:\tFailed: %s" % (fn, e)
 
     if len(anns) != len(filenames):
         print >> sys.stderr, "Note: only checking %d/%d given files" % (len(anns), len(filenames))
@@ -233,6 +274,339 @@ def __doc_or_dir_to_annotations(directory, document, scope):
         Messager.error('Unrecognized search scope specification %s' % scope)
         return []
 
+def __collection_filenames(directory, names=None):
+    """
+    Given a directory and optionally a set of names of documents in
+    it (in unicode, as found in an index), returns the file names of
+    the (named) documents in the directory, in the order of a search
+    through all of them.
+    """
+    from document import real_directory,_listdir
+    from os.path import join as path_join
+
+    real_dir = real_directory(directory)
+    base_names = [fn[0:-4] for fn in _listdir(real_dir) if fn.endswith('txt')]
+
+    return [path_join(real_dir, bn) for bn in base_names
+            if names is None or _unicode_name(bn) in names]
+
+def __iter_filenames_to_annotations(filenames, deadline=None):
+    """
+    Given file names, generates the corresponding Annotations objects,
+    reading each file only once it is needed, until the given deadline
+    (a time()) if any.
+    """
+
+    for i, fn in enumerate(filenames):
+        if deadline is not None and time() >= deadline:
+            Messager.warning('Search time limit exceeded, searched %d of %d documents.' % (i, len(filenames)))
+            break
+        ann_obj = __filename_to_annotations(fn)
+        if ann_obj is not None:
+            yield ann_obj
+
+def _search_shard(job):
+    """
+    Helper for _execute_search(), run in the worker processes. Given
+    the name of a search_anns_for_ function, the position of the first
+    of the given file names and the arguments to search with, returns
+    the (position, match references) of the documents with matches
+    (see _match_references()).
+    """
+    matcher_name, first, filenames, args, kwargs = job
+    matcher = globals()[matcher_name]
+    # workers look for all matches, the limit applies to their total
+    kwargs = dict(kwargs, max_results=-1)
+
+    found = []
+    for i, fn in enumerate(filenames):
+        # one at a time, for the matches to be told apart by document
+        ann_obj = __filename_to_annotations(fn)
+        if ann_obj is None:
+            continue
+        doc_matches = matcher([ann_obj], *args, **kwargs).get_matches()
+        if len(doc_matches) != 0:
+            found.append((first + i, _match_references(ann_obj, doc_matches)))
+    return found
+
+def _match_references(ann_obj, matches):
+    """
+    Given the matches of a search in the given Annotations object,
+    returns references to them that can be passed between processes:
+    the (line, id) of the annotations in the document and the text
+    matches as they are.
+    """
+    lines = dict((id(ann), i) for i, ann in enumerate(ann_obj))
+    references = []
+    for _, ann in matches:
+        if isinstance(ann, TextMatch):
+            references.append(ann)
+        else:
+            references.append((lines[id(ann)], getattr(ann, 'id', None)))
+    return references
+
+def _resolve_references(ann_obj, references):
+    """
+    Inverse of _match_references(), returns the matches referred to in
+    the given Annotations object, or None if its annotations are no
+    longer those referred to.
+    """
+    matches = []
+    for reference in references:
+        if isinstance(reference, TextMatch):
+            matches.append((ann_obj, reference))
+            continue
+        line, ann_id = reference
+        if line >= len(ann_obj) or getattr(ann_obj[line], 'id', None) != ann_id:
+            return None
+        matches.append((ann_obj, ann_obj[line]))
+    return matches
+
+def _search_workers(filenames, workers=None):
+    """
+    Returns the number of worker processes to search the given files
+    with, up to the given number (SEARCH_WORKERS if None), or None if
+    there are too few files or workers to search in parallel, or if
+    worker processes can not be forked from this one (see
+    common.can_fork_workers()).
+    """
+    from common import can_fork_workers
+
+    if not can_fork_workers():
+        return None
+
+    if workers is None:
+        workers = SEARCH_WORKERS
+    if workers is None:
+        from multiprocessing import cpu_count
+        workers = cpu_count()
+
+    shards = (len(filenames) + SEARCH_SHARD_DOCUMENTS - 1) / SEARCH_SHARD_DOCUMENTS
+    workers = min(workers, shards)
+    if workers <= 1 or len(filenames) < PARALLEL_SEARCH_MIN_DOCUMENTS:
+        return None
+    return workers
+
+def _execute_search(filenames, matcher, args, kwargs, workers, deadline=None):
+    """
+    Search executor. Given file names, one of the search_anns_for_
+    functions and the arguments to call it with after the Annotations
+    objects, searches the documents in shards spread over the given
+    number of worker processes, generating the (file name, match
+    references) of those with matches in the given order (see
+    _match_references()), of those searched by the given deadline (a
+    time()) if any.
+
+    The workers are only started once the first file name is asked
+    for, and are stopped when the generator is closed, so that a
+    search stopping early (e.g. at the result limit) has them abandon
+    the rest. They are forked from the calling process, which must
+    run no other threads and hold no open database transactions or
+    other locks that they would inherit (see _search_workers()).
+    """
+    from multiprocessing import Pool, TimeoutError
+
+    firsts = range(0, len(filenames), SEARCH_SHARD_DOCUMENTS)
+    pool = Pool(workers)
+    try:
+        # in order and one shard at a time, as only then can we wait
+        # for results with a timeout
+        results = pool.imap(_search_shard,
+                            [(matcher.__name__, first,
+                              filenames[first:first+SEARCH_SHARD_DOCUMENTS],
+                              args, kwargs) for first in firsts])
+        for first in firsts:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - time())
+            try:
+                found = results.next(timeout)
+            except TimeoutError:
+                Messager.warning('Search time limit exceeded, searched %d of %d documents.' % (first, len(filenames)))
+                break
+            for position, references in found:
+                yield filenames[position], references
+    finally:
+        pool.terminate()
+        pool.join()
+
+def __search_filenames(filenames, matcher, args, kwargs, workers=None,
+                       deadline=None):
+    """
+    Given file names, one of the search_anns_for_ functions and the
+    arguments to call it with after the Annotations objects, returns
+    its SearchMatchSet for the files, searched until the given
+    deadline (a time()) if any. Files are searched in parallel by the
+    search executor if there are enough of them for the given number
+    of worker processes (SEARCH_WORKERS if None), the matches being
+    then gathered from the parsed documents found to have some, up to
+    the search result limit.
+    """
+
+    workers = _search_workers(filenames, workers)
+    if workers is None:
+        ann_objs = __iter_filenames_to_annotations(filenames, deadline)
+        return matcher(ann_objs, *args, **kwargs)
+
+    # only worth starting the workers if the search looks at the
+    # documents, the matches found being added to this empty set
+    probe = _DocumentProbe()
+    matches = matcher(probe, *args, **kwargs)
+    if not probe.iterated:
+        return matches
+
+    max_results = kwargs.get("max_results")
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
+    found = _execute_search(filenames, matcher, args, kwargs, workers,
+                            deadline)
+    try:
+        for fn, references in found:
+            ann_obj = __filename_to_annotations(fn)
+            if ann_obj is None:
+                continue
+            doc_matches = _resolve_references(ann_obj, references)
+            if doc_matches is None:
+                # changed since it was searched, search it again
+                doc_matches = matcher([ann_obj], *args,
+                                      **dict(kwargs, max_results=-1)).get_matches()
+            for match_ann_obj, ann in doc_matches:
+                matches.add_match(match_ann_obj, ann)
+
+            # max_results <= 0 --> no limit
+            if len(matches) > max_results and max_results > 0:
+                Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
+                break
+    finally:
+        found.close()
+
+    matches.limit_to(max_results)
+    if matches.by_document:
+        # as the matcher sorted its (empty) matches
+        matches.sort_matches()
+    return matches
+
+class _DocumentProbe(object):
+    """
+    Empty stand-in for the Annotations objects to search, telling
+    whether a search got as far as looking at them, i.e. did not give
+    up on the query (an invalid regular expression, say) first.
+    """
+
+    def __init__(self):
+        self.iterated = False
+
+    def __iter__(self):
+        self.iterated = True
+        return iter([])
+
+def __search_page(filenames, matcher, args, kwargs, page, deadline=None):
+    """
+    Pager. Given file names, one of the search_anns_for_ functions and
+    the arguments to call it with after the Annotations objects, and a
+    page as a (limit, document, skip) triple, returns a SearchMatchSet
+    with at most limit matches in the files in the order of their
+    document names, starting from the skip:th match in the named
+    document or else the first document after it (the first document
+    if None). Its next_page is the page following it if there may be
+    more matches, as there may if the search stops at the given
+    deadline (a time()).
+
+    Documents are searched one at a time, and only until the page is
+    full, the first one of the page even past the deadline for the
+    search to always get further. Pages being limited in size already,
+    the search result limit does not apply to the documents.
+    """
+    from bisect import bisect_left
+    from os.path import basename
+
+    limit, document, skip = page
+    kwargs = dict(kwargs, max_results=-1)
+
+    # only worth reading the documents if the search looks at them
+    probe = _DocumentProbe()
+    matches = matcher(probe, *args, **kwargs)
+    if not probe.iterated:
+        return matches
+
+    named = sorted((_unicode_name(basename(fn)), fn) for fn in filenames)
+    names = [name for name, _ in named]
+    first = 0 if document is None else bisect_left(names, document)
+    if first == len(names) or names[first] != document:
+        # gone, or we were to start from its first match anyway
+        skip = 0
+
+    for i in range(first, len(named)):
+        name, fn = named[i]
+        doc_skip = skip if i == first else 0
+        if i != first and deadline is not None and time() >= deadline:
+            Messager.warning('Search time limit exceeded, searched %d of %d documents.' % (i, len(named)))
+            matches.next_page = (limit, name, doc_skip)
+            break
+
+        ann_obj = __filename_to_annotations(fn)
+        if ann_obj is None:
+            continue
+        doc_matches = matcher([ann_obj], *args, **kwargs).get_matches()[doc_skip:]
+
+        room = limit - len(matches)
+        for match_ann_obj, ann in doc_matches[:room]:
+            matches.add_match(match_ann_obj, ann)
+        if len(doc_matches) > room:
+            matches.next_page = (limit, name, doc_skip + room)
+            break
+        if len(matches) == limit:
+            if i + 1 < len(named):
+                matches.next_page = (limit, names[i + 1], 0)
+            break
+    return matches
+
+def __search_doc_or_dir(directory, document, scope, matcher, args, kwargs,
+                        find=None, page=None):
+    """
+    Given a directory, a document and a scope specification (see
+    __doc_or_dir_to_annotations()), one of the search_anns_for_
+    functions and the arguments to call it with after the Annotations
+    objects, returns its SearchMatchSet for the annotations in scope.
+
+    In a collection, only the documents found by the annotation index
+    lookup find, a (function, args, kwargs) triple called with the
+    collection directory first, are searched if it is given and the
+    index is available. The search stops at SEARCH_TIME_BUDGET seconds
+    if not None. Only the given page (see __search_page()) of the
+    matches is returned if any, for collections.
+    """
+    from document import real_directory
+
+    if scope != "collection":
+        ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
+        return matcher(ann_objs, *args, **kwargs)
+
+    names = None
+    if find is not None:
+        find_function, find_args, find_kwargs = find
+        names = find_function(real_directory(directory), *find_args,
+                              **find_kwargs)
+    filenames = __collection_filenames(directory, names)
+
+    deadline = None
+    if SEARCH_TIME_BUDGET is not None:
+        deadline = time() + SEARCH_TIME_BUDGET
+
+    if page is not None:
+        return __search_page(filenames, matcher, args, kwargs, page,
+                             deadline)
+    return __search_filenames(filenames, matcher, args, kwargs,
+                              deadline=deadline)
+
+def _unicode_name(name):
+    # Indices have document names in unicode, file names may not be
+    if isinstance(name, str):
+        return name.decode('utf-8')
+    return name
+
 def _get_text_type_ann_map(ann_objs, restrict_types=None, ignore_types=None, nested_types=None):
     """
     Helper function for search. Given annotations, returns a
@@ -247,11 +621,16 @@ def _get_text_type_ann_map(ann_objs, restrict_types=None, ignore_types=None, nes
 
     text_type_ann_map = {}
     for ann_obj in ann_objs:
+        if nested_types != []:
+            nested_ann_map = _get_nested_ann_map(ann_obj)
         for t in ann_obj.get_textbounds():
             if t.type in ignore_types:
                 continue
             if restrict_types != [] and t.type not in restrict_types:
                 continue
+            if (nested_types != [] and
+                len([x for x in nested_ann_map.get(t, []) if x.type in nested_types]) == 0):
+                continue
 
             if t.text not in text_type_ann_map:
                 text_type_ann_map[t.text] = {}
@@ -261,32 +640,91 @@ def _get_text_type_ann_map(ann_objs, restrict_types=None, ignore_types=None, nes
 
     return text_type_ann_map
 
-def _get_offset_ann_map(ann_objs, restrict_types=None, ignore_types=None):
+def _containing_spans(queries, spans):
     """
-    Helper function for search. Given annotations, returns a dict
-    mapping offsets in text into the set of annotations spanning each
-    offset.
+    Helper for search, joining spans on containment. Given (start,
+    end, key) queries and (start, end, value) spans, generates for
+    each query, in order of start offset, the pair of the query and the
+    values of the spans containing (or equivalent with) it. Makes a
+    single sweep over both sorted by start offset, keeping only the
+    spans around the current offset.
+    """
+    from heapq import heappush, heappop
+
+    queries = sorted(queries, key=lambda q: q[0])
+    spans = sorted(spans, key=lambda s: s[0])
+
+    # spans started at or before the current query start, by end
+    active = []
+    next_span = 0
+    for query in queries:
+        q_start, q_end = query[0], query[1]
+        while next_span < len(spans) and spans[next_span][0] <= q_start:
+            s_start, s_end, value = spans[next_span]
+            heappush(active, (s_end, next_span, value))
+            next_span += 1
+        # spans ending before the query start can't contain this query
+        # or any of those following it
+        while active and active[0][0] < q_start:
+            heappop(active)
+        yield query, [value for s_end, _, value in active if s_end >= q_end]
+
+def _textbound_spans(ann_obj, restrict_types=None, ignore_types=None):
+    """
+    Helper for search. Given annotations, returns (start, end,
+    annotation) for each span of the textbounds of the given types.
     """
 
     # treat None and empty list uniformly
     restrict_types = [] if restrict_types is None else restrict_types
     ignore_types   = [] if ignore_types is None else ignore_types
 
-    offset_ann_map = {}
-    for ann_obj in ann_objs:
-        for t in ann_obj.get_textbounds():
-            if t.type in ignore_types:
-                continue
-            if restrict_types != [] and t.type not in restrict_types:
-                continue
+    spans = []
+    for t in ann_obj.get_textbounds():
+        if t.type in ignore_types:
+            continue
+        if restrict_types != [] and t.type not in restrict_types:
+            continue
+        spans.extend((start, end, t) for start, end in t.spans)
+    return spans
+
+def _get_offset_spanning_anns(ann_obj, offsets):
+    """
+    Helper for search. Given annotations and offsets in their text,
+    returns a dict mapping each of the offsets into the set of
+    textbounds with a span covering the character at the offset.
+    """
+
+    spanning = {}
+    for (o, _, _), anns in _containing_spans([(o, o+1, None) for o in offsets],
+                                              _textbound_spans(ann_obj)):
+        spanning[o] = set(anns)
+    return spanning
+
+def _get_nested_ann_map(ann_obj):
+    """
+    Helper for search. Given annotations, returns a dict mapping
+    textbounds into the list of other textbounds nested in them, that
+    is, with each of their spans inside (or equivalent with) one of
+    the spans of the nesting one.
+    """
+
+    spans = _textbound_spans(ann_obj)
 
-            for t_start, t_end in t.spans:
-                for o in range(t_start, t_end):
-                    if o not in offset_ann_map:
-                        offset_ann_map[o] = set()
-                    offset_ann_map[o].add(t)
+    # the annotations containing all the spans of each annotation
+    containing_map = {}
+    for (_, _, t), anns in _containing_spans(spans, spans):
+        if t not in containing_map:
+            containing_map[t] = set(anns)
+        else:
+            containing_map[t] &= set(anns)
 
-    return offset_ann_map
+    nested_map = {}
+    for t, containing in containing_map.iteritems():
+        for c in containing:
+            if c != t:
+                nested_map.setdefault(c, []).append(t)
+    return nested_map
 
 def eq_text_neq_type_spans(ann_objs, restrict_types=None, ignore_types=None, nested_types=None):
     """
@@ -299,8 +737,6 @@ def eq_text_neq_type_spans(ann_objs, restrict_types=None, ignore_types=None, nes
     ignore_types   = [] if ignore_types is None else ignore_types
     nested_types   = [] if nested_types is None else nested_types
 
-    # TODO: nested_types constraints not applied
-
     matches = SearchMatchSet("Text marked with different types")
 
     text_type_ann_map = _get_text_type_ann_map(ann_objs, restrict_types, ignore_types, nested_types)
@@ -446,11 +882,10 @@ def eq_text_partially_marked(ann_objs, restrict_types=None, ignore_types=None, n
             continue
 
         # document-specific map
-        offset_ann_map = _get_offset_ann_map([ann_obj])
-
-        # this one too
         sentence_num = _get_offset_sentence_map(doctext)
 
+        # spans matching some tagged text
+        tagged_text_spans = []
         start_offset = 0
         for start in range(len(tokens)):
             for end in range(start, len(tokens)):
@@ -465,19 +900,28 @@ def eq_text_partially_marked(ann_objs, restrict_types=None, ignore_types=None, n
                     # consistently untagged
                     continue
 
-                # Some matching is tagged; this is considered
-                # inconsistent (for this check) if the current span
-                # has no fully covering tagging. Note that type
-                # matching is not considered here.
-                start_spanning = offset_ann_map.get(start_offset, set())
-                end_spanning = offset_ann_map.get(end_offset-1, set()) # NOTE: -1 needed, see _get_offset_ann_map()
-                if len(start_spanning & end_spanning) == 0:
-                    if s not in text_untagged_map:
-                        text_untagged_map[s] = []
-                    text_untagged_map[s].append((ann_obj, start_offset, end_offset, s, sentence_num[start_offset]))
+                tagged_text_spans.append((start_offset, end_offset, s))
 
             start_offset += len(tokens[start])
 
+        # annotations covering the first and last characters of these
+        # spans (NOTE: -1 needed for the last, end offsets are exclusive)
+        offset_ann_map = _get_offset_spanning_anns(ann_obj,
+            set(o for start_offset, end_offset, s in tagged_text_spans
+                for o in (start_offset, end_offset-1)))
+
+        for start_offset, end_offset, s in tagged_text_spans:
+            # Some matching is tagged; this is considered
+            # inconsistent (for this check) if the current span
+            # has no fully covering tagging. Note that type
+            # matching is not considered here.
+            start_spanning = offset_ann_map[start_offset]
+            end_spanning = offset_ann_map[end_offset-1]
+            if len(start_spanning & end_spanning) == 0:
+                if s not in text_untagged_map:
+                    text_untagged_map[s] = []
+                text_untagged_map[s].append((ann_obj, start_offset, end_offset, s, sentence_num[start_offset]))
+
     # form match objects, grouping by text
     for text in text_untagged_map:
         assert text in text_type_ann_map, "INTERNAL ERROR"
@@ -581,6 +1025,9 @@ def _get_match_regex(text, text_match="word", match_case=False,
             return re.compile(r'^'+re.escape(text)+r'$', regex_flags)
         else:
             return re.compile(r'\b'+re.escape(text)+r'\b', regex_flags)
+    elif text_match == "prefix":
+        # word-initial match: require a word boundary at the start only
+        return re.compile(r'\b'+re.escape(text), regex_flags)
     elif text_match == "substring":
         # any substring match, as text (nonoverlapping matches)
         return re.compile(re.escape(text), regex_flags)
@@ -594,15 +1041,40 @@ def _get_match_regex(text, text_match="word", match_case=False,
         Messager.error('Unrecognized search match specification "%s"' % text_match)
         return None    
 
+def _index_match_regex(text, text_match="word", match_case=False):
+    """
+    Helper for the searches using the annotation index. Returns the
+    regular expression the annotation texts have to match to match
+    the given text, as for the search_anns_for_ functions, None for no
+    constraint and False if the text can not be matched (leaving it to
+    the search to tell why).
+    """
+
+    if text is None or text == "" or text == DEFAULT_EMPTY_STRING:
+        return None
+    if text_match not in ("word", "prefix", "substring", "regex"):
+        return False
+    if text_match == "regex":
+        try:
+            re.compile(text)
+        except: # whatever (sre_constants.error, other?)
+            return False
+    return _get_match_regex(text, text_match, match_case)
+
 def search_anns_for_textbound(ann_objs, text, restrict_types=None, 
                               ignore_types=None, nested_types=None, 
                               text_match="word", match_case=False,
-                              entities_only=False):
+                              entities_only=False, max_results=None):
     """
     Searches for the given text in the Textbound annotations in the
-    given Annotations objects.  Returns a SearchMatchSet object.
+    given Annotations objects.  Returns a SearchMatchSet object of at
+    most max_results (MAX_SEARCH_RESULT_NUMBER if None) matches, no
+    limit if not positive.
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -635,6 +1107,9 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
         else:
             candidates = ann_obj.get_entities()
 
+        if nested_types != []:
+            nested_ann_map = _get_nested_ann_map(ann_obj)
+
         for t in candidates:
             if t.type in ignore_types:
                 continue
@@ -644,9 +1119,7 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
                 text != DEFAULT_EMPTY_STRING and not match_regex.search(t.get_text())):
                 continue
             if nested_types != []:
-                # TODO: massively inefficient
-                nested = [x for x in ann_obj.get_textbounds() 
-                          if x != t and t.contains(x)]
+                nested = nested_ann_map.get(t, [])
                 if len([x for x in nested if x.type in nested_types]) == 0:
                     continue
 
@@ -660,12 +1133,12 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
         for t in ann_matches:
             matches.add_match(ann_obj, t)    
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -678,12 +1151,17 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
 
 def search_anns_for_note(ann_objs, text, category,
                          restrict_types=None, ignore_types=None,
-                         text_match="word", match_case=False):
+                         text_match="word", match_case=False, max_results=None):
     """
     Searches for the given text in the comment annotations in the
-    given Annotations objects.  Returns a SearchMatchSet object.
+    given Annotations objects.  Returns a SearchMatchSet object of at
+    most max_results (MAX_SEARCH_RESULT_NUMBER if None) matches, no
+    limit if not positive.
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -733,12 +1211,12 @@ def search_anns_for_note(ann_objs, text, category,
         for t in ann_matches:
             matches.add_match(ann_obj, t)    
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -751,12 +1229,17 @@ def search_anns_for_note(ann_objs, text, category,
 
 def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type, 
                              restrict_types=None, ignore_types=None, 
-                             text_match="word", match_case=False):
+                             text_match="word", match_case=False, max_results=None):
     """
     Searches the given Annotations objects for relation annotations
-    matching the given specification. Returns a SearchMatchSet object.
+    matching the given specification. Returns a SearchMatchSet object
+    of at most max_results (MAX_SEARCH_RESULT_NUMBER if None) matches,
+    no limit if not positive.
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -851,12 +1334,12 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
         for r in ann_matches:
             matches.add_match(ann_obj, r)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -869,12 +1352,17 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
 
 def search_anns_for_event(ann_objs, trigger_text, args, 
                           restrict_types=None, ignore_types=None, 
-                          text_match="word", match_case=False):
+                          text_match="word", match_case=False, max_results=None):
     """
     Searches the given Annotations objects for Event annotations
-    matching the given specification. Returns a SearchMatchSet object.
+    matching the given specification. Returns a SearchMatchSet object
+    of at most max_results (MAX_SEARCH_RESULT_NUMBER if None) matches,
+    no limit if not positive.
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -981,12 +1469,12 @@ def search_anns_for_event(ann_objs, trigger_text, args,
         for t_obj, e in ann_matches:
             matches.add_match(ann_obj, e)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -999,12 +1487,17 @@ def search_anns_for_event(ann_objs, trigger_text, args,
 
 def search_anns_for_text(ann_objs, text, 
                          restrict_types=None, ignore_types=None, nested_types=None, 
-                         text_match="word", match_case=False):
+                         text_match="word", match_case=False, max_results=None):
     """
     Searches for the given text in the document texts of the given
-    Annotations objects.  Returns a SearchMatchSet object.
+    Annotations objects.  Returns a SearchMatchSet object of at most
+    max_results (MAX_SEARCH_RESULT_NUMBER if None) matches, no limit
+    if not positive.
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -1032,19 +1525,19 @@ def search_anns_for_text(ann_objs, text,
     for ann_obj in ann_objs:
         doctext = ann_obj.get_document_text()
 
-        for m in match_regex.finditer(doctext):
-            # only need to care about embedding annotations if there's
-            # some annotation-based restriction
-            #if restrict_types == [] and ignore_types == []:
-            # TODO: _extremely_ naive and slow way to find embedding
-            # annotations.  Use some reasonable data structure
-            # instead.
-            embedding = []
-            # if there are no type restrictions, we can skip this bit
-            if restrict_types != [] or ignore_types != []:
-                for t in ann_obj.get_textbounds():
-                    if t.contains(m):
-                        embedding.append(t)
+        text_matches = ((m.start(), m.end(), m)
+                        for m in match_regex.finditer(doctext))
+        # only need to care about embedding annotations if there's
+        # some annotation-based restriction
+        if restrict_types != [] or ignore_types != []:
+            # join the matches (in order, as found) with the embedding
+            # textbounds in one sweep over both
+            text_matches = _containing_spans(text_matches,
+                                             _textbound_spans(ann_obj))
+        else:
+            text_matches = ((match, []) for match in text_matches)
+
+        for (_, _, m), embedding in text_matches:
 
             # Note interpretation of ignore_types here: if the text
             # span is embedded in one or more of the ignore_types or
@@ -1061,12 +1554,12 @@ def search_anns_for_text(ann_objs, text,
             tm = TextMatch(m.start(), m.end(), m.group())
             matches.add_match(ann_obj, tm)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     if REPORT_SEARCH_TIMINGS:
         process_delta = datetime.now() - process_start
@@ -1074,6 +1567,92 @@ def search_anns_for_text(ann_objs, text,
 
     return matches
 
+def _find_text_documents(real_dir, text, text_match="word"):
+    """
+    Text counterpart of the annotation index lookups: returns the
+    names of the documents in the given collection directory whose
+    texts contain the words searched for according to its text index,
+    or None if the search can not be narrowed down using the index
+    (only word and prefix matches can) or the index is not available.
+    """
+    import textindex
+
+    if text_match not in ("word", "prefix") or text == DEFAULT_EMPTY_STRING:
+        return None
+    words = [w for w, _ in textindex.text_words(text)]
+    if not words:
+        return None
+
+    # Only the last word can be a prefix, the others are bounded by the
+    # non-word characters between them
+    return textindex.lookup_documents(real_dir, words,
+                                      prefix_last=(text_match == "prefix"
+                                          and textindex.WORD_RE.match(
+                                              text[-1:]) is not None))
+
+def _search_collection_for_text(directory, text, text_match="word",
+                                match_case=False, max_results=None):
+    """
+    Searches for the given text in the document texts of the given
+    collection using its text index, reading only the documents that
+    contain the words searched for. Returns a SearchMatchSet object
+    of at most max_results (MAX_SEARCH_RESULT_NUMBER if None) matches,
+    no limit if not positive, or None if the search can not be made
+    using the index (only word and prefix matches can).
+    """
+
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+    import textindex
+    from document import real_directory
+    from os.path import basename
+
+    if text_match not in ("word", "prefix") or text == DEFAULT_EMPTY_STRING:
+        return None
+    words = [w for w, _ in textindex.text_words(text)]
+    if not words:
+        return None
+
+    real_dir = real_directory(directory)
+    # The single word searched for is found in the index as it is, more
+    # than one have to be looked for in the texts containing them all
+    single_word = textindex.WORD_RE.match(text)
+    single_word = single_word is not None and single_word.end() == len(text)
+    if single_word:
+        postings = textindex.lookup_postings(real_dir, words[0],
+                                             prefix=(text_match == "prefix"))
+        found = postings
+    else:
+        found = _find_text_documents(real_dir, text, text_match)
+    if found is None:
+        # No index available
+        return None
+
+    ann_objs = __iter_filenames_to_annotations(
+        __collection_filenames(directory, found))
+    if not single_word:
+        return search_anns_for_text(ann_objs, text, text_match=text_match,
+                                    match_case=match_case)
+
+    matches = SearchMatchSet("Text matching '%s'" % text)
+    for ann_obj in ann_objs:
+        for start in postings[_unicode_name(basename(ann_obj.get_document()))]:
+            # The match is the text searched for, all of the word when
+            # matching words
+            end = start + len(text)
+            match_text = ann_obj.get_document_text_slice(start, end)
+            if match_case and match_text != text:
+                continue
+            matches.add_match(ann_obj, TextMatch(start, end, match_text))
+
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_results)
+            break
+
+    matches.limit_to(max_results)
+    return matches
+
 def _get_arg_n(ann_obj, ann, n):
     # helper for format_results, normalizes over BinaryRelationAnnotation
     # arg1, arg2 and EquivAnnotation entities[0], entities[1], ...
@@ -1261,8 +1840,8 @@ def format_results(matches, concordancing=False, context_length=50,
         if context_ann is not None:
             # left context
             start = max(context_ann.first_start() - context_length, 0)
-            doctext = ann_obj.get_document_text()
-            items[-1].append(doctext[start:context_ann.first_start()])
+            items[-1].append(ann_obj.get_document_text_slice(
+                    start, context_ann.first_start()))
 
         if include_text:
             items[-1].append(ann.text)
@@ -1277,9 +1856,9 @@ def format_results(matches, concordancing=False, context_length=50,
         if context_ann is not None:
             # right context
             end = min(context_ann.last_end() + context_length, 
-                      len(ann_obj.get_document_text()))
-            doctext = ann_obj.get_document_text()
-            items[-1].append(doctext[context_ann.last_end():end])
+                      ann_obj.get_document_text_length())
+            items[-1].append(ann_obj.get_document_text_slice(
+                    context_ann.last_end(), end))
 
         if include_argument_type:
             items[-1].append(_get_arg_n(ann_obj, ann, 0).type)
@@ -1308,95 +1887,225 @@ def _to_bool(s):
     else:
         assert False, "Error: '%s' is not bool or JSON boolean" % str(s)
 
+def _page_limit(limit):
+    # The number of matches on a page of search results, at most the
+    # search result limit
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        limit = 0
+    if limit <= 0:
+        Messager.error('Search result page limit should be a positive integer')
+        raise ProtocolArgumentError
+    if MAX_SEARCH_RESULT_NUMBER > 0:
+        limit = min(limit, MAX_SEARCH_RESULT_NUMBER)
+    return limit
+
+def _read_cursor(cursor):
+    """
+    Given a cursor as returned with a page of search results, returns
+    the name of the search (see SEARCH_FUNCTION), its arguments and
+    the (limit, document, skip) page to resume it from.
+    """
+    from base64 import urlsafe_b64decode
+    from jsonwrap import loads
+
+    try:
+        cursor = loads(urlsafe_b64decode(str(cursor)))
+        page = (_page_limit(cursor['limit']), unicode(cursor['document']),
+                int(cursor['skip']))
+        if page[2] < 0 or not isinstance(cursor['args'], dict):
+            raise ValueError
+        return cursor['search'], cursor['args'], page
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        Messager.error('Invalid search cursor')
+        raise ProtocolArgumentError
+
+def _search_page(scope, limit, cursor):
+    """
+    Given the scope, the page limit and the cursor arguments of a
+    search, returns the page of its matches to return as a (limit,
+    document, skip) triple (see __search_page()), or None if the
+    search is not paged: collection searches are when given either.
+    """
+    if scope != "collection" or (limit is None and cursor is None):
+        return None
+
+    if cursor is None:
+        return _page_limit(limit), None, 0
+    cursor_limit, document, skip = _read_cursor(cursor)[2]
+    if limit is not None:
+        cursor_limit = _page_limit(limit)
+    return cursor_limit, document, skip
+
+def _search_cursor(search, search_args, page):
+    """
+    Returns an opaque cursor for resuming the named search (see
+    SEARCH_FUNCTION) with the given arguments from the given page, or
+    None if there is none.
+    """
+    from base64 import urlsafe_b64encode
+    from jsonwrap import dumps
+
+    if page is None:
+        return None
+    limit, document, skip = page
+    return urlsafe_b64encode(dumps({
+                'search': search,
+                'args': search_args,
+                'limit': limit,
+                'document': document,
+                'skip': skip,
+                }))
+
+# Search functions of collection and document searches. Collection
+# searches are paged when given a limit, the number of matches on a
+# page, and return the "cursor" to resume from with searchResume (or
+# None when done).
+
 def search_text(collection, document, scope="collection",
                 concordancing="false", context_length=50,
                 text_match="word", match_case="false",
-                text=""):
+                text="", limit=None, cursor=None):
 
     directory = collection
+    search_args = dict(document=document, scope=scope,
+                       concordancing=concordancing,
+                       context_length=context_length, text_match=text_match,
+                       match_case=match_case, text=text)
+    page = _search_page(scope, limit, cursor)
 
     # Interpret JSON booleans
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)    
-
-    matches = search_anns_for_text(ann_objs, text, 
-                                   text_match=text_match, 
-                                   match_case=match_case)
+    matches = None
+    if scope == "collection" and page is None:
+        # Word and prefix searches only need the documents containing the
+        # words searched for, as found in the text index
+        matches = _search_collection_for_text(directory, text,
+                                              text_match=text_match,
+                                              match_case=match_case)
+    if matches is None:
+        matches = __search_doc_or_dir(directory, document, scope,
+                                      search_anns_for_text, (text, ),
+                                      dict(text_match=text_match,
+                                           match_case=match_case),
+                                      (_find_text_documents,
+                                       (text, text_match), {}),
+                                      page)
         
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
+    if page is not None:
+        results['cursor'] = _search_cursor('text', search_args,
+                                           matches.next_page)
     
     return results
 
 def search_entity(collection, document, scope="collection",
                   concordancing="false", context_length=50,
                   text_match="word", match_case="false",
-                  type=None, text=DEFAULT_EMPTY_STRING):
+                  type=None, text=DEFAULT_EMPTY_STRING,
+                  limit=None, cursor=None):
 
     directory = collection
+    search_args = dict(document=document, scope=scope,
+                       concordancing=concordancing,
+                       context_length=context_length, text_match=text_match,
+                       match_case=match_case, type=type, text=text)
+    page = _search_page(scope, limit, cursor)
 
     # Interpret JSON booleans
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_textbound(ann_objs, text, 
-                                        restrict_types=restrict_types, 
-                                        text_match=text_match,
-                                        match_case=match_case)
+    find = None
+    match_regex = _index_match_regex(text, text_match, match_case)
+    if match_regex is not False:
+        find = (annindex.find_textbounds, (match_regex, ),
+                dict(restrict_types=restrict_types))
+
+    matches = __search_doc_or_dir(directory, document, scope,
+                                  search_anns_for_textbound, (text, ),
+                                  dict(restrict_types=restrict_types,
+                                       text_match=text_match,
+                                       match_case=match_case),
+                                  find, page)
         
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
+    if page is not None:
+        results['cursor'] = _search_cursor('entity', search_args,
+                                           matches.next_page)
     
     return results
 
 def search_note(collection, document, scope="collection",
                 concordancing="false", context_length=50,
                 text_match="word", match_case="false",
-                category=None, type=None, text=DEFAULT_EMPTY_STRING):
+                category=None, type=None, text=DEFAULT_EMPTY_STRING,
+                limit=None, cursor=None):
 
     directory = collection
+    search_args = dict(document=document, scope=scope,
+                       concordancing=concordancing,
+                       context_length=context_length, text_match=text_match,
+                       match_case=match_case, category=category, type=type,
+                       text=text)
+    page = _search_page(scope, limit, cursor)
 
     # Interpret JSON booleans
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_note(ann_objs, text, category,
-                                   restrict_types=restrict_types, 
-                                   text_match=text_match,
-                                   match_case=match_case)
+    find = None
+    match_regex = _index_match_regex(text, text_match, match_case)
+    if match_regex is not False:
+        find = (annindex.find_notes, (match_regex, ),
+                dict(restrict_types=restrict_types))
+
+    matches = __search_doc_or_dir(directory, document, scope,
+                                  search_anns_for_note, (text, category),
+                                  dict(restrict_types=restrict_types,
+                                       text_match=text_match,
+                                       match_case=match_case),
+                                  find, page)
         
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
+    if page is not None:
+        results['cursor'] = _search_cursor('note', search_args,
+                                           matches.next_page)
     
     return results
 
 def search_event(collection, document, scope="collection",
                  concordancing="false", context_length=50,
                  text_match="word", match_case="false",
-                 type=None, trigger=DEFAULT_EMPTY_STRING, args={}):
+                 type=None, trigger=DEFAULT_EMPTY_STRING, args={},
+                 limit=None, cursor=None):
 
     directory = collection
+    search_args = dict(document=document, scope=scope,
+                       concordancing=concordancing,
+                       context_length=context_length, text_match=text_match,
+                       match_case=match_case, type=type, trigger=trigger,
+                       args=args)
+    page = _search_page(scope, limit, cursor)
 
     # Interpret JSON booleans
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
@@ -1407,13 +2116,34 @@ def search_event(collection, document, scope="collection",
     from jsonwrap import loads
     args = loads(args)
 
-    matches = search_anns_for_event(ann_objs, trigger, args, 
-                                    restrict_types=restrict_types,
-                                    text_match=text_match, 
-                                    match_case=match_case)
+    # the argument constraints as looked up in the annotation index,
+    # blank values standing for no constraint
+    trigger_regex = _index_match_regex(trigger, text_match, match_case)
+    arg_constraints = []
+    for arg in args:
+        constraint = (arg.get('role') or None, arg.get('type') or None,
+                      _index_match_regex(arg.get('text'), text_match,
+                                         match_case))
+        if constraint != (None, None, None):
+            arg_constraints.append(constraint)
+    find = None
+    if (trigger_regex is not False and
+        False not in [r for _, _, r in arg_constraints]):
+        find = (annindex.find_events, (trigger_regex, arg_constraints),
+                dict(restrict_types=restrict_types))
+
+    matches = __search_doc_or_dir(directory, document, scope,
+                                  search_anns_for_event, (trigger, args),
+                                  dict(restrict_types=restrict_types,
+                                       text_match=text_match,
+                                       match_case=match_case),
+                                  find, page)
 
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
+    if page is not None:
+        results['cursor'] = _search_cursor('event', search_args,
+                                           matches.next_page)
     
     return results
 
@@ -1422,9 +2152,17 @@ def search_relation(collection, document, scope="collection",
                     text_match="word", match_case="false",
                     type=None, arg1=None, arg1type=None, 
                     arg2=None, arg2type=None,
-                    show_text=False, show_type=False):
+                    show_text=False, show_type=False,
+                    limit=None, cursor=None):
 
     directory = collection
+    search_args = dict(document=document, scope=scope,
+                       concordancing=concordancing,
+                       context_length=context_length, text_match=text_match,
+                       match_case=match_case, type=type, arg1=arg1,
+                       arg1type=arg1type, arg2=arg2, arg2type=arg2type,
+                       show_text=show_text, show_type=show_type)
+    page = _search_page(scope, limit, cursor)
 
     # Interpret JSON booleans
     concordancing = _to_bool(concordancing)
@@ -1432,40 +2170,81 @@ def search_relation(collection, document, scope="collection",
     show_text = _to_bool(show_text)
     show_type = _to_bool(show_type)
     
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_relation(ann_objs, arg1, arg1type,
-                                       arg2, arg2type,
-                                       restrict_types=restrict_types,
+    arg1_regex = _index_match_regex(arg1, text_match, match_case)
+    arg2_regex = _index_match_regex(arg2, text_match, match_case)
+    find = None
+    if arg1_regex is not False and arg2_regex is not False:
+        find = (annindex.find_relations,
+                (arg1_regex, arg1type, arg2_regex, arg2type),
+                dict(restrict_types=restrict_types))
+
+    matches = __search_doc_or_dir(directory, document, scope,
+                                  search_anns_for_relation,
+                                  (arg1, arg1type, arg2, arg2type),
+                                  dict(restrict_types=restrict_types,
                                        text_match=text_match,
-                                       match_case=match_case)
+                                       match_case=match_case),
+                                  find, page)
 
     results = format_results(matches, concordancing, context_length,
                              show_text, show_type)
     results['collection'] = directory
+    if page is not None:
+        results['cursor'] = _search_cursor('relation', search_args,
+                                           matches.next_page)
     
     return results
 
+# Searches by the name they go by in cursors
+SEARCH_FUNCTION = {
+    'text'     : search_text,
+    'entity'   : search_entity,
+    'note'     : search_note,
+    'event'    : search_event,
+    'relation' : search_relation,
+    }
+
+def search_resume(collection, cursor, limit=None):
+    """
+    Resumes the collection search the given cursor was returned for
+    from where its page of matches ended, returning the next page of
+    at most the given number of matches (as many as on the previous
+    one if None) and the cursor to resume from in turn.
+    """
+    from inspect import getargspec
+
+    search, search_args, _ = _read_cursor(cursor)
+    try:
+        search_function = SEARCH_FUNCTION[search]
+    except (KeyError, TypeError):
+        Messager.error('Invalid search cursor')
+        raise ProtocolArgumentError
+    if not set(search_args) <= set(getargspec(search_function)[0][1:-2]):
+        Messager.error('Invalid search cursor')
+        raise ProtocolArgumentError
+
+    search_args = dict((str(k), v) for k, v in search_args.iteritems())
+    return search_function(collection, limit=limit, cursor=cursor,
+                           **search_args)
+
 ### filename list interface functions (e.g. command line) ###
 
-def search_files_for_text(filenames, text, restrict_types=None, ignore_types=None, nested_types=None):
+def search_files_for_text(filenames, text, restrict_types=None, ignore_types=None, nested_types=None, workers=None):
     """
     Searches for the given text in the given set of files.
     """
-    anns = __filenames_to_annotations(filenames)
-    return search_anns_for_text(anns, text, restrict_types=restrict_types, ignore_types=ignore_types, nested_types=nested_types)
+    return __search_filenames(filenames, search_anns_for_text, (text, ), dict(restrict_types=restrict_types, ignore_types=ignore_types, nested_types=nested_types), workers)
 
-def search_files_for_textbound(filenames, text, restrict_types=None, ignore_types=None, nested_types=None, entities_only=False):
+def search_files_for_textbound(filenames, text, restrict_types=None, ignore_types=None, nested_types=None, entities_only=False, workers=None):
     """
     Searches for the given text in textbound annotations in the given
     set of files.
     """
-    anns = __filenames_to_annotations(filenames)
-    return search_anns_for_textbound(anns, text, restrict_types=restrict_types, ignore_types=ignore_types, nested_types=nested_types, entities_only=entities_only)
+    return __search_filenames(filenames, search_anns_for_textbound, (text, ), dict(restrict_types=restrict_types, ignore_types=ignore_types, nested_types=nested_types, entities_only=entities_only), workers)
 
 # TODO: filename list interface functions for event and relation search
 
@@ -1496,6 +2275,7 @@ def argparser():
     ap.add_argument("-r", "--restrict", metavar="TYPE", nargs="+", help="Restrict to given types.")
     ap.add_argument("-i", "--ignore", metavar="TYPE", nargs="+", help="Ignore given types.")
     ap.add_argument("-n", "--nested", metavar="TYPE", nargs="+", help="Require type to be nested.")
+    ap.add_argument("-w", "--workers", metavar="N", type=int, help="Number of processes to search with (default: number of CPUs).")
     ap.add_argument("files", metavar="FILE", nargs="+", help="Files to verify.")
     return ap
 
@@ -1517,18 +2297,21 @@ def main(argv=None):
         matches = [search_files_for_textbound(arg.files, arg.textbound,
                                               restrict_types=arg.restrict,
                                               ignore_types=arg.ignore,
-                                              nested_types=arg.nested)]
+                                              nested_types=arg.nested,
+                                              workers=arg.workers)]
     elif arg.entity is not None:
         matches = [search_files_for_textbound(arg.files, arg.textbound,
                                               restrict_types=arg.restrict,
                                               ignore_types=arg.ignore,
                                               nested_types=arg.nested,
-                                              entities_only=True)]
+                                              entities_only=True,
+                                              workers=arg.workers)]
     elif arg.text is not None:
         matches = [search_files_for_text(arg.files, arg.text,
                                          restrict_types=arg.restrict,
                                          ignore_types=arg.ignore,
-                                         nested_types=arg.nested)]
+                                         nested_types=arg.nested,
+                                         workers=arg.workers)]
     elif arg.consistency_types:
         matches = check_files_type_consistency(arg.files,
                                                restrict_types=arg.restrict,
@@ -1565,8 +2348,191 @@ def main(argv=None):
 if __name__ == "__main__":
     import sys
 
-    # on command-line invocations, don't limit the number of results
-    # as the user has direct control over the system.
-    MAX_SEARCH_RESULT_NUMBER = -1
+    if sys.argv[1:2] == ["--test"]:
+        # the unit tests, run as "search.py --test [unittest arguments]"
+        from unittest import TestCase
+        import unittest
+
+        from os.path import basename, join as path_join
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        # not to be mangled as a private name in the test cases
+        search_filenames = globals()["__search_filenames"]
+
+        def _write_documents(directory, count):
+            # documents with two BRCA1 entities, but for every third with none
+            filenames = []
+            for i in range(count):
+                filename = path_join(directory, "doc%02d" % i)
+                with open(filename + ".txt", "w") as txt_file:
+                    txt_file.write("BRCA1 and BRCA1 and p53.\n")
+                with open(filename + ".ann", "w") as ann_file:
+                    if i % 3 != 0:
+                        ann_file.write("T1\tProtein 0 5\tBRCA1\n"
+                                       "T2\tProtein 10 15\tBRCA1\n")
+                    ann_file.write("T3\tProtein 20 23\tp53\n")
+                filenames.append(filename)
+            return filenames
+
+        def _match_ids(matches):
+            return [(basename(ann_obj.get_document()), ann.id)
+                    for ann_obj, ann in matches.get_matches()]
+
+        class TestSearchExecutor(TestCase):
+            def setUp(self):
+                self._dir = mkdtemp()
+                # in reverse, as the order given is the order of the results
+                self._filenames = _write_documents(self._dir, 40)[::-1]
+
+            def tearDown(self):
+                rmtree(self._dir)
+
+            def test_parallel(self):
+                self.assertEqual(_search_workers(self._filenames, 4), 4)
+                self.assertEqual(_search_workers(self._filenames[:8], 4), None)
+                self.assertEqual(_search_workers(self._filenames, 1), None)
+
+            def test_order(self):
+                self.assertEqual([fn for fn, _ in _execute_search(
+                    self._filenames, search_anns_for_textbound, ("BRCA1", ),
+                    {}, 4)],
+                    [fn for i, fn in enumerate(self._filenames)
+                     if (39 - i) % 3 != 0])
+
+            def test_as_serial(self):
+                for kwargs in ({}, {"restrict_types": ["Protein"]},
+                               {"max_results": 5}, {"max_results": -1}):
+                    serial = search_filenames(self._filenames,
+                                              search_anns_for_textbound,
+                                              ("BRCA1", ), kwargs, 1)
+                    parallel = search_filenames(self._filenames,
+                                                search_anns_for_textbound,
+                                                ("BRCA1", ), kwargs, 4)
+                    self.assertEqual(_match_ids(parallel), _match_ids(serial))
+                self.assertEqual(len(parallel), 52)
+                self.assertEqual(_match_ids(parallel)[:2],
+                                 [("doc01", "T1"), ("doc01", "T2")])
+
+            def test_text_as_serial(self):
+                def spans(matches):
+                    return [(basename(ann_obj.get_document()), m.start, m.end)
+                            for ann_obj, m in matches.get_matches()]
+
+                serial = search_filenames(self._filenames, search_anns_for_text,
+                                          ("BRCA1", ), {}, 1)
+                parallel = search_filenames(self._filenames,
+                                            search_anns_for_text, ("BRCA1", ),
+                                            {}, 4)
+                self.assertEqual(spans(parallel), spans(serial))
+                self.assertEqual(len(parallel), 80)
+
+            def test_references(self):
+                from annotation import TextAnnotations
+
+                ann_obj = TextAnnotations(self._filenames[1], read_only=True)
+                matches = search_anns_for_textbound([ann_obj], "BRCA1")
+                references = _match_references(ann_obj, matches.get_matches())
+                self.assertEqual(_resolve_references(ann_obj, references),
+                                 matches.get_matches())
+                # not those of another document
+                other = TextAnnotations(self._filenames[0], read_only=True)
+                self.assertEqual(_resolve_references(other, references), None)
+
+            def test_limit(self):
+                # the first ones in the order given, sorted by document
+                matches = search_filenames(self._filenames,
+                                           search_anns_for_textbound, ("BRCA1", ),
+                                           {"max_results": 5}, 4)
+                self.assertEqual(_match_ids(matches),
+                                 [("doc35", "T1"), ("doc37", "T1"),
+                                  ("doc37", "T2"), ("doc38", "T1"),
+                                  ("doc38", "T2")])
+
+            def test_stop_early(self):
+                found = _execute_search(self._filenames, search_anns_for_textbound,
+                                        ("BRCA1", ), {}, 4)
+                self.assertEqual(found.next()[0], self._filenames[1])
+                # stops the workers
+                found.close()
+
+        class TestSearchCursor(TestCase):
+            def setUp(self):
+                import document
+                import workdir
+                from session import init_session
+
+                init_session("127.0.0.1")
+                self._dir = mkdtemp()
+                self._tmp_work_dir = mkdtemp()
+                _write_documents(self._dir, 10)
+                self._document = document
+                self._real_directory = document.real_directory
+                document.real_directory = lambda collection: self._dir
+                self._workdir = workdir
+                self._work_dir = workdir.WORK_DIR
+                workdir.WORK_DIR = self._tmp_work_dir
+
+            def tearDown(self):
+                self._document.real_directory = self._real_directory
+                self._workdir.WORK_DIR = self._work_dir
+                rmtree(self._tmp_work_dir)
+                rmtree(self._dir)
+
+            def _matches(self, results):
+                # the document, annotation and text of the matches, the
+                # matches highlighted along with them depending on the page
+                return [item[2:] for item in results["items"]]
+
+            def _pages(self, search_function, limit, **kwargs):
+                # all the pages of a search, resumed from their cursors
+                results = search_function("/test/", "", limit=limit, **kwargs)
+                pages = [self._matches(results)]
+                while results["cursor"] is not None:
+                    results = search_resume("/test/", results["cursor"])
+                    pages.append(self._matches(results))
+                return pages
+
+            def test_round_trip(self):
+                for search_function, kwargs in ((search_entity,
+                                                 {"text": "BRCA1"}),
+                                                (search_text, {"text": "p53"})):
+                    # pages are in the order of the document names, the
+                    # matches of a search of the whole collection not
+                    # always
+                    matches = sorted(self._matches(search_function(
+                        "/test/", "", **kwargs)), key=lambda m: m[0])
+                    # pages ending both between and within documents
+                    for limit in (1, 2, 3, 100):
+                        pages = self._pages(search_function, limit, **kwargs)
+                        self.assertTrue(all(len(page) == limit
+                                            for page in pages[:-1]))
+                        self.assertEqual(sum(pages, []), matches)
+
+            def test_limit(self):
+                results = search_entity("/test/", "", text="BRCA1", limit=4)
+                results = search_resume("/test/", results["cursor"], limit=3)
+                self.assertEqual(len(results["items"]), 3)
+                self.assertEqual(results["items"][0][2:4], ["doc04", "T1"])
+
+            def test_invalid(self):
+                results = search_entity("/test/", "", text="BRCA1", limit=4)
+                for cursor in ("", "not a cursor", results["cursor"][:-4],
+                               _search_cursor("nosuchsearch", {},
+                                              (1, None, 0)),
+                               _search_cursor("entity", {"nosucharg": 1},
+                                              (1, None, 0)),
+                               _search_cursor("entity", {}, (1, "doc01", -1)),
+                               _search_cursor("entity", {}, (0, "doc01", 0))):
+                    self.assertRaises(ProtocolArgumentError, search_resume,
+                                      "/test/", cursor)
+                self.assertRaises(ProtocolArgumentError, search_entity,
+                                  "/test/", "", text="BRCA1", limit="x")
+
+        unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+    else:
+        # on command-line invocations, don't limit the number of results
+        # as the user has direct control over the system.
+        MAX_SEARCH_RESULT_NUMBER = -1
 
-    sys.exit(main(sys.argv))
+        sys.exit(main(sys.argv))
@@ -30,6 +30,14 @@ REQUIRED_PY_VERSION = (2, 5, 0, 'alpha', 1)
 REQUIRED_PY_VERSION_STR = '%d.%d.%d-%s-%d' % tuple(REQUIRED_PY_VERSION)
 JSON_HDR = ('Content-Type', 'application/json')
 CONF_FNAME = 'config.py'
+# Content-Encodings we can compress responses with, in order of preference
+RESPONSE_ENCODINGS = ('gzip', 'deflate')
+# Content-Types of the responses worth compressing
+COMPRESSIBLE_CONTENT_TYPES = ('application/json', )
+# Responses of at least this many bytes are compressed piece by piece as
+# they are sent rather than all at once
+STREAMED_RESPONSE_MIN_SIZE = 1024 * 1024
+STREAMED_RESPONSE_CHUNK_SIZE = 64 * 1024
 CONF_TEMPLATE_FNAME = 'config_template.py'
 CONFIG_CHECK_LOCK = allocate_lock()
 ###
@@ -270,8 +278,95 @@ def _server_crash(cookie_hdrs, e):
             }
     return (cookie_hdrs, ((JSON_HDR, ), dumps(Messager.output_json(json_dic))))
 
+def _accepted_encoding(accept_encoding):
+    # Returns the most preferred of our encodings acceptable according to
+    # the value of an Accept-Encoding header, None if none of them are
+    if not accept_encoding:
+        return None
+    quality = {}
+    for coding in accept_encoding.split(','):
+        parts = coding.split(';')
+        name = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        quality[name] = q
+    best, best_q = None, 0.0
+    for encoding in RESPONSE_ENCODINGS:
+        q = quality.get(encoding, quality.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def _compressor(encoding):
+    from zlib import compressobj, DEFLATED, MAX_WBITS, Z_DEFAULT_COMPRESSION
+    if encoding == 'gzip':
+        # A gzip header and trailer instead of the zlib ones
+        wbits = 16 + MAX_WBITS
+    else:
+        wbits = MAX_WBITS
+    return compressobj(Z_DEFAULT_COMPRESSION, DEFLATED, wbits)
+
+def _stream_compressed(data, compressor):
+    for i in xrange(0, len(data), STREAMED_RESPONSE_CHUNK_SIZE):
+        chunk = compressor.compress(data[i:i + STREAMED_RESPONSE_CHUNK_SIZE])
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+def _compress_response(response_data, accept_encoding):
+    # Compress the data of a response using an encoding accepted by the
+    # client, if worth it. Streamed responses come as an iterable of
+    # pieces of the data rather than as a string.
+    hdrs, data = response_data
+    content_types = [v for k, v in hdrs if k.lower() == 'content-type']
+    if not content_types or content_types[0] not in COMPRESSIBLE_CONTENT_TYPES:
+        return response_data
+    try:
+        from config import RESPONSE_COMPRESSION_MIN_SIZE
+    except ImportError:
+        RESPONSE_COMPRESSION_MIN_SIZE = 1024
+    if (RESPONSE_COMPRESSION_MIN_SIZE is None
+            or len(data) < RESPONSE_COMPRESSION_MIN_SIZE):
+        return response_data
+    encoding = _accepted_encoding(accept_encoding)
+    if encoding is None:
+        return response_data
+
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    hdrs = tuple(hdrs) + (('Content-Encoding', encoding),
+            ('Vary', 'Accept-Encoding'))
+    compressor = _compressor(encoding)
+    if len(data) >= STREAMED_RESPONSE_MIN_SIZE:
+        return hdrs, _stream_compressed(data, compressor)
+    return hdrs, compressor.compress(data) + compressor.flush()
+
 # Serve the client request
-def serve(params, client_ip, client_hostname, cookie_data):
+def serve(params, client_ip, client_hostname, cookie_data,
+        accept_encoding=None):
+    '''
+    Serve a request, returning the cookie headers (None if none) and a
+    tuple of the response headers and data. The data is compressed if the
+    client accepts an encoding we can compress it with (as given by the
+    value of its Accept-Encoding header), in which case it may be an
+    iterable of the pieces of data to send in order rather than a string.
+    '''
+    cookie_hdrs, response_data = _serve(params, client_ip, client_hostname,
+            cookie_data)
+    try:
+        response_data = _compress_response(response_data, accept_encoding)
+    except Exception:
+        # Better to send it as it is than not at all
+        print >> stderr, _get_stack_trace()
+    return cookie_hdrs, response_data
+
+def _serve(params, client_ip, client_hostname, cookie_data):
     # The session relies on the config, wait-for-it
     cookie_hdrs = None
 
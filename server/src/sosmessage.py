@@ -24,6 +24,12 @@ class SosMessager:
         print >> o, 'HELP: messager down! (internal error in message.py, please contact administrator)'
     output = staticmethod(output)
 
+    def take_pending(): return []
+    take_pending = staticmethod(take_pending)
+
+    def put_pending(messages): pass
+    put_pending = staticmethod(put_pending)
+
     def info(msg, duration=3, escaped=False): pass
     info = staticmethod(info)
 
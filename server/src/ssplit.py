@@ -130,6 +130,41 @@ def newline_sentence_boundary_gen(text):
     for o in _sentence_boundary_gen(text, SENTENCE_END_NEWLINE_REGEX):
         yield o
 
+def merge_crossed_sentences(sentence_offsets, spans):
+    '''
+    Return the given (sorted) sentence offsets with the sentences that a
+    span crosses the end of merged with the sentences that follow until
+    no span crosses a sentence end. A span reaching into the gap between
+    two sentences, but not into the next one, extends the sentence instead.
+
+    Takes O((sentences + spans) log spans) time, sweeping over the spans
+    sorted by start offset.
+    '''
+    spans = sorted(spans)
+    span_i = 0
+    merged = []
+    max_end = -1
+    s_i = 0
+    while s_i < len(sentence_offsets):
+        s_start, s_end = sentence_offsets[s_i]
+        s_i += 1
+        while True:
+            # How far do the spans that start within the sentence reach?
+            while span_i < len(spans) and spans[span_i][0] < s_end:
+                max_end = max(max_end, spans[span_i][1])
+                span_i += 1
+            if max_end <= s_end:
+                break
+            if (s_i < len(sentence_offsets)
+                    and max_end > sentence_offsets[s_i][0]):
+                # Merge this sentence and the next sentence
+                s_end = sentence_offsets[s_i][1]
+                s_i += 1
+            else:
+                s_end = max_end
+        merged.append((s_start, s_end))
+    return merged
+
 if __name__ == '__main__':
     from sys import argv
 
@@ -11,127 +11,258 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 '''
 
-from cPickle import UnpicklingError
-from cPickle import dump as pickle_dump
-from cPickle import load as pickle_load
 from logging import info as log_info
-from os import listdir
-from os.path import isfile, getmtime
+from os.path import getmtime
+from time import time
 from os.path import join as path_join
 
-from annotation import Annotations, open_textfile
+from common import can_fork_workers
+from annotation import (Annotations, open_textfile, iter_annotations,
+        TextBoundAnnotation, BinaryRelationAnnotation, EventAnnotation,
+        EquivAnnotation)
 from config import DATA_DIR, BASE_DIR
-from message import Messager
-from projectconfig import get_config_path, options_get_validation
+from projectconfig import (ProjectConfiguration, get_config_path,
+        get_labels_by_storage_form, get_node_by_storage_form,
+        options_get_validation)
+
+try:
+    from config import STATS_WORKERS
+except ImportError:
+    # As many as there are CPUs
+    STATS_WORKERS = None
+
+try:
+    from config import STATS_TIME_BUDGET
+except ImportError:
+    STATS_TIME_BUDGET = None
 
 ### Constants
-STATS_CACHE_FILE_NAME = '.stats_cache'
+# Below this many documents generating in a single process is faster
+PARALLEL_STATS_MIN_DOCUMENTS = 8
 ###
 
-def get_stat_cache_by_dir(directory):
-    return path_join(directory, STATS_CACHE_FILE_NAME)
+# Project configuration shared by the documents generated by a worker
+# process, see _init_stats_worker()
+_worker_projectconf = None
 
 # TODO: Move this to a util module
 def get_config_py_path():
     return path_join(BASE_DIR, 'config.py')
 
-# TODO: Quick hack, prettify and use some sort of csv format
-def get_statistics(directory, base_names, use_cache=True):
-    # Check if we have a cache of the costly satistics generation
-    # Also, only use it if no file is newer than the cache itself
-    cache_file_path = get_stat_cache_by_dir(directory)
+def _count_equiv_groups(equivs):
+    # Equivs sharing an entity are merged into one by Annotations, count
+    # the resulting groups by joining the entity sets as we go
+    group_by_ent = {}
+    groups = []
+    for ents in equivs:
+        group = set(ents)
+        for ent in ents:
+            other = group_by_ent.get(ent)
+            if other is not None and other is not group:
+                group |= other
+                groups.remove(other)
+        groups.append(group)
+        for ent in group:
+            group_by_ent[ent] = group
+    return len(groups)
 
-    try:
-        cache_mtime = getmtime(cache_file_path);
-    except OSError, e:
-        if e.errno == 2:
-            cache_mtime = -1;
-        else:
-            raise
+def get_document_counts(document):
+    '''
+    Return the number of entities, relations (equivs included) and events
+    in the given document, as for the statistics, reading the annotation
+    lines as a stream instead of creating an Annotations object.
+    '''
+    tb_ids = set()
+    trigger_ids = set()
+    rel_ids = set()
+    event_ids = set()
+    equivs = []
+    for ann in iter_annotations(document, kinds='TR*E'):
+        if isinstance(ann, TextBoundAnnotation):
+            tb_ids.add(ann.id)
+        elif isinstance(ann, BinaryRelationAnnotation):
+            rel_ids.add(ann.id)
+        elif isinstance(ann, EventAnnotation):
+            event_ids.add(ann.id)
+            trigger_ids.add(ann.trigger)
+        elif isinstance(ann, EquivAnnotation):
+            equivs.append(ann.entities)
+    return [len(tb_ids - trigger_ids),
+            len(rel_ids) + _count_equiv_groups(equivs),
+            len(event_ids)]
 
+def get_stat_types(directory):
+    '''
+    Return the (name, type) of the statistics columns for the documents
+    of the given directory.
+    '''
+    # "header" and types
+    stat_types = [("Entities", "int"), ("Relations", "int"), ("Events", "int")]
+
+    if options_get_validation(directory) != 'none':
+        stat_types.append(("Issues", "int"))
+    return stat_types
+
+def get_stats_fingerprint(directory):
+    '''
+    Return a value that changes whenever the configuration that the
+    statistics for the documents of the given directory depend on does.
+    '''
+    config_path = get_config_path(directory)
+    fingerprint = [options_get_validation(directory), config_path]
+    for path in (get_config_py_path(), config_path):
+        try:
+            fingerprint.append(getmtime(path))
+        except (OSError, TypeError):
+            # No such file (or no path at all), the defaults apply
+            fingerprint.append(None)
+    return repr(fingerprint)
+
+def get_document_stats(directory, docname, projectconf=None):
+    '''
+    Return the statistics for a document in the given directory, in the
+    order of the columns given by get_stat_types(), -1 for all of them if
+    they could not be generated. The project configuration for the
+    directory is created unless given.
+    '''
     try:
-        if (not isfile(cache_file_path)
-                # Has config.py been changed?
-                or getmtime(get_config_py_path()) > cache_mtime
-                # Any file has changed in the dir since the cache was generated
-                or any(True for f in listdir(directory)
-                    if (getmtime(path_join(directory, f)) > cache_mtime
-                    # Ignore hidden files
-                    and not f.startswith('.')))
-                # The configuration is newer than the cache
-                or getmtime(get_config_path(directory)) > cache_mtime):
-            generate = True
-            docstats = []
-        else:
-            generate = False
+        if options_get_validation(directory) == 'none':
+            # No need to hold the whole document just to count
+            return get_document_counts(path_join(directory, docname))
+
+        with Annotations(path_join(directory, docname),
+                read_only=True) as ann_obj:
+            tb_count = len([a for a in ann_obj.get_entities()])
+            rel_count = (len([a for a in ann_obj.get_relations()]) +
+                         len([a for a in ann_obj.get_equivs()]))
+            event_count = len([a for a in ann_obj.get_events()])
+
+            # verify and include verification issue count
             try:
-                with open(cache_file_path, 'rb') as cache_file:
-                    docstats = pickle_load(cache_file)
-                if len(docstats) != len(base_names):
-                    Messager.warning('Stats cache %s was incomplete; regenerating' % cache_file_path)
-                    generate = True
-                    docstats = []
-            except UnpicklingError:
-                # Corrupt data, re-generate
-                Messager.warning('Stats cache %s was corrupted; regenerating' % cache_file_path, -1)
-                generate = True
-            except EOFError:
-                # Corrupt data, re-generate
-                generate = True
-    except OSError, e:
-        Messager.warning('Failed checking file modification times for stats cache check; regenerating')
-        generate = True
+                if projectconf is None:
+                    projectconf = ProjectConfiguration(directory)
+                from verify_annotations import verify_annotation
+                issues = verify_annotation(ann_obj, projectconf)
+                issue_count = len(issues)
+            except:
+                # TODO: error reporting
+                issue_count = -1
+            return [tb_count, rel_count, event_count, issue_count]
+    except Exception, e:
+        log_info('Received "%s" when trying to generate stats' % e)
+        # Pass exceptions silently, just marking stats missing
+        return [-1] * len(get_stat_types(directory))
 
-    if not use_cache:
-        generate = True
+def _compiled_projectconf(directory):
+    # A project configuration for the directory with the configuration
+    # parsed and indexed up front, for worker processes to inherit rather
+    # than each doing the same
+    projectconf = ProjectConfiguration(directory)
+    projectconf.get_entity_types()
+    projectconf.get_event_types()
+    projectconf.get_relation_types()
+    projectconf.get_attribute_types()
+    get_node_by_storage_form(directory, None)
+    get_labels_by_storage_form(directory, None)
+    return projectconf
 
-    # "header" and types
-    stat_types = [("Entities", "int"), ("Relations", "int"), ("Events", "int")]
+def _init_stats_worker(projectconf):
+    global _worker_projectconf
+    _worker_projectconf = projectconf
+
+def _worker_document_stats(job):
+    directory, docname = job
+    return docname, get_document_stats(directory, docname,
+            _worker_projectconf)
+
+def generate_document_stats(directory, docnames, workers=STATS_WORKERS,
+        time_budget=None):
+    '''
+    Generate the statistics for the named documents of the given directory,
+    spread over the given number of worker processes (as many as there are
+    CPUs if None) sharing one project configuration. Return a dictionary
+    from document names to their statistics, leaving out the documents not
+    done within time_budget seconds (if not None).
+
+    The workers are forked from the calling process, which must hold no
+    open database transactions or other locks that they would inherit.
+    Processes running other threads (see common.can_fork_workers())
+    generate the statistics themselves.
+    '''
+    deadline = time() + time_budget if time_budget is not None else None
+    docstats = {}
+    if not docnames:
+        return docstats
 
     if options_get_validation(directory) != 'none':
-        stat_types.append(("Issues", "int"))
-            
-    if generate:
-        # Generate the document statistics from scratch
-        from annotation import JOINED_ANN_FILE_SUFF
-        log_info('generating statistics for "%s"' % directory)
-        docstats = []
-        for docname in base_names:
+        projectconf = _compiled_projectconf(directory)
+    else:
+        projectconf = None
+
+    if workers is None:
+        from multiprocessing import cpu_count
+        workers = cpu_count()
+    workers = min(workers, len(docnames))
+
+    if (workers <= 1 or len(docnames) < PARALLEL_STATS_MIN_DOCUMENTS
+            or not can_fork_workers()):
+        for docname in docnames:
+            if deadline is not None and time() >= deadline:
+                break
+            docstats[docname] = get_document_stats(directory, docname,
+                    projectconf)
+        return docstats
+
+    from multiprocessing import Pool, TimeoutError
+    pool = Pool(workers, _init_stats_worker, (projectconf, ))
+    try:
+        # One document at a time, as only then can we wait for results
+        # with a timeout
+        results = pool.imap_unordered(_worker_document_stats,
+                [(directory, docname) for docname in docnames])
+        while True:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - time())
             try:
-                with Annotations(path_join(directory, docname), 
-                        read_only=True) as ann_obj:
-                    tb_count = len([a for a in ann_obj.get_entities()])
-                    rel_count = (len([a for a in ann_obj.get_relations()]) +
-                                 len([a for a in ann_obj.get_equivs()]))
-                    event_count = len([a for a in ann_obj.get_events()])
-
-
-                    if options_get_validation(directory) == 'none':
-                        docstats.append([tb_count, rel_count, event_count])
-                    else:
-                        # verify and include verification issue count
-                        try:
-                            from projectconfig import ProjectConfiguration
-                            projectconf = ProjectConfiguration(directory)
-                            from verify_annotations import verify_annotation
-                            issues = verify_annotation(ann_obj, projectconf)
-                            issue_count = len(issues)
-                        except:
-                            # TODO: error reporting
-                            issue_count = -1
-                        docstats.append([tb_count, rel_count, event_count, issue_count])
-            except Exception, e:
-                log_info('Received "%s" when trying to generate stats' % e)
-                # Pass exceptions silently, just marking stats missing
-                docstats.append([-1] * len(stat_types))
-
-        # Cache the statistics
-        try:
-            with open(cache_file_path, 'wb') as cache_file:
-                pickle_dump(docstats, cache_file)
-        except IOError, e:
-            Messager.warning("Could not write statistics cache file to directory %s: %s" % (directory, e))
+                docname, stats = results.next(timeout)
+            except (StopIteration, TimeoutError):
+                break
+            docstats[docname] = stats
+    finally:
+        # Abandons whatever is left if we ran out of time
+        pool.terminate()
+        pool.join()
+    return docstats
+
+def get_statistics(directory, base_names, use_cache=True):
+    '''
+    Return the statistics column (name, type) headers for the given
+    directory and the statistics for each of the named documents in it.
 
+    The statistics are kept per document in the collection manifest, so
+    that only those of documents changed since they were last generated
+    (or all of them if the configuration changed) are generated again.
+    With use_cache False they are all generated from scratch.
+    '''
+    stat_types = get_stat_types(directory)
+    if not use_cache:
+        log_info('generating statistics for "%s"' % directory)
+        docstats = generate_document_stats(directory, base_names)
+        return stat_types, [docstats[docname] for docname in base_names]
+
+    # The manifest generates its statistics using this module
+    from manifest import get_manifest
+    _, documents, _ = get_manifest(directory, time_budget=None)
+    stats_by_name = dict((doc[0], doc[2:]) for doc in documents)
+    docstats = []
+    for docname in base_names:
+        try:
+            docstats.append(stats_by_name[docname])
+        except KeyError:
+            # Not a document listed in the manifest (hidden, say)
+            docstats.append(get_document_stats(directory, docname))
     return stat_types, docstats
 
 # TODO: Testing!
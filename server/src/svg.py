@@ -19,7 +19,7 @@ from os.path import join as path_join
 from os.path import isfile, exists
 from os import makedirs, mkdir
 
-from annotator import open_textfile
+from annotation import open_textfile
 from common import ProtocolError, NoPrintJSONError
 from config import BASE_DIR, WORK_DIR
 from document import real_directory
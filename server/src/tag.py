@@ -150,7 +150,10 @@ def tag(collection, document, tagger):
 
         mods = ModificationTracker()
 
-        for ann_data in json_resp.itervalues():
+        # Allocate the ids for all the hits in one go
+        new_ids = ann_obj.reserve_new_ids('T', len(json_resp))
+
+        for _id, ann_data in zip(new_ids, json_resp.itervalues()):
             assert 'offsets' in ann_data, 'Tagger response lacks offsets'
             offsets = ann_data['offsets']
             assert 'type' in ann_data, 'Tagger response lacks type'
@@ -165,13 +168,11 @@ def tag(collection, document, tagger):
             start, end = offsets[0]
             text = texts[0]
 
-            _id = ann_obj.get_new_id('T')
-
             tb = TextBoundAnnotationWithText(offsets, _id, _type, text, " " + ' '.join(texts[1:]))
 
-            mods.addition(tb)
             ann_obj.add_annotation(tb)
 
+        mods.record_changes(ann_obj)
         mod_resp = mods.json_response()
         mod_resp['annotations'] = _json_from_ann(ann_obj)
         return mod_resp
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Persistent per-collection inverted index of the words in the document
+texts, used to find word and prefix matches without reading every text
+and annotation file of a collection.
+
+The index is a small SQLite database under WORK_DIR mapping each word
+(lowercased) to the documents it occurs in and its offsets in them. It is
+brought up to date incrementally before every lookup, see
+workdir.refresh_documents(): once texts were added to or removed from the
+collection, only those that were added or changed (by modification time
+and size) since they were last indexed are read again. Texts are not
+written in place by the server, those that are imported are marked by
+invalidate_document().
+'''
+
+import re
+import sqlite3 as sqlite
+
+from array import array
+from logging import info as log_info
+from os import listdir, stat
+from os.path import join as path_join
+from os.path import basename, dirname
+
+from annotation import open_textfile, TEXT_FILE_SUFFIX
+from workdir import mark_changed, open_database, refresh_documents
+
+### Constants
+# Sub-directory of the work directory holding the indices
+TEXT_INDEX_DIR_NAME = 'text_index'
+# Bump this whenever the schema or the tokenisation changes
+TEXT_INDEX_VERSION = 2
+# Seconds to wait for other processes updating the same index
+TEXT_INDEX_TIMEOUT = 30
+# What is indexed as a word, the same as what lies between two "\b" in a
+# regular expression with re.UNICODE
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+###
+
+_SCHEMA = (
+        'CREATE TABLE documents ('
+            'id INTEGER PRIMARY KEY, name TEXT UNIQUE, identity TEXT)',
+        'CREATE TABLE postings ('
+            'word TEXT, document INTEGER, offsets BLOB)',
+        'CREATE INDEX postings_word ON postings (word)',
+        'CREATE INDEX postings_document '
+            'ON postings (document)',
+        )
+
+
+def _connect(directory):
+    # Returns a connection to the index for the given directory, None if it
+    # can not be opened
+    return open_database(TEXT_INDEX_DIR_NAME, directory, _SCHEMA,
+            TEXT_INDEX_VERSION, TEXT_INDEX_TIMEOUT)
+
+
+def text_words(text):
+    '''
+    Generate the (lowercased word, start offset) of the words of a text
+    as indexed.
+    '''
+    for m in WORD_RE.finditer(text):
+        yield m.group().lower(), m.start()
+
+
+def _store_text(conn, doc_id, text):
+    # Index the text of a document
+    offsets_by_word = {}
+    for word, start in text_words(text):
+        try:
+            offsets_by_word[word].append(start)
+        except KeyError:
+            offsets_by_word[word] = array('i', (start, ))
+    conn.executemany('INSERT INTO postings (word, document, offsets) '
+            'VALUES (?, ?, ?)', ((word, doc_id, buffer(offsets.tostring()))
+                for word, offsets in offsets_by_word.iteritems()))
+
+
+def _delete_text(conn, doc_id):
+    conn.execute('DELETE FROM postings WHERE document = ?', (doc_id, ))
+
+
+def _text_identity(path):
+    st = stat(path)
+    return repr((st.st_mtime, st.st_size))
+
+
+def _text_identities(directory, names):
+    # The identities of the texts in the directory, by name, of the given
+    # ones only if names is not None
+    if names is None:
+        names = [file_name[:-len(TEXT_FILE_SUFFIX) - 1]
+                for file_name in listdir(directory)
+                if file_name.endswith('.' + TEXT_FILE_SUFFIX)]
+    identities = {}
+    for name in names:
+        try:
+            identities[name] = _text_identity(path_join(directory,
+                name + '.' + TEXT_FILE_SUFFIX))
+        except OSError:
+            # Gone already
+            pass
+    return identities
+
+
+def _read_text(path):
+    with open_textfile(path, 'r') as txt_file:
+        return txt_file.read()
+
+
+def _read_document_text(directory, name):
+    path = path_join(directory, name + '.' + TEXT_FILE_SUFFIX)
+    try:
+        return _read_text(path)
+    except (IOError, UnicodeDecodeError), e:
+        # Can not be searched, do not try again until it changes
+        log_info('Could not index %s: %s' % (path, e))
+        return u''
+
+
+def _open_index(directory):
+    # Returns a connection to the up to date index for the given directory,
+    # None if not available
+    conn = _connect(directory)
+    if conn is None:
+        return None
+    try:
+        refresh_documents(conn, TEXT_INDEX_DIR_NAME, directory,
+                _text_identities, _read_document_text, _store_text,
+                _delete_text)
+    except (OSError, sqlite.Error), e:
+        log_info('Could not update text index for %s: %s' % (directory, e))
+        conn.close()
+        return None
+    return conn
+
+
+def _word_condition(word, prefix):
+    if prefix:
+        # All words sorting from the prefix up to those starting with the
+        # highest character after it
+        return 'word >= ? AND word < ?', (word, word + u'\U0010ffff')
+    return 'word = ?', (word, )
+
+
+def lookup_documents(directory, words, prefix_last=False):
+    '''
+    Return the names of the documents in the given directory whose texts
+    contain all the given (lowercased) words, the last of them also as a
+    prefix of a word if prefix_last is True, or None if the index is not
+    available.
+    '''
+    conn = _open_index(directory)
+    if conn is None:
+        return None
+    try:
+        found = None
+        for i, word in enumerate(words):
+            condition, args = _word_condition(word,
+                    prefix_last and i == len(words) - 1)
+            docs = set(doc for doc, in conn.execute('SELECT DISTINCT '
+                'document FROM postings WHERE ' + condition, args))
+            found = docs if found is None else found & docs
+            if not found:
+                return set()
+        names = dict(conn.execute('SELECT id, name FROM documents'))
+    finally:
+        conn.close()
+    return set(names[doc] for doc in found or ())
+
+
+def lookup_postings(directory, word, prefix=False):
+    '''
+    Return a dictionary from the names of the documents in the given
+    directory to the sorted start offsets in their texts of the given
+    (lowercased) word, or of the words starting with it if prefix is
+    True, or None if the index is not available.
+    '''
+    conn = _open_index(directory)
+    if conn is None:
+        return None
+    try:
+        condition, args = _word_condition(word, prefix)
+        postings = {}
+        for name, offsets in conn.execute('SELECT name, offsets FROM '
+                'postings JOIN documents ON document = id WHERE ' + condition,
+                args):
+            postings.setdefault(name, array('i')).fromstring(str(offsets))
+    finally:
+        conn.close()
+    return dict((name, sorted(offsets))
+            for name, offsets in postings.iteritems())
+
+
+def invalidate_document(document):
+    '''
+    Mark the given document (path without suffix) as changed, for its text
+    to be indexed again before the next lookup in its collection. To be
+    called once its text is written, never waits for the index.
+    '''
+    mark_changed(TEXT_INDEX_DIR_NAME, dirname(document), basename(document))
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import remove, utime
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    import workdir
+
+    TEXTS = {
+            'a': u'Breast cancer and ovarian cancer.\n',
+            'b': u'Cancers of the breast, BRCA1.\n',
+            'c': u'No étude of this.\n',
+            }
+
+    class TestTextIndex(TestCase):
+        def setUp(self):
+            self._work_dir = workdir.WORK_DIR
+            self._tmp_work_dir = workdir.WORK_DIR = mkdtemp()
+            self._dir = mkdtemp()
+            for name, text in TEXTS.iteritems():
+                self._write(name, text)
+
+        def tearDown(self):
+            workdir.WORK_DIR = self._work_dir
+            rmtree(self._tmp_work_dir)
+            rmtree(self._dir)
+
+        def _write(self, name, text, mtime=None):
+            path = path_join(self._dir, name + '.' + TEXT_FILE_SUFFIX)
+            with open(path, 'w') as txt_file:
+                txt_file.write(text.encode('utf-8'))
+            if mtime is not None:
+                utime(path, (mtime, mtime))
+
+        def _scan(self, word, prefix=False):
+            # The postings found by going through every text
+            postings = {}
+            for file_name in listdir(self._dir):
+                name = file_name[:-len(TEXT_FILE_SUFFIX) - 1]
+                for w, start in text_words(_read_text(
+                        path_join(self._dir, file_name))):
+                    if w == word or prefix and w.startswith(word):
+                        postings.setdefault(name, []).append(start)
+            return postings
+
+        def _assert_as_scan(self):
+            for word in (u'cancer', u'breast', u'brca1', u'étude',
+                    u'missing'):
+                for prefix in (False, True):
+                    self.assertEqual(lookup_postings(self._dir, word,
+                        prefix), self._scan(word, prefix))
+
+        def test_lookup(self):
+            self._assert_as_scan()
+            self.assertEqual(lookup_documents(self._dir,
+                [u'breast', u'cancer']), set(['a']))
+            self.assertEqual(lookup_documents(self._dir,
+                [u'breast', u'cancer'], prefix_last=True), set(['a', 'b']))
+            self.assertEqual(lookup_documents(self._dir,
+                [u'breast', u'missing']), set())
+
+        def test_refresh(self):
+            self._assert_as_scan()
+            # Same size, only the modification time tells, and only once
+            # marked or the directory changes
+            self._write('a', TEXTS['a'].replace(u'ovarian', u'gastric'),
+                    1000)
+            self.assertEqual(lookup_documents(self._dir, [u'gastric']),
+                    set())
+            invalidate_document(path_join(self._dir, 'a'))
+            self._assert_as_scan()
+            self._write('d', u'Cancer.\n')
+            remove(path_join(self._dir, 'b.' + TEXT_FILE_SUFFIX))
+            self._assert_as_scan()
+            self.assertEqual(lookup_documents(self._dir, [u'ovarian']),
+                    set())
+            self.assertEqual(lookup_documents(self._dir, [u'gastric']),
+                    set(['a']))
+
+        def test_unavailable(self):
+            workdir.WORK_DIR = None
+            self.assertEqual(lookup_documents(self._dir, [u'cancer']), None)
+            self.assertEqual(lookup_postings(self._dir, u'cancer'), None)
+
+    unittest.main()
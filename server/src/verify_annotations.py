@@ -75,15 +75,24 @@ def check_textbound_overlap(anns):
     """
     overlapping = []
 
-    for a1 in anns:
-        for a2 in anns:
-            if a1 is a2:
-                continue
+    # sweep over the annotations in order of start offset, keeping
+    # those that have started but not yet ended; only these can
+    # overlap with the next one
+    by_start = sorted(enumerate(anns), key=lambda (i, a): a.first_start())
+    active = []
+    for i2, a2 in by_start:
+        active = [(i1, a1) for i1, a1 in active
+                  if a1.last_end() > a2.first_start()]
+        for i1, a1 in active:
             if (a2.first_start() < a1.last_end() and
                 a2.last_end() > a1.first_start()):
-                overlapping.append((a1,a2))
+                overlapping.append((i1, i2, a1, a2))
+                overlapping.append((i2, i1, a2, a1))
+        active.append((i2, a2))
 
-    return overlapping
+    # report in the order of the given annotations
+    overlapping.sort(key=lambda o: o[:2])
+    return [(a1, a2) for _, _, a1, a2 in overlapping]
 
 def verify_equivs(ann_obj, projectconf):
     issues = []
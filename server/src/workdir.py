@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Files kept by the server under WORK_DIR to speed up later requests: the
+caches are written so that concurrent readers never see a partially
+written file, and may be kept to a number of files, and the SQLite
+databases (manifests and indices) are kept per collection directory,
+along with marks for the documents changed since they were updated.
+'''
+
+import sqlite3 as sqlite
+
+from contextlib import contextmanager
+from hashlib import sha1
+from logging import info as log_info
+from os import close, fdopen, listdir, makedirs, remove, rename, stat
+from os import open as os_open, O_CREAT, O_WRONLY
+from os.path import join as path_join
+from os.path import abspath, dirname, exists, isdir, normpath
+from tempfile import mkstemp
+
+try:
+    from config import WORK_DIR
+except ImportError:
+    # Most likely used as a stand-alone tool, nothing is kept
+    WORK_DIR = None
+
+### Constants
+# Documents read before writing them to a database, in one transaction, by
+# refresh_documents()
+REFRESH_BATCH_DOCUMENTS = 32
+###
+
+
+def write_cache_file(path, data, max_files=None):
+    '''
+    Write the given string to the given cache file, creating its directory
+    if needed, and then evict the oldest files of the directory if there
+    are more than max_files of them (see evict_cache_files()). Return True
+    if written, failures are only logged as caches are optional.
+    '''
+    cache_dir = dirname(path)
+    try:
+        if not isdir(cache_dir):
+            makedirs(cache_dir)
+        # Written to a hidden temporary file renamed onto the cache file,
+        # hidden for it not to be evicted or counted while being written
+        tmp_fh, tmp_fname = mkstemp(dir=cache_dir, prefix='.')
+        try:
+            with fdopen(tmp_fh, 'wb') as cache_file:
+                cache_file.write(data)
+            rename(tmp_fname, path)
+        except:
+            remove(tmp_fname)
+            raise
+    except (IOError, OSError), e:
+        log_info('Could not write cache file %s: %s' % (path, e))
+        return False
+
+    if max_files is not None:
+        evict_cache_files(cache_dir, max_files)
+    return True
+
+
+def evict_cache_files(cache_dir, max_files):
+    '''
+    Remove the files of the given cache directory with the oldest
+    modification times (the last written, or used if the cache touches its
+    files on use) if there are more than max_files of them, down to three
+    quarters of max_files so that a full cache is not gone through on
+    every write.
+    '''
+    try:
+        cached = [f for f in listdir(cache_dir) if not f.startswith('.')]
+    except OSError, e:
+        log_info('Could not list cache directory %s: %s' % (cache_dir, e))
+        return
+    if len(cached) <= max_files:
+        return
+
+    by_age = []
+    for f in cached:
+        try:
+            by_age.append((stat(path_join(cache_dir, f)).st_mtime, f))
+        except OSError:
+            # Evicted by someone else already
+            pass
+    by_age.sort()
+    for _, f in by_age[:len(by_age) - max_files * 3 / 4]:
+        try:
+            remove(path_join(cache_dir, f))
+        except OSError:
+            pass
+
+
+def unicode_path(path):
+    '''
+    Return the given path as unicode, as SQLite wants it, paths coming both
+    as UTF-8 encoded strings and as unicode.
+    '''
+    if isinstance(path, str):
+        return path.decode('utf-8')
+    return path
+
+
+def _database_path(dir_name, directory):
+    directory = normpath(abspath(unicode_path(directory)))
+    return path_join(WORK_DIR, dir_name,
+            sha1(directory.encode('utf-8')).hexdigest() + '.sqlite')
+
+
+def open_database(dir_name, directory, schema, version, timeout,
+        create=True):
+    '''
+    Return a connection to the SQLite database kept in the given
+    sub-directory of the work directory for the given (collection)
+    directory, initialised by init_database() with the given schema and
+    version, waiting at most timeout seconds for other writers. Return None
+    if there is no work directory, if the database can not be opened
+    (logged) or if it does not exist and create is False.
+    '''
+    if WORK_DIR is None:
+        return None
+    db_path = _database_path(dir_name, directory)
+    if not create and not exists(db_path):
+        return None
+    try:
+        if not isdir(dirname(db_path)):
+            makedirs(dirname(db_path))
+        conn = sqlite.connect(db_path, timeout=timeout)
+        init_database(conn, schema, version)
+        return conn
+    except (OSError, sqlite.Error), e:
+        log_info('Could not open database %s: %s' % (db_path, e))
+        return None
+
+
+def init_database(conn, schema, version):
+    '''
+    Prepare the database of the given connection for use: create it with
+    the given schema (a sequence of statements) unless it already has the
+    given version, dropping whatever tables it has first. The version is
+    kept in an "info" table of (key, value) pairs, see get_info(). The
+    connection is left without implicit transactions, see
+    write_transaction().
+    '''
+    conn.isolation_level = None
+    conn.execute('CREATE TABLE IF NOT EXISTS info ('
+            'key TEXT PRIMARY KEY, value TEXT)')
+    if get_info(conn, 'version') == str(version):
+        return
+    with write_transaction(conn):
+        # Someone else may have done it while we were waiting
+        if get_info(conn, 'version') == str(version):
+            return
+        tables = [name for name, in conn.execute('SELECT name FROM '
+            "sqlite_master WHERE type = 'table' AND name != 'info'")]
+        for name in tables:
+            conn.execute('DROP TABLE "%s"' % name)
+        conn.execute('DELETE FROM info')
+        for statement in schema:
+            conn.execute(statement)
+        set_info(conn, 'version', str(version))
+
+
+def get_info(conn, key):
+    row = conn.execute('SELECT value FROM info WHERE key = ?',
+            (key, )).fetchone()
+    return row[0] if row is not None else None
+
+
+def set_info(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)',
+            (key, value))
+
+
+@contextmanager
+def write_transaction(conn):
+    '''
+    Run the block in a transaction of the given connection (as opened by
+    open_database()) taking the write lock up front, committed at the end
+    of the block and rolled back if it raises an exception.
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def mark_changed(dir_name, directory, name):
+    '''
+    Mark the named document of the given directory as changed for the
+    database kept for the directory in the given sub-directory of the work
+    directory, if there is one, for take_changed() to return it. The marks
+    are files kept next to the database, so that marking a document never
+    waits for whoever is updating the database.
+    '''
+    if WORK_DIR is None:
+        return
+    db_path = _database_path(dir_name, directory)
+    if not exists(db_path):
+        # Will be built from the files as they are then
+        return
+    # As UTF-8, whatever the file system encoding
+    marks_dir = (db_path + '.changed').encode('utf-8')
+    try:
+        if not isdir(marks_dir):
+            try:
+                makedirs(marks_dir)
+            except OSError:
+                # Made by someone else meanwhile, or we can not
+                if not isdir(marks_dir):
+                    raise
+        # Named as the document, no two documents having the same name
+        close(os_open(path_join(marks_dir,
+            unicode_path(name).encode('utf-8')), O_WRONLY | O_CREAT, 0666))
+    except OSError, e:
+        log_info('Could not mark %s as changed in %s: %s' % (name,
+            db_path, e))
+
+
+def take_changed(dir_name, directory):
+    '''
+    Return the names of the documents of the given directory marked by
+    mark_changed() for the database kept for the directory in the given
+    sub-directory of the work directory, removing the marks. The documents
+    are to be read only once their marks are taken: a document changed
+    after that is marked again.
+    '''
+    if WORK_DIR is None:
+        return set()
+    marks_dir = (_database_path(dir_name, directory)
+            + '.changed').encode('utf-8')
+    try:
+        marked = listdir(marks_dir)
+    except OSError:
+        # None marked yet
+        return set()
+    taken = set()
+    for name in marked:
+        try:
+            remove(path_join(marks_dir, name))
+        except OSError:
+            # Taken by someone else
+            continue
+        taken.add(name.decode('utf-8'))
+    return taken
+
+
+def refresh_documents(conn, dir_name, directory, identities, read, store,
+        delete):
+    '''
+    Bring the documents of the database of the given connection, kept for
+    the given directory in the given sub-directory of the work directory,
+    up to date with the files of the directory. The database has a
+    "documents" table of (id INTEGER PRIMARY KEY, name TEXT UNIQUE,
+    identity TEXT) rows, the rest is up to the caller:
+
+    - identities(directory, names) returns the identities (strings) of the
+      documents of the directory by name, of all of them if names is None
+      and of those among names that still exist otherwise,
+    - read(directory, name) returns the data of a document, read outside
+      of any transaction,
+    - store(conn, doc_id, data) stores the data of a document,
+    - delete(conn, doc_id) deletes whatever was stored for a document.
+
+    When the directory has changed since the last call (documents added
+    or removed) the identities of all the documents are compared with the
+    stored ones, otherwise only the documents marked by mark_changed() are
+    read again: a document changed in place without being marked is only
+    seen once its directory changes.
+    '''
+    directory = unicode_path(directory)
+    changed = take_changed(dir_name, directory)
+    try:
+        # The ctime as well as the mtime, as restoring a directory (or a
+        # backup of it) may well have set its mtime back
+        st = stat(directory)
+        dir_identity = repr((st.st_mtime, st.st_ctime, st.st_ino))
+        if get_info(conn, 'dir_identity') != dir_identity:
+            current = identities(directory, None)
+            stored = dict(conn.execute('SELECT name, identity FROM documents'))
+            gone = [name for name in stored if name not in current]
+            stale = [name for name, identity in current.iteritems()
+                    if name in changed or stored.get(name) != identity]
+        elif changed:
+            dir_identity = None
+            current = identities(directory, changed)
+            gone = [name for name in changed if name not in current]
+            stale = list(current)
+        else:
+            # The common case, nothing to do
+            return
+
+        if stale:
+            log_info('updating %d document(s) of "%s" in %s' % (len(stale),
+                directory, dir_name))
+        for i in xrange(0, len(stale), REFRESH_BATCH_DOCUMENTS):
+            batch = [(name, current[name], read(directory, name))
+                    for name in stale[i:i + REFRESH_BATCH_DOCUMENTS]]
+            with write_transaction(conn):
+                for name, identity, data in batch:
+                    row = conn.execute('SELECT id FROM documents '
+                            'WHERE name = ?', (name, )).fetchone()
+                    if row is None:
+                        doc_id = conn.execute('INSERT INTO documents '
+                                '(name, identity) VALUES (?, ?)',
+                                (name, identity)).lastrowid
+                    else:
+                        doc_id = row[0]
+                        conn.execute('UPDATE documents SET identity = ? '
+                                'WHERE id = ?', (identity, doc_id))
+                        delete(conn, doc_id)
+                    store(conn, doc_id, data)
+        if gone or dir_identity is not None:
+            with write_transaction(conn):
+                for name in gone:
+                    row = conn.execute('SELECT id FROM documents '
+                            'WHERE name = ?', (name, )).fetchone()
+                    if row is not None:
+                        delete(conn, row[0])
+                        conn.execute('DELETE FROM documents WHERE id = ?',
+                                (row[0], ))
+                if dir_identity is not None:
+                    set_info(conn, 'dir_identity', dir_identity)
+    except:
+        for name in changed:
+            # Still to be done next time
+            mark_changed(dir_name, directory, name)
+        raise
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    from os import utime
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    class TestCacheFiles(TestCase):
+        def setUp(self):
+            self._cache_dir = path_join(mkdtemp(), 'cache')
+
+        def tearDown(self):
+            rmtree(dirname(self._cache_dir))
+
+        def _write(self, name, max_files=None, mtime=None):
+            path = path_join(self._cache_dir, name)
+            self.assertTrue(write_cache_file(path, name, max_files))
+            if mtime is not None:
+                utime(path, (mtime, mtime))
+
+        def test_write(self):
+            self._write('a')
+            self._write('a')
+            with open(path_join(self._cache_dir, 'a'), 'rb') as cache_file:
+                self.assertEqual(cache_file.read(), 'a')
+            # No temporary files left behind
+            self.assertEqual(listdir(self._cache_dir), ['a'])
+
+        def test_unwritable(self):
+            self._write('a')
+            self.assertFalse(write_cache_file(
+                path_join(self._cache_dir, 'a', 'b'), 'b'))
+
+        def test_evict_oldest(self):
+            for i in range(8):
+                self._write(str(i), mtime=1000 + i)
+            self.assertEqual(len(listdir(self._cache_dir)), 8)
+            self._write('8', max_files=8)
+            # Down to three quarters, the most recent ones kept
+            self.assertEqual(sorted(listdir(self._cache_dir)),
+                    ['3', '4', '5', '6', '7', '8'])
+
+        def test_hidden_not_counted(self):
+            self._write('.hidden')
+            self._write('a', max_files=1)
+            self.assertEqual(sorted(listdir(self._cache_dir)),
+                    ['.hidden', 'a'])
+
+    class TestDatabase(TestCase):
+        def setUp(self):
+            global WORK_DIR
+            self._work_dir = WORK_DIR
+            WORK_DIR = mkdtemp()
+
+        def tearDown(self):
+            global WORK_DIR
+            rmtree(WORK_DIR)
+            WORK_DIR = self._work_dir
+
+        def test_changed(self):
+            schema = ('CREATE TABLE t (a)', )
+            # Nothing to mark before there is a database
+            mark_changed('test', '/data', 'a')
+            open_database('test', '/data', schema, 1, 1).close()
+            mark_changed('test', '/data', 'a')
+            mark_changed('test', '/data', u'\xe9')
+            mark_changed('test', '/data', 'a')
+            mark_changed('test', '/other', 'b')
+            self.assertEqual(take_changed('test', '/data'),
+                    set([u'a', u'\xe9']))
+            self.assertEqual(take_changed('test', '/data'), set())
+            self.assertEqual(take_changed('test', '/other'), set())
+
+        def test_refresh_documents(self):
+            directory = mkdtemp()
+            try:
+                conn = open_database('test', directory, (
+                    'CREATE TABLE documents (id INTEGER PRIMARY KEY, '
+                        'name TEXT UNIQUE, identity TEXT)',
+                    'CREATE TABLE texts (document INTEGER, text TEXT)'), 1, 1)
+                read = []
+
+                def identities(directory, names):
+                    if names is None:
+                        names = listdir(directory)
+                    return dict((name, repr(stat(path_join(directory,
+                        name)).st_mtime)) for name in names
+                        if exists(path_join(directory, name)))
+
+                def read_text(directory, name):
+                    read.append(name)
+                    with open(path_join(directory, name)) as f:
+                        return f.read()
+
+                def refresh():
+                    del read[:]
+                    refresh_documents(conn, 'test', directory, identities,
+                            read_text, lambda conn, doc_id, text:
+                            conn.execute('INSERT INTO texts (document, text) '
+                                'VALUES (?, ?)', (doc_id, text)),
+                            lambda conn, doc_id: conn.execute('DELETE FROM '
+                                'texts WHERE document = ?', (doc_id, )))
+                    return dict(conn.execute('SELECT name, text FROM '
+                        'documents JOIN texts ON document = id'))
+
+                for name in ('a', 'b'):
+                    with open(path_join(directory, name), 'w') as f:
+                        f.write(name)
+                self.assertEqual(refresh(), {u'a': u'a', u'b': u'b'})
+                self.assertEqual(refresh(), {u'a': u'a', u'b': u'b'})
+                self.assertEqual(read, [])
+                # In place, only seen once marked
+                with open(path_join(directory, 'a'), 'w') as f:
+                    f.write('c')
+                self.assertEqual(refresh(), {u'a': u'a', u'b': u'b'})
+                mark_changed('test', directory, 'a')
+                self.assertEqual(refresh(), {u'a': u'c', u'b': u'b'})
+                self.assertEqual(read, [u'a'])
+                # Removals are seen from the directory
+                remove(path_join(directory, 'b'))
+                self.assertEqual(refresh(), {u'a': u'c'})
+                self.assertEqual(read, [])
+                conn.close()
+            finally:
+                rmtree(directory)
+
+        def test_version_change(self):
+            conn = sqlite.connect(':memory:')
+            init_database(conn, ('CREATE TABLE t (a)', ), 1)
+            conn.execute('INSERT INTO t (a) VALUES (1)')
+            init_database(conn, ('CREATE TABLE t (a)', ), 1)
+            self.assertEqual(conn.execute('SELECT a FROM t').fetchall(),
+                    [(1, )])
+            # Recreated with the new schema
+            init_database(conn, ('CREATE TABLE t (a, b)', ), 2)
+            self.assertEqual(conn.execute('SELECT a, b FROM t').fetchall(),
+                    [])
+            self.assertEqual(get_info(conn, 'version'), '2')
+
+        def test_rollback(self):
+            conn = sqlite.connect(':memory:')
+            init_database(conn, ('CREATE TABLE t (a)', ), 1)
+            try:
+                with write_transaction(conn):
+                    conn.execute('INSERT INTO t (a) VALUES (1)')
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(conn.execute('SELECT a FROM t').fetchall(), [])
+
+    unittest.main()
@@ -183,6 +183,7 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
         remote_addr = self.client_address[0]
         remote_host = self.address_string()
         cookie_data = ', '.join(filter(None, self.headers.getheaders('cookie')))
+        accept_encoding = self.headers.getheader('accept-encoding')
 
         query_string = ''
         i = self.path.find('?')
@@ -205,7 +206,7 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
 
         # Call main server
         cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-                                           cookie_data)
+                                           cookie_data, accept_encoding)
 
         sys.stdin, sys.stdout, sys.stderr = saved
 
@@ -223,8 +224,12 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
         # Hack to support binary data and general Unicode for SVGs and JSON
         if isinstance(response_data[1], unicode):
             self.wfile.write(response_data[1].encode('utf-8'))
-        else:
+        elif isinstance(response_data[1], str):
             self.wfile.write(response_data[1])
+        else:
+            # Streamed in pieces
+            for data in response_data[1]:
+                self.wfile.write(data)
         return 0
 
     def allow_path(self):
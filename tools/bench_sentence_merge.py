@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Micro-benchmark for merging the sentences crossed by annotation spans
+# (see ssplit.merge_crossed_sentences) on synthetic documents.
+
+# Usage example:
+
+#     python tools/bench_sentence_merge.py -s 10000 -a 20000 --compare
+
+from __future__ import with_statement
+
+import sys
+import os
+
+from random import Random
+from time import time
+
+try:
+    from ssplit import merge_crossed_sentences
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+    from ssplit import merge_crossed_sentences
+
+def synthetic_document(sentence_count, span_count, seed=0):
+    # Newline separated sentences of 20 to 200 characters, and spans of
+    # mostly a few characters, with the odd one crossing a sentence end
+    rnd = Random(seed)
+    sentences = []
+    offset = 0
+    for i in xrange(sentence_count):
+        length = rnd.randint(20, 200)
+        sentences.append((offset, offset + length))
+        offset += length + 1
+    spans = []
+    for i in xrange(span_count):
+        start = rnd.randrange(offset - 1)
+        if rnd.random() < 0.01:
+            length = rnd.randint(1, 400)
+        else:
+            length = rnd.randint(1, 15)
+        spans.append((start, min(start + length, offset - 1)))
+    return sentences, spans
+
+def nested_loop_merge(sentences, spans):
+    # The merge formerly done in document._document_json_dict, for
+    # reference, one span at a time
+    s_breaks = list(sentences)
+    for tb_start, tb_end in spans:
+        s_i = 0
+        while s_i < len(s_breaks):
+            s_start, s_end = s_breaks[s_i]
+            if (tb_start < s_end and tb_end > s_end
+                    and s_i + 1 < len(s_breaks)):
+                s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
+                del s_breaks[s_i + 1]
+            else:
+                s_i += 1
+    return s_breaks
+
+def _time(func, *args):
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Benchmark merging sentences crossed by annotation spans.")
+    ap.add_argument("-s", "--sentences", type=int, default=10000, help="Number of sentences.")
+    ap.add_argument("-a", "--spans", type=int, default=20000, help="Number of annotation spans.")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="Number of timed runs.")
+    ap.add_argument("--compare", default=False, action="store_true", help="Also time the former nested-loop merge (slow) and check that the results agree.")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    arg = argparser().parse_args(argv[1:])
+
+    sentences, spans = synthetic_document(arg.sentences, arg.spans)
+
+    timings = []
+    for i in xrange(arg.repeat):
+        elapsed, merged = _time(merge_crossed_sentences, sentences, spans)
+        timings.append(elapsed)
+    print '%d sentences, %d spans: %d merged sentences' % (
+            len(sentences), len(spans), len(merged))
+    print 'sweep merge: best %.4fs of %d' % (min(timings), arg.repeat)
+
+    if arg.compare:
+        # The former merge never extended a sentence into the gap before
+        # the next one, so only use spans that do not end in such a gap
+        gaps = set(s_end + 1 for s_start, s_end in sentences)
+        spans = [s for s in spans if s[1] not in gaps]
+        elapsed, expected = _time(nested_loop_merge, sentences, spans)
+        print 'nested-loop merge: %.4fs' % (elapsed, )
+        if merge_crossed_sentences(sentences, spans) != expected:
+            print >> sys.stderr, 'ERROR: results differ'
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -62,11 +62,15 @@ def ent2event(anntype, fn):
                         if argid == ann.id:
                             # need to remap
                             argid = new_id
+                            ann_obj.change_annotation(e)
                             e.args[i] = role, argid
+                            ann_obj.update_deps(e)
                 for c in ann_obj.get_oneline_comments():
                     if c.target == ann.id:
                         # need to remap
+                        ann_obj.change_annotation(c)
                         c.target = new_id
+                        ann_obj.update_deps(c)
 
                 # finally, add in the new event annotation
                 ann_obj.add_annotation(eann)
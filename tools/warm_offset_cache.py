@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Fill the token and sentence offset cache for the documents of one or
+# more collections, so that the first getDocument of a (long) document
+# does not have to wait for it to be tokenised and sentence split.
+
+# Usage example:
+
+#     python tools/warm_offset_cache.py -r data/
+
+from __future__ import with_statement
+
+import sys
+import os
+
+from sys import path as sys_path
+# Guessing that we might be in the brat tools/ directory, a configuration
+# already on the path takes precedence
+sys_path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+
+from config import WORK_DIR
+
+from annotation import open_textfile, TEXT_FILE_SUFFIX
+from document import get_text_offsets
+
+def warm_collection(directory, recursive=False, verbose=False):
+    count = 0
+    for fn in sorted(os.listdir(directory)):
+        if fn.startswith('.'):
+            continue
+        path = os.path.join(directory, fn)
+        if os.path.isdir(path):
+            if recursive:
+                count += warm_collection(path, recursive, verbose)
+            continue
+        if not fn.endswith('.' + TEXT_FILE_SUFFIX):
+            continue
+
+        try:
+            with open_textfile(path, 'r') as txt_file:
+                text = txt_file.read()
+        except (IOError, UnicodeDecodeError), e:
+            print >> sys.stderr, 'Skipping %s: %s' % (path, e)
+            continue
+        get_text_offsets(directory, text)
+        count += 1
+        if verbose:
+            print >> sys.stderr, 'Cached offsets for %s' % path
+    return count
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Fill the token and sentence offset cache for the documents of collections.")
+    ap.add_argument("-r", "--recursive", default=False, action="store_true", help="Also process sub-collections.")
+    ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output.")
+    ap.add_argument("collections", metavar="DIR", nargs="+", help="Collection directory to process.")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    arg = argparser().parse_args(argv[1:])
+
+    if WORK_DIR is None:
+        print >> sys.stderr, 'No WORK_DIR configured, nothing to cache'
+        return 1
+
+    for directory in arg.collections:
+        count = warm_collection(os.path.abspath(directory), arg.recursive,
+                arg.verbose)
+        print >> sys.stderr, '%s: %d document(s)' % (directory, count)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
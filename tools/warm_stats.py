@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Generate the document statistics (and validation issue counts) of one
+# or more collections ahead of time, so that the first listing of a large
+# collection does not have to wait for them.
+
+# Usage example:
+
+#     python tools/warm_stats.py -r -w 8 data/
+
+from __future__ import with_statement
+
+import sys
+import os
+
+from sys import path as sys_path
+# Guessing that we might be in the brat tools/ directory, a configuration
+# already on the path takes precedence
+sys_path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+
+from config import WORK_DIR
+
+from manifest import get_manifest
+from stats import STATS_WORKERS
+
+def warm_collection(directory, workers, recursive=False, verbose=False):
+    _, documents, collections = get_manifest(directory, workers,
+            time_budget=None)
+    count = len(documents)
+    if verbose:
+        print >> sys.stderr, '%s: %d document(s)' % (directory, count)
+    if recursive:
+        for collection in collections:
+            count += warm_collection(os.path.join(directory, collection),
+                    workers, recursive, verbose)
+    return count
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Generate the document statistics of collections ahead of time.")
+    ap.add_argument("-r", "--recursive", default=False, action="store_true", help="Also process sub-collections.")
+    ap.add_argument("-w", "--workers", default=STATS_WORKERS, type=int, help="Number of worker processes (default: as configured, else number of CPUs).")
+    ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output.")
+    ap.add_argument("collections", metavar="DIR", nargs="+", help="Collection directory to process.")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    arg = argparser().parse_args(argv[1:])
+
+    if WORK_DIR is None:
+        print >> sys.stderr, 'No WORK_DIR configured, nothing to store'
+        return 1
+
+    for directory in arg.collections:
+        count = warm_collection(os.path.abspath(directory), arg.workers,
+                arg.recursive, arg.verbose)
+        print >> sys.stderr, '%s: %d document(s)' % (directory, count)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))